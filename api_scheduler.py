@@ -0,0 +1,199 @@
+# --- ПЛАНИРОВЩИК ИСХОДЯЩИХ ЗАПРОСОВ К TELEGRAM API ---
+import asyncio
+import logging
+import time
+from collections import deque
+from contextvars import ContextVar
+from aiogram.client.session.middlewares.base import BaseRequestMiddleware
+from aiogram.exceptions import TelegramAPIError, TelegramRetryAfter
+from aiogram.methods import DeleteMessage, DeleteMessages, GetUpdates
+from metrics import API_ERRORS_TOTAL, API_REQUEST_SECONDS
+from ratelimit import TokenBucket
+
+# Приоритеты: меньше — важнее
+PRIORITY_SPAM = 0    # удаление спама в группах
+PRIORITY_CLEAN = 1   # /clean
+PRIORITY_ADMIN = 2   # ответы админу, клавиатуры, прочее
+PRIORITY_NAMES = {PRIORITY_SPAM: "спам", PRIORITY_CLEAN: "clean", PRIORITY_ADMIN: "админ"}
+
+# Явный приоритет для запросов из текущей задачи (например, /clean)
+api_priority = ContextVar("api_priority", default=None)
+
+
+class _Pending:
+    __slots__ = ("chat_id", "future", "enqueued")
+
+    def __init__(self, chat_id, future):
+        self.chat_id = chat_id
+        self.future = future
+        self.enqueued = time.monotonic()
+
+
+class ApiScheduler(BaseRequestMiddleware):
+    """
+    Middleware сессии бота: все исходящие вызовы проходят через общую очередь.
+    Токены выдаются по глобальной корзине и корзине чата, сначала запросам
+    с более высоким приоритетом. Ответ 429 (retry_after) ставит чат (или всё API,
+    если чата нет) на паузу и повторяет запрос автоматически.
+    getUpdates идёт в обход очереди.
+    """
+
+    def __init__(self, global_rate=30, chat_rate=1, chat_burst=20, max_retries=5,
+                 stats_interval=60, slow_wait=1.0, scan_limit=100):
+        self.global_bucket = TokenBucket(global_rate)
+        self.chat_rate = chat_rate
+        self.chat_burst = chat_burst
+        self.max_retries = max_retries
+        self.stats_interval = stats_interval
+        self.slow_wait = slow_wait
+        self.scan_limit = scan_limit
+        self._chat_buckets = {}
+        self._paused_until = {}  # chat_id (или None для всего API) -> monotonic time
+        self._queues = {priority: deque() for priority in PRIORITY_NAMES}
+        self._wakeup = asyncio.Event()
+        self._pump_task = None
+        self._stats_task = None
+        self._waits = {priority: [] for priority in PRIORITY_NAMES}
+
+    @property
+    def depth(self):
+        return sum(len(queue) for queue in self._queues.values())
+
+    def priority_for(self, method):
+        priority = api_priority.get()
+        if priority is not None:
+            return priority
+        if isinstance(method, (DeleteMessage, DeleteMessages)):
+            return PRIORITY_SPAM
+        return PRIORITY_ADMIN
+
+    def _chat_bucket(self, chat_id):
+        bucket = self._chat_buckets.get(chat_id)
+        if bucket is None:
+            bucket = self._chat_buckets[chat_id] = TokenBucket(self.chat_rate, self.chat_burst)
+        return bucket
+
+    def _pause_delay(self, chat_id, now):
+        return max(0.0, self._paused_until.get(chat_id, 0.0) - now)
+
+    def pause(self, chat_id, seconds):
+        """Ставит чат (или всё API при chat_id=None) на паузу после flood wait"""
+        until = time.monotonic() + seconds
+        self._paused_until[chat_id] = max(self._paused_until.get(chat_id, 0.0), until)
+        logging.warning(f"⏳ Flood wait {seconds} с для {'всего API' if chat_id is None else f'чата {chat_id}'}")
+
+    async def __call__(self, make_request, bot, method):
+        if isinstance(method, GetUpdates):
+            return await make_request(bot, method)
+        chat_id = getattr(method, "chat_id", None)
+        priority = self.priority_for(method)
+        labels = (type(method).__name__,)
+        for attempt in range(self.max_retries + 1):
+            await self._wait_turn(priority, chat_id)
+            started = time.perf_counter()
+            try:
+                return await make_request(bot, method)
+            except TelegramRetryAfter as e:
+                API_ERRORS_TOTAL.inc(labels=labels + (type(e).__name__,))
+                if attempt == self.max_retries:
+                    raise
+                self.pause(chat_id, e.retry_after)
+            except TelegramAPIError as e:
+                API_ERRORS_TOTAL.inc(labels=labels + (type(e).__name__,))
+                raise
+            finally:
+                API_REQUEST_SECONDS.observe(time.perf_counter() - started, labels)
+
+    async def _wait_turn(self, priority, chat_id):
+        self._ensure_started()
+        pending = _Pending(chat_id, asyncio.get_running_loop().create_future())
+        self._queues[priority].append(pending)
+        self._wakeup.set()
+        await pending.future
+        waited = time.monotonic() - pending.enqueued
+        self._waits[priority].append(waited)
+        if waited >= self.slow_wait:
+            logging.warning(
+                f"🐢 Запрос к API ждал {waited:.2f} с (приоритет: {PRIORITY_NAMES[priority]}, очередь: {self.depth})"
+            )
+
+    def _ensure_started(self):
+        if self._pump_task is None or self._pump_task.done():
+            self._pump_task = asyncio.create_task(self._pump())
+        if self.stats_interval and (self._stats_task is None or self._stats_task.done()):
+            self._stats_task = asyncio.create_task(self._log_stats())
+
+    def _next_ready(self, now):
+        """
+        Первый запрос в порядке приоритета, чей чат не исчерпал лимит.
+        В каждой очереди просматриваются только первые scan_limit запросов.
+        Возвращает (очередь, индекс) или (None, задержка до ближайшей готовности).
+        """
+        soonest = None
+        for priority in sorted(self._queues):
+            queue = self._queues[priority]
+            blocked = set()
+            for index, pending in enumerate(queue):
+                if index >= self.scan_limit:
+                    break
+                if pending.future.cancelled() or pending.chat_id is None:
+                    return queue, index
+                if pending.chat_id in blocked:
+                    continue
+                delay = max(self._pause_delay(pending.chat_id, now), self._chat_bucket(pending.chat_id).delay())
+                if delay <= 0:
+                    return queue, index
+                blocked.add(pending.chat_id)
+                soonest = delay if soonest is None else min(soonest, delay)
+        return None, soonest
+
+    async def _pump(self):
+        """Выдаёт разрешения на запросы, соблюдая лимиты и приоритеты"""
+        while True:
+            if not self.depth:
+                self._wakeup.clear()
+                await self._wakeup.wait()
+                continue
+            now = time.monotonic()
+            delay = max(self._pause_delay(None, now), self.global_bucket.delay())
+            if delay > 0:
+                await asyncio.sleep(delay)
+                continue
+            queue, found = self._next_ready(now)
+            if queue is None:
+                # Все ожидающие чаты упёрлись в лимит — ждём ближайший токен или новый запрос
+                self._wakeup.clear()
+                try:
+                    await asyncio.wait_for(self._wakeup.wait(), timeout=found)
+                except asyncio.TimeoutError:
+                    pass
+                continue
+            pending = queue[found]
+            del queue[found]
+            if pending.future.cancelled():
+                continue
+            self.global_bucket.take()
+            if pending.chat_id is not None:
+                self._chat_bucket(pending.chat_id).take()
+            pending.future.set_result(None)
+
+    async def _log_stats(self):
+        """Периодически пишет в лог глубину очереди и время ожидания по приоритетам"""
+        while True:
+            await asyncio.sleep(self.stats_interval)
+            parts = []
+            for priority, waits in self._waits.items():
+                if waits:
+                    parts.append(
+                        f"{PRIORITY_NAMES[priority]}: {len(waits)} шт., "
+                        f"среднее {sum(waits) / len(waits):.3f} с, макс {max(waits):.3f} с"
+                    )
+                    waits.clear()
+            if parts or self.depth:
+                logging.info(f"📤 API: очередь {self.depth}; " + "; ".join(parts))
+            # Забываем чаты с полной корзиной и истёкшей паузой — их состояние совпадает с начальным
+            now = time.monotonic()
+            for chat_id in [c for c, b in self._chat_buckets.items() if b.full]:
+                del self._chat_buckets[chat_id]
+            for chat_id in [c for c, until in self._paused_until.items() if until <= now]:
+                del self._paused_until[chat_id]
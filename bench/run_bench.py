@@ -0,0 +1,365 @@
+"""
+Офлайн-бенчмарки горячего пути бота: check_spam, проверка правил (RuleMatcher) и хранилище.
+Telegram не нужен: вместо Message и очереди удаления используются заглушки,
+данные пишутся во временную папку.
+
+Запуск:
+    python bench/run_bench.py                      # полный набор
+    python bench/run_bench.py --quick              # уменьшенные размеры
+    python bench/run_bench.py --save base.json     # сохранить результаты
+    python bench/run_bench.py --compare base.json  # сравнить с сохранёнными (код 1 при регрессии)
+"""
+import argparse
+import asyncio
+import gc
+import json
+import logging
+import os
+import platform
+import random
+import sys
+import tempfile
+import time
+import tracemalloc
+from datetime import datetime
+from types import SimpleNamespace
+
+ROOT = os.path.dirname(os.path.dirname(os.path.abspath(__file__)))
+sys.path.insert(0, ROOT)
+
+# main.py при импорте создаёт бота и хранилище в текущей папке — уводим их во временную
+WORKDIR = tempfile.mkdtemp(prefix="antispam-bench-")
+os.chdir(WORKDIR)
+os.environ.setdefault("BOT_TOKEN", "123456:BENCHMARK")
+
+import main  # noqa: E402
+from matcher import MatcherCache, RuleMatcher  # noqa: E402
+from storage import open_storage  # noqa: E402
+
+CYRILLIC = "абвгдеёжзийклмнопрстуфхцчшщъыьэюя"
+LATIN = "abcdefghijklmnopqrstuvwxyz"
+COMMON_WORDS = [
+    "привет", "всем", "кто", "знает", "где", "купить", "сегодня", "работа", "встреча", "вопрос",
+    "спасибо", "документы", "профсоюз", "собрание", "hello", "thanks", "link", "meeting", "ok", "bot",
+]
+
+
+# Доля правил-шаблонов (re:, glob:) в наборах для бенчмарка правил
+PATTERN_SHARE = 0.1
+# Сообщений в одной записи на диск в бенчмарке flush
+FLUSH_BATCH = 100
+
+
+# --- СИНТЕТИЧЕСКИЕ ДАННЫЕ ---
+def random_word(rng, min_len=4, max_len=10):
+    alphabet = CYRILLIC if rng.random() < 0.7 else LATIN
+    return "".join(rng.choice(alphabet) for _ in range(rng.randint(min_len, max_len)))
+
+
+def make_stop_words(rng, count):
+    words = set()
+    while len(words) < count:
+        words.add(random_word(rng, 5, 12))
+    return list(words)
+
+
+def make_rules(rng, count):
+    """Правила как в бою: простые слова и доля PATTERN_SHARE шаблонов re: и glob:"""
+    rules = []
+    for word in make_stop_words(rng, count):
+        roll = rng.random()
+        if roll < PATTERN_SHARE / 2:
+            rules.append(f"re:{word[:4]}\\d+{word[-2:]}")
+        elif roll < PATTERN_SHARE:
+            rules.append(f"glob:{word[:3]}*{word[-2:]}")
+        else:
+            rules.append(word)
+    return rules
+
+
+def make_text(rng, stop_words=None, hit_rate=0.05):
+    """Сообщение из 5–40 слов, смесь кириллицы и латиницы; с вероятностью hit_rate содержит стоп-слово"""
+    words = [rng.choice(COMMON_WORDS) if rng.random() < 0.6 else random_word(rng) for _ in range(rng.randint(5, 40))]
+    if stop_words and rng.random() < hit_rate:
+        words.insert(rng.randrange(len(words) + 1), rng.choice(stop_words).upper())
+    return " ".join(words)
+
+
+def fake_message(message_id, chat_id, topic_id, user_id, text):
+    return SimpleNamespace(
+        message_id=message_id,
+        chat=SimpleNamespace(id=chat_id, type="supergroup"),
+        message_thread_id=topic_id,
+        from_user=SimpleNamespace(id=user_id, is_bot=False),
+        sender_chat=None,
+        is_automatic_forward=None,
+        text=text,
+    )
+
+
+class FakeDeletionQueue:
+    """Заглушка очереди удаления: только считает поставленные сообщения"""
+
+    def __init__(self):
+        self.enqueued = 0
+
+    async def put(self, chat_id, message_id, reason=""):
+        self.enqueued += 1
+
+
+def fresh_storage(backend, capacity):
+    path = tempfile.mkdtemp(dir=WORKDIR)
+    return open_storage(
+        backend,
+        data_path=os.path.join(path, "data.json"),
+        cache_path=os.path.join(path, "cache.jsonl"),
+        sqlite_path=os.path.join(path, "data.db"),
+        cache_capacity=capacity,
+        # Запись на диск меряется отдельно (cache_flush_*), чтобы не размазывать её по cache_message
+        flush_every=10 ** 9,
+    )
+
+
+def install(storage):
+    """Подменяет глобальное состояние main на тестовое"""
+    main.storage = storage
+    main.matchers = MatcherCache()
+    main.deletion_queue = FakeDeletionQueue()
+
+
+def seed_rules(storage, chats, topics, words_per_topic, rng):
+    """Быстро заполняет правила в памяти, минуя историю (add_rule на 10^6 слов слишком долог)"""
+    vocabulary = make_stop_words(rng, max(words_per_topic * 4, 100))
+    for chat in range(chats):
+        chat_id = -1000000000000 - chat
+        for topic_id in topics:
+            storage._words(chat_id, topic_id)[:] = rng.sample(vocabulary, words_per_topic)
+    return vocabulary
+
+
+# --- ЗАМЕРЫ ---
+def percentile(sorted_values, q):
+    if not sorted_values:
+        return 0.0
+    index = min(len(sorted_values) - 1, int(round(q * (len(sorted_values) - 1))))
+    return sorted_values[index]
+
+
+def measure(setup, op, count, memory=True):
+    """
+    Выполняет op(state, i) count раз после setup() и возвращает пропускную способность,
+    p50/p99 задержки (мкс) и, отдельным прогоном под tracemalloc, пиковую память (КиБ).
+    op может быть корутинной функцией.
+    """
+    loop = asyncio.new_event_loop()
+
+    def run(state, timings):
+        is_async = asyncio.iscoroutinefunction(op)
+        for i in range(count):
+            start = time.perf_counter_ns()
+            if is_async:
+                loop.run_until_complete(op(state, i))
+            else:
+                op(state, i)
+            if timings is not None:
+                timings.append(time.perf_counter_ns() - start)
+
+    try:
+        gc.collect()
+        state = setup()
+        timings = []
+        started = time.perf_counter()
+        run(state, timings)
+        elapsed = time.perf_counter() - started
+        timings.sort()
+        result = {
+            "n": count,
+            "ops_per_sec": round(count / elapsed, 1) if elapsed else 0.0,
+            "p50_us": round(percentile(timings, 0.50) / 1000, 2),
+            "p99_us": round(percentile(timings, 0.99) / 1000, 2),
+        }
+        del state
+        if memory:
+            gc.collect()
+            tracemalloc.start()
+            state = setup()
+            run(state, None)
+            result["peak_kib"] = round(tracemalloc.get_traced_memory()[1] / 1024, 1)
+            tracemalloc.stop()
+            del state
+        return result
+    finally:
+        loop.close()
+
+
+# --- НАБОРЫ ---
+def bench_matcher(results, sizes, count, memory):
+    """RuleMatcher, как в check_spam: normalize_text, автомат простых слов и общее выражение шаблонов"""
+    rng = random.Random(1)
+    for words_count in sizes:
+        rules = make_rules(rng, words_count)
+        plain = [rule for rule in rules if not rule.startswith(("re:", "glob:"))] or rules
+        texts = [make_text(rng, plain) for _ in range(count)]
+
+        results[f"matcher_build_{words_count}w"] = measure(
+            lambda: rules, lambda r, i: RuleMatcher(r), max(3, min(50, 20000 // words_count)), memory
+        )
+        results[f"matcher_find_{words_count}w"] = measure(
+            lambda: RuleMatcher(rules), lambda m, i: m.find(texts[i]), count, memory
+        )
+
+
+def bench_check_spam(results, grid, backend, count, memory):
+    for chats, words_per_topic in grid:
+        rng = random.Random(2)
+        topics = (None, 1, 2)
+        holder = {}
+
+        def setup():
+            storage = fresh_storage(backend, 1000)
+            install(storage)
+            holder["vocabulary"] = seed_rules(storage, chats, topics, words_per_topic, rng)
+            # Автоматы строятся заранее: замеряем установившийся режим, а не холодный старт
+            for chat in range(chats):
+                for topic_id in topics:
+                    main.get_matcher(-1000000000000 - chat, topic_id)
+            msg_rng = random.Random(3)
+            return [
+                fake_message(
+                    i, -1000000000000 - msg_rng.randrange(chats), msg_rng.choice(topics),
+                    msg_rng.randrange(1, 5000), make_text(msg_rng, holder["vocabulary"])
+                )
+                for i in range(count)
+            ]
+
+        async def op(messages, i):
+            await main.check_spam(messages[i])
+
+        results[f"check_spam_{backend}_{chats}c_{words_per_topic}w"] = measure(setup, op, count, memory)
+
+
+def bench_storage(results, sizes, backend, count, memory):
+    for size in sizes:
+        rng = random.Random(4)
+        chats = max(1, size // 1000)
+
+        def setup():
+            storage = fresh_storage(backend, 1000)
+            for i in range(size):
+                storage.cache_message(i, -1000 - i % chats, None, rng.randrange(1, 500), make_text(rng))
+            storage.flush()
+            return storage
+
+        results[f"cache_message_{backend}_{size}"] = measure(
+            setup,
+            lambda s, i: s.cache_message(size + i, -1000 - i % chats, None, 7, "benchmark message"),
+            count, memory
+        )
+
+        loop = asyncio.new_event_loop()
+        # cache_message выше только ставит запись в очередь; здесь — запись на диск:
+        # FLUSH_BATCH сообщений и синхронный flush (дозапись журнала или транзакция SQLite)
+        def flush_batch(s, i):
+            for j in range(FLUSH_BATCH):
+                s.cache_message(size + i * FLUSH_BATCH + j, -1000 - j % chats, None, 7, "benchmark message")
+            s.flush()
+
+        results[f"cache_flush_{backend}_{size}x{FLUSH_BATCH}"] = measure(
+            setup, flush_batch, max(10, count // FLUSH_BATCH), memory
+        )
+
+        results[f"get_user_messages_{backend}_{size}"] = measure(
+            setup,
+            lambda s, i: loop.run_until_complete(s.get_user_messages(-1000 - i % chats, 1 + i % 499)),
+            min(count, 2000), memory
+        )
+        loop.close()
+
+        results[f"get_rules_{backend}_{size}"] = measure(
+            setup, lambda s, i: s.get_rules(-1000 - i % chats, None), count, False
+        )
+
+        results[f"clear_old_cache_{backend}_{size}"] = measure(
+            setup, lambda s, i: (s.clear_old_cache(), s.flush()), 3, memory
+        )
+
+
+# --- СРАВНЕНИЕ ---
+def compare(current, baseline, tolerance):
+    """Печатает изменения пропускной способности; возвращает список регрессий"""
+    regressions = []
+    print(f"\n{'бенчмарк':50} {'было':>12} {'стало':>12} {'изм.':>8}")
+    for name, result in current["results"].items():
+        old = baseline.get("results", {}).get(name)
+        if not old or not old.get("ops_per_sec"):
+            continue
+        change = result["ops_per_sec"] / old["ops_per_sec"] - 1
+        mark = ""
+        if change < -tolerance:
+            mark = "  ⚠️ регрессия"
+            regressions.append(name)
+        print(f"{name:50} {old['ops_per_sec']:>12} {result['ops_per_sec']:>12} {change:>+7.1%}{mark}")
+    return regressions
+
+
+def main_cli():
+    parser = argparse.ArgumentParser(description="Бенчмарки ProfsoyuzAntiSpam Bot")
+    parser.add_argument("--quick", action="store_true", help="уменьшенные размеры для быстрой проверки")
+    parser.add_argument("--backend", choices=("json", "sqlite"), default="json")
+    parser.add_argument("--only", choices=("matcher", "check_spam", "storage"), action="append")
+    parser.add_argument("--no-memory", action="store_true", help="не замерять пиковую память")
+    parser.add_argument("--save", help="сохранить результаты в JSON-файл")
+    parser.add_argument("--compare", help="сравнить с ранее сохранёнными результатами")
+    parser.add_argument("--tolerance", type=float, default=0.2, help="допустимое падение ops/sec (0.2 = 20%%)")
+    args = parser.parse_args()
+
+    # Логи форматируются как в бою, но пишутся в никуда — чтобы не мерить скорость терминала
+    root = logging.getLogger()
+    root.handlers = [logging.StreamHandler(open(os.devnull, "w", encoding="utf-8"))]
+
+    memory = not args.no_memory
+    only = set(args.only or ("matcher", "check_spam", "storage"))
+    if args.quick:
+        count, matcher_sizes = 1000, (1, 100, 1000)
+        spam_grid = ((10, 10), (100, 100))
+        storage_sizes = (1000, 10000)
+    else:
+        count, matcher_sizes = 5000, (1, 10, 100, 1000, 5000)
+        spam_grid = ((10, 1), (10, 100), (10, 1000), (10, 5000), (1000, 100), (10000, 10))
+        storage_sizes = (1000, 10000, 100000)
+
+    results = {}
+    if "matcher" in only:
+        bench_matcher(results, matcher_sizes, count, memory)
+    if "check_spam" in only:
+        bench_check_spam(results, spam_grid, args.backend, count, memory)
+    if "storage" in only:
+        bench_storage(results, storage_sizes, args.backend, count, memory)
+
+    print(f"{'бенчмарк':50} {'ops/s':>12} {'p50 мкс':>10} {'p99 мкс':>10} {'пик КиБ':>10}")
+    for name, r in results.items():
+        print(f"{name:50} {r['ops_per_sec']:>12} {r['p50_us']:>10} {r['p99_us']:>10} {r.get('peak_kib', '-'):>10}")
+
+    report = {
+        "meta": {
+            "timestamp": datetime.now().isoformat(timespec="seconds"),
+            "python": platform.python_version(),
+            "platform": platform.platform(),
+            "backend": args.backend,
+            "quick": args.quick,
+        },
+        "results": results,
+    }
+    if args.save:
+        with open(os.path.join(ROOT, args.save) if not os.path.isabs(args.save) else args.save, "w", encoding="utf-8") as f:
+            json.dump(report, f, ensure_ascii=False, indent=2)
+    if args.compare:
+        path = os.path.join(ROOT, args.compare) if not os.path.isabs(args.compare) else args.compare
+        with open(path, "r", encoding="utf-8") as f:
+            baseline = json.load(f)
+        if compare(report, baseline, args.tolerance):
+            sys.exit(1)
+
+
+if __name__ == "__main__":
+    main_cli()
@@ -0,0 +1,242 @@
+# --- ПРОВЕРКА СООБЩЕНИЙ В ПУЛЕ ПРОЦЕССОВ ---
+# Тяжёлые проверки (большие наборы шаблонов, оценка моделью) не должны занимать
+# цикл событий. ClassificationStage копит сообщения в небольшие пакеты и отдаёт их
+# в ProcessPoolExecutor. Снимок правил передаётся процессам не с каждым пакетом,
+# а через файл: пакет несёт только номер версии, процесс перечитывает снимок,
+# когда версия выросла. Если ответа нет за timeout, сообщение пропускается (fail open).
+import asyncio
+import logging
+import multiprocessing
+import os
+import pickle
+import shutil
+import tempfile
+from collections import deque
+from concurrent.futures import ProcessPoolExecutor
+from concurrent.futures.process import BrokenProcessPool
+from matcher import MatcherCache
+from storage import effective_rules
+from metrics import CLASSIFY_BATCH_SECONDS, CLASSIFY_FAIL_OPEN_TOTAL, timed
+
+
+class RuleChecker:
+    """
+    Стоп-слова и шаблоны. snapshot — ({ключ правил: [правила]}, {чаты с наследованием правил}),
+    key — (chat_id, topic_id); автоматы строятся в процессе пула при первой проверке ключа.
+    """
+
+    name = "rules"
+
+    def __init__(self, snapshot):
+        self.rules, self.inherit = snapshot or ({}, set())
+        self.matchers = MatcherCache()
+
+    def check(self, key, text):
+        chat_id, topic_id = key
+        matcher = self.matchers.get(
+            key, lambda: effective_rules(self.rules, chat_id, topic_id, chat_id in self.inherit)
+        )
+        return matcher.find(text) if matcher else None
+
+
+# --- Состояние процесса пула ---
+_version = -1
+_checkers = []
+
+
+def _init_worker(path):
+    """Запуск процесса пула: свой вывод логов и загрузка снимка до прихода первых сообщений"""
+    # Поток, который пишет логи из очереди, при fork не копируется: в процессе пула пишем в stderr сами
+    handler = logging.StreamHandler()
+    handler.setFormatter(logging.Formatter("%(asctime)s - [пул проверки] %(message)s"))
+    logging.getLogger().handlers = [handler]
+    _load_snapshot(path)
+
+
+def _load_snapshot(path):
+    global _version, _checkers
+    with open(path, "rb") as f:
+        version, entries = pickle.load(f)
+    if version > _version:
+        _checkers = [checker_cls(snapshot) for checker_cls, snapshot in entries]
+        _version = version
+
+
+def _classify_batch(version, path, items):
+    """items — [(ключ правил, текст)]; результат — сработавшее правило или None для каждого"""
+    if version > _version:
+        _load_snapshot(path)
+    results = []
+    for key, text in items:
+        verdict = None
+        for checker in _checkers:
+            verdict = checker.check(key, text)
+            if verdict is not None:
+                break
+        results.append(verdict)
+    return results
+
+
+class _Item:
+    __slots__ = ("key", "text", "future")
+
+    def __init__(self, key, text, future):
+        self.key = key
+        self.text = text
+        self.future = future
+
+
+class ClassificationStage:
+    """
+    Пул из workers процессов. Проверки подключаются через register(checker_cls, source):
+    checker_cls(snapshot).check(key, text) выполняется в процессе пула,
+    source() в цикле событий возвращает свежий снимок данных для него.
+    После изменения данных вызывается invalidate(): снимок пересоберётся перед следующим пакетом.
+    """
+
+    def __init__(self, workers=2, batch_size=32, batch_window=0.002, timeout=0.5, max_in_flight=None,
+                 max_pending=None):
+        self.workers = workers
+        self.batch_size = batch_size
+        self.batch_window = batch_window
+        self.timeout = timeout
+        # Пакетов в работе одновременно; остальные сообщения ждут в очереди не дольше timeout
+        self.max_in_flight = max_in_flight or workers * 2
+        # Очередь длиннее — пул не успевает: новые сообщения пропускаются без проверки сразу
+        self.max_pending = max_pending or batch_size * self.max_in_flight * 4
+        self._checkers = []
+        self._pool = None
+        self._dir = None
+        self._path = None
+        self._version = 0
+        self._stale = True
+        self._pending = deque()
+        self._flush_handle = None
+        self._in_flight = 0
+
+    def register(self, checker_cls, source):
+        self._checkers.append((checker_cls, source))
+        self._stale = True
+
+    def invalidate(self):
+        self._stale = True
+
+    def _write_snapshot(self):
+        """Атомарная запись снимка (в цикле событий: правила меняются редко)"""
+        self._version += 1
+        entries = [(checker_cls, source()) for checker_cls, source in self._checkers]
+        tmp_path = self._path + ".tmp"
+        with open(tmp_path, "wb") as f:
+            pickle.dump((self._version, entries), f, protocol=pickle.HIGHEST_PROTOCOL)
+        os.replace(tmp_path, self._path)
+        self._stale = False
+
+    def _create_pool(self):
+        # fork: процессу пула не нужно заново импортировать main.py (при spawn он открыл бы хранилище)
+        methods = multiprocessing.get_all_start_methods()
+        context = multiprocessing.get_context("fork" if "fork" in methods else None)
+        self._pool = ProcessPoolExecutor(
+            max_workers=self.workers, mp_context=context,
+            initializer=_init_worker, initargs=(self._path,)
+        )
+
+    async def start(self):
+        """Создаёт пул и запускает все процессы сразу, чтобы первое сообщение не ждало их старта"""
+        self._dir = tempfile.mkdtemp(prefix="antispam-classify-")
+        self._path = os.path.join(self._dir, "snapshot.pickle")
+        self._write_snapshot()
+        self._create_pool()
+        await self._warm_up()
+
+    async def _warm_up(self):
+        # Первая задача запускает процессы (при fork — сразу все), initializer загружает снимок
+        await asyncio.get_running_loop().run_in_executor(self._pool, os.getpid)
+        logging.info(f"🧠 Пул проверки сообщений запущен: {self.workers} процессов")
+
+    async def classify(self, key, text):
+        """Результат проверки (сработавшее правило) или None — в том числе при таймауте или перегрузке"""
+        if self._pool is None:
+            return None
+        if len(self._pending) >= self.max_pending:
+            CLASSIFY_FAIL_OPEN_TOTAL.inc(labels=("overload",))
+            return None
+        loop = asyncio.get_running_loop()
+        future = loop.create_future()
+        self._pending.append(_Item(key, text, future))
+        if len(self._pending) >= self.batch_size:
+            self._flush()
+        elif self._flush_handle is None:
+            self._flush_handle = loop.call_later(self.batch_window, self._flush)
+        try:
+            return await asyncio.wait_for(asyncio.shield(future), self.timeout)
+        except asyncio.TimeoutError:
+            CLASSIFY_FAIL_OPEN_TOTAL.inc(labels=("timeout",))
+            return None
+
+    def _flush(self):
+        """Отправляет в пул пакеты, пока есть свободные места; остальное ждёт завершения пакетов"""
+        if self._flush_handle is not None:
+            self._flush_handle.cancel()
+            self._flush_handle = None
+        while self._pending and self._in_flight < self.max_in_flight:
+            batch = []
+            while self._pending and len(batch) < self.batch_size:
+                item = self._pending.popleft()
+                # Ожидавший уже сдался по таймауту — проверять незачем
+                if not item.future.done():
+                    batch.append(item)
+            if not batch:
+                continue
+            if self._stale:
+                self._write_snapshot()
+            self._in_flight += 1
+            asyncio.get_running_loop().create_task(self._run_batch(batch))
+
+    async def _run_batch(self, batch):
+        loop = asyncio.get_running_loop()
+        pool = self._pool
+        try:
+            with timed(CLASSIFY_BATCH_SECONDS):
+                results = await loop.run_in_executor(
+                    pool, _classify_batch, self._version, self._path,
+                    [(item.key, item.text) for item in batch]
+                )
+        except BrokenProcessPool:
+            results = [None] * len(batch)
+            CLASSIFY_FAIL_OPEN_TOTAL.inc(len(batch), ("error",))
+            self._restart_pool(pool)
+        except Exception as e:
+            results = [None] * len(batch)
+            CLASSIFY_FAIL_OPEN_TOTAL.inc(len(batch), ("error",))
+            logging.error(f"❌ Ошибка проверки пакета: {type(e).__name__}: {e}")
+        finally:
+            self._in_flight -= 1
+        for item, result in zip(batch, results):
+            # Ожидавший мог уже сдаться по таймауту — результат тогда не нужен
+            if not item.future.done():
+                item.future.set_result(result)
+        if self._pending:
+            self._flush()
+
+    def _restart_pool(self, broken):
+        if self._pool is not broken:
+            return  # пул уже пересоздан другим пакетом или закрыт
+        logging.error("❌ Процесс пула проверки упал, пул пересоздаётся")
+        broken.shutdown(wait=False, cancel_futures=True)
+        self._create_pool()
+        asyncio.get_running_loop().create_task(self._warm_up())
+
+    async def close(self):
+        if self._flush_handle is not None:
+            self._flush_handle.cancel()
+            self._flush_handle = None
+        for item in self._pending:
+            if not item.future.done():
+                item.future.set_result(None)
+        self._pending.clear()
+        if self._pool is not None:
+            pool, self._pool = self._pool, None
+            await asyncio.get_running_loop().run_in_executor(None, pool.shutdown)
+        if self._dir is not None:
+            shutil.rmtree(self._dir, ignore_errors=True)
+            self._dir = None
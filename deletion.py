@@ -0,0 +1,234 @@
+# --- ПАКЕТНОЕ УДАЛЕНИЕ СООБЩЕНИЙ ---
+import asyncio
+import logging
+from aiogram.exceptions import TelegramAPIError, TelegramBadRequest, TelegramForbiddenError
+from metrics import DELETE_FAILURES_TOTAL, DELETIONS_TOTAL
+
+# deleteMessages принимает не больше 100 id за вызов
+DELETE_BATCH_LIMIT = 100
+
+
+class DeletionReport:
+    """Итог удаления: удалено, уже не существовало, нет прав на удаление, прочие ошибки"""
+
+    __slots__ = ("deleted", "gone", "forbidden", "failed")
+
+    def __init__(self):
+        self.deleted = 0
+        self.gone = 0
+        self.forbidden = 0
+        self.failed = 0
+
+    @property
+    def total(self):
+        return self.deleted + self.gone + self.forbidden + self.failed
+
+    def count_metrics(self):
+        """Добавляет итоги в счётчики метрик"""
+        for result in self.__slots__:
+            value = getattr(self, result)
+            if value:
+                DELETIONS_TOTAL.inc(value, (result,))
+
+    def merge(self, other):
+        self.deleted += other.deleted
+        self.gone += other.gone
+        self.forbidden += other.forbidden
+        self.failed += other.failed
+
+
+def is_message_gone(error):
+    """Сообщение уже удалено (кем-то ещё) или никогда не существовало"""
+    return isinstance(error, TelegramBadRequest) and "not found" in str(error).lower()
+
+
+def chunked(items, size):
+    return [items[i:i + size] for i in range(0, len(items), size)]
+
+
+# Лимиты частоты и повтор после flood wait обеспечивает ApiScheduler на сессии бота
+
+async def delete_one(bot, chat_id, message_id, report):
+    """Удаляет одно сообщение и записывает результат в отчёт"""
+    try:
+        await bot.delete_message(chat_id=chat_id, message_id=message_id)
+        report.deleted += 1
+    except TelegramForbiddenError as e:
+        report.forbidden += 1
+        DELETE_FAILURES_TOTAL.inc(labels=(type(e).__name__,))
+        logging.error(f"❌ Не удалил {message_id}: {e}")
+    except TelegramBadRequest as e:
+        if is_message_gone(e):
+            report.gone += 1
+        else:
+            # "message can't be deleted" — слишком старое сообщение или нет прав
+            report.forbidden += 1
+            DELETE_FAILURES_TOTAL.inc(labels=(type(e).__name__,))
+            logging.error(f"❌ Не удалил {message_id}: {e}")
+    except TelegramAPIError as e:
+        report.failed += 1
+        DELETE_FAILURES_TOTAL.inc(labels=(type(e).__name__,))
+        logging.error(f"❌ Не удалил {message_id}: {e}")
+
+
+async def delete_batch(bot, chat_id, message_ids):
+    """
+    Удаляет до 100 сообщений одним вызовом deleteMessages.
+    Если пакетный вызов отклонён, сообщения удаляются по одному,
+    чтобы разделить удалённые, уже исчезнувшие и недоступные.
+    Пакетный вызов молча пропускает ненайденные сообщения,
+    поэтому при его успехе все id считаются удалёнными.
+    """
+    report = DeletionReport()
+    try:
+        await bot.delete_messages(chat_id=chat_id, message_ids=message_ids)
+        report.deleted += len(message_ids)
+        report.count_metrics()
+        return report
+    except TelegramAPIError as e:
+        logging.warning(f"⚠️ Пакетное удаление не удалось ({e}), удаляю по одному")
+    for message_id in message_ids:
+        await delete_one(bot, chat_id, message_id, report)
+    report.count_metrics()
+    return report
+
+
+async def delete_messages(bot, chat_id, message_ids, concurrency=3,
+                          batch_size=DELETE_BATCH_LIMIT, on_progress=None):
+    """
+    Удаляет сообщения чата пакетами по batch_size, до concurrency пакетов одновременно.
+    on_progress(done, total) вызывается после каждого пакета.
+    """
+    report = DeletionReport()
+    total = len(message_ids)
+    semaphore = asyncio.Semaphore(concurrency)
+
+    async def run(batch):
+        async with semaphore:
+            batch_report = await delete_batch(bot, chat_id, batch)
+        report.merge(batch_report)
+        if on_progress is not None:
+            await on_progress(report.total, total)
+
+    await asyncio.gather(*(run(batch) for batch in chunked(list(message_ids), min(batch_size, DELETE_BATCH_LIMIT))))
+    return report
+
+
+class _Reasons:
+    """Причины удаления для строки лога: текст собирается, только если строка пишется"""
+
+    __slots__ = ("reasons",)
+
+    def __init__(self, reasons):
+        self.reasons = reasons
+
+    def __str__(self):
+        return f" ({', '.join(sorted(self.reasons))})" if self.reasons else ""
+
+
+class DeletionQueue:
+    """
+    Очередь удаления спама: check_spam только ставит (chat_id, message_id, причина),
+    а пул воркеров разбирает очередь и склеивает id одного чата в пакетные удаления.
+    Очередь ограничена: когда она заполнена, put() ждёт (обратное давление),
+    а счётчик переполнений и глубина очереди попадают в лог.
+    Строка на каждый пакет идёт в events (EventLog, событие "deleted") с его выборкой,
+    без events — на уровне DEBUG; итоги раз в stats_interval секунд пишутся всегда.
+    """
+
+    def __init__(self, bot, maxsize=10000, workers=4, batch_window=0.05, stats_interval=60, events=None):
+        self.bot = bot
+        self.events = events
+        self.workers = workers
+        self.batch_window = batch_window
+        self.stats_interval = stats_interval
+        self._queue = asyncio.Queue(maxsize=maxsize)
+        self._tasks = []
+        self.report = DeletionReport()
+        self.enqueued = 0
+        self.full_events = 0
+        self.max_depth = 0
+
+    @property
+    def depth(self):
+        return self._queue.qsize()
+
+    async def put(self, chat_id, message_id, reason=""):
+        item = (chat_id, message_id, reason)
+        try:
+            self._queue.put_nowait(item)
+        except asyncio.QueueFull:
+            self.full_events += 1
+            if self.full_events == 1 or self.full_events % 100 == 0:
+                logging.warning(
+                    f"🚧 Очередь удаления заполнена ({self.depth}), переполнений: {self.full_events}"
+                )
+            await self._queue.put(item)
+        self.enqueued += 1
+        self.max_depth = max(self.max_depth, self.depth)
+
+    def start(self):
+        for _ in range(self.workers):
+            self._tasks.append(asyncio.create_task(self._worker()))
+        if self.stats_interval:
+            self._tasks.append(asyncio.create_task(self._log_stats()))
+
+    async def close(self, timeout=5.0):
+        """Даёт воркерам дочистить очередь (не дольше timeout) и останавливает их"""
+        try:
+            await asyncio.wait_for(self._queue.join(), timeout=timeout)
+        except asyncio.TimeoutError:
+            logging.warning(f"⚠️ Очередь удаления не дочищена: осталось {self.depth}")
+        for task in self._tasks:
+            task.cancel()
+        self._tasks.clear()
+
+    async def _collect(self):
+        """Ждёт первый элемент, затем короткое окно добирает всё, что успело прийти"""
+        items = [await self._queue.get()]
+        if self.batch_window:
+            await asyncio.sleep(self.batch_window)
+        while True:
+            try:
+                items.append(self._queue.get_nowait())
+            except asyncio.QueueEmpty:
+                return items
+
+    async def _worker(self):
+        while True:
+            items = await self._collect()
+            try:
+                by_chat = {}
+                for chat_id, message_id, reason in items:
+                    ids, reasons = by_chat.setdefault(chat_id, ([], set()))
+                    ids.append(message_id)
+                    if reason:
+                        reasons.add(reason)
+                for chat_id, (ids, reasons) in by_chat.items():
+                    for batch in chunked(ids, DELETE_BATCH_LIMIT):
+                        report = await delete_batch(self.bot, chat_id, batch)
+                        self.report.merge(report)
+                        args = (report.deleted, len(batch), chat_id, _Reasons(reasons))
+                        if self.events is not None:
+                            self.events.log("deleted", "✅ Удалено %s/%s в чате %s%s", *args)
+                        else:
+                            logging.debug("✅ Удалено %s/%s в чате %s%s", *args)
+            except Exception as e:
+                DELETE_FAILURES_TOTAL.inc(labels=(type(e).__name__,))
+                logging.error(f"❌ ОШИБКА УДАЛЕНИЯ: {type(e).__name__}: {e}")
+            finally:
+                for _ in items:
+                    self._queue.task_done()
+
+    async def _log_stats(self):
+        while True:
+            await asyncio.sleep(self.stats_interval)
+            if not self.enqueued and not self.depth:
+                continue
+            logging.info(
+                f"🗑 Очередь удаления: глубина {self.depth} (макс {self.max_depth}), "
+                f"поставлено {self.enqueued}, удалено {self.report.deleted}, "
+                f"уже удалены {self.report.gone}, нет прав {self.report.forbidden}, "
+                f"ошибки {self.report.failed}, переполнений {self.full_events}"
+            )
+            self.max_depth = self.depth
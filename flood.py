@@ -0,0 +1,71 @@
+# --- ФЛУД: СЛИШКОМ ЧАСТЫЕ СООБЩЕНИЯ ОДНОГО ПОЛЬЗОВАТЕЛЯ ---
+# GCRA (generic cell rate algorithm): для каждой пары (чат, пользователь) хранится одно
+# число — теоретическое время прихода следующего сообщения (TAT). Лимит "count сообщений
+# за period секунд" означает: каждое сообщение сдвигает TAT на period / count, а
+# сообщение отклоняется, если TAT ушло вперёд больше чем на period минус этот шаг.
+# Это скользящее окно без хранения времени каждого сообщения: проверка за O(1).
+import time
+from collections import OrderedDict
+
+# Результаты check()
+FLOOD_STARTED = "started"    # лимит превышен только что — удалить недавние сообщения пользователя
+FLOOD_CONTINUES = "continues"  # пользователь всё ещё выше лимита — удалить это сообщение
+# Допуск при сравнении TAT: шаг period / count часто не представим точно (10 / 3), и без
+# допуска последнее разрешённое сообщение пачки отклонялось бы из-за ошибки округления
+_EPSILON = 1e-9
+
+
+class _State:
+    __slots__ = ("tat", "flooding")
+
+    def __init__(self, tat):
+        self.tat = tat
+        self.flooding = False
+
+
+class FloodLimiter:
+    """
+    Состояния пользователей лежат в OrderedDict в порядке последнего сообщения (запись
+    переставляется в конец при каждом сообщении). Когда TAT в прошлом, состояние
+    ничем не отличается от нового, поэтому expire() снимает такие записи с головы
+    и память зависит только от числа пользователей, писавших недавно.
+    """
+
+    def __init__(self):
+        self._states = OrderedDict()
+
+    def check(self, chat_id, user_id, count, period, now=None):
+        """None — сообщение в пределах лимита, иначе FLOOD_STARTED или FLOOD_CONTINUES"""
+        now = time.monotonic() if now is None else now
+        interval = period / count
+        key = (chat_id, user_id)
+        state = self._states.get(key)
+        if state is None:
+            state = self._states[key] = _State(now)
+        else:
+            self._states.move_to_end(key)
+        tat = max(state.tat, now)
+        if tat - now > period - interval + _EPSILON:
+            # Отклонённое сообщение лимит не расходует: после паузы пользователь снова может писать
+            if state.flooding:
+                return FLOOD_CONTINUES
+            state.flooding = True
+            return FLOOD_STARTED
+        state.tat = tat + interval
+        state.flooding = False
+        return None
+
+    def expire(self, now=None):
+        """Забывает пользователей, у которых лимит полностью восстановился; возвращает их число"""
+        now = time.monotonic() if now is None else now
+        states = self._states
+        removed = 0
+        # Голова — давно не писавшие; первая запись с TAT в будущем останавливает проход.
+        # Записи за ней снимутся при следующих вызовах, когда голова устареет.
+        while states and next(iter(states.values())).tat <= now:
+            states.popitem(last=False)
+            removed += 1
+        return removed
+
+    def __len__(self):
+        return len(self._states)
@@ -0,0 +1,114 @@
+# --- ЛОГИРОВАНИЕ: ФОНОВЫЙ ПОТОК И ВЫБОРОЧНЫЕ СОБЫТИЯ ---
+import atexit
+import logging
+import queue
+from logging.handlers import QueueHandler, QueueListener
+from metrics import LOG_DROPPED_TOTAL, LOG_SUPPRESSED_TOTAL
+from ratelimit import TokenBucket
+
+# Подробность логов горячего пути:
+#   quiet   — события сообщений не пишутся
+#   sampled — каждое every-е событие и не чаще rate в секунду
+#   full    — каждое событие
+VERBOSITY_MODES = ("quiet", "sampled", "full")
+
+_listener = None
+
+
+class _QueueHandler(QueueHandler):
+    """
+    Кладёт запись в очередь как есть: подстановка аргументов и форматирование
+    выполняются в потоке слушателя, а не в цикле событий.
+    Если очередь переполнена (вывод не успевает), запись отбрасывается.
+    """
+
+    def prepare(self, record):
+        return record
+
+    def enqueue(self, record):
+        try:
+            self.queue.put_nowait(record)
+        except queue.Full:
+            LOG_DROPPED_TOTAL.inc()
+
+
+def setup_logging(level=logging.INFO, fmt="%(asctime)s - %(message)s", queue_size=10000):
+    """
+    Замена logging.basicConfig: корневой логгер только ставит записи в очередь,
+    а в stderr их пишет отдельный поток. Очередь дописывается при выходе из процесса.
+    """
+    global _listener
+    handler = logging.StreamHandler()
+    handler.setFormatter(logging.Formatter(fmt))
+    log_queue = queue.Queue(maxsize=queue_size)
+    root = logging.getLogger()
+    root.handlers = [_QueueHandler(log_queue)]
+    root.setLevel(level)
+    _listener = QueueListener(log_queue, handler, respect_handler_level=True)
+    _listener.start()
+    atexit.register(stop_logging)
+
+
+def stop_logging():
+    """Дописывает оставшиеся записи и останавливает поток вывода"""
+    global _listener
+    if _listener is not None:
+        _listener.stop()
+        _listener = None
+
+
+class _EventPolicy:
+    __slots__ = ("every", "bucket", "seen", "skipped")
+
+    def __init__(self, every, rate):
+        self.every = max(1, every)
+        self.bucket = TokenBucket(rate) if rate else None
+        self.seen = 0
+        self.skipped = 0
+
+
+class EventLog:
+    """
+    Логи событий, которые случаются на каждое сообщение группы.
+    Текст строки собирается только для событий, прошедших выборку;
+    число пропущенных дописывается к следующей записи того же события.
+    """
+
+    def __init__(self, mode="sampled", logger=None):
+        self.logger = logger or logging.getLogger()
+        self._policies = {}
+        self.mode = None
+        self.set_mode(mode)
+
+    def configure(self, event, every=1, rate=None):
+        """every — писать каждое every-е событие, rate — не чаще rate записей в секунду"""
+        self._policies[event] = _EventPolicy(every, rate)
+
+    def set_mode(self, mode):
+        if mode not in VERBOSITY_MODES:
+            raise ValueError(f"неизвестный режим логов: {mode}")
+        self.mode = mode
+        # aiogram пишет строку на каждый апдейт — она нужна только в полном режиме
+        logging.getLogger("aiogram.event").setLevel(logging.INFO if mode == "full" else logging.WARNING)
+
+    def skipped(self):
+        """Сколько событий каждого типа пропущено с момента последней записи"""
+        return {event: policy.skipped for event, policy in self._policies.items()}
+
+    def log(self, event, msg, *args):
+        if self.mode == "quiet":
+            return
+        policy = self._policies.get(event)
+        if policy is not None and self.mode == "sampled":
+            policy.seen += 1
+            if policy.seen % policy.every or (policy.bucket is not None and policy.bucket.delay() > 0):
+                policy.skipped += 1
+                LOG_SUPPRESSED_TOTAL.inc(labels=(event,))
+                return
+            if policy.bucket is not None:
+                policy.bucket.take()
+            if policy.skipped:
+                msg += " (пропущено похожих: %d)"
+                args += (policy.skipped,)
+                policy.skipped = 0
+        self.logger.info(msg, *args)
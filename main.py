@@ -1,52 +1,220 @@
 import asyncio
+import html
 import logging
-import json
 import os
+import secrets
+import time
+import zlib
 from aiogram import Bot, Dispatcher, types, F
+from aiogram.exceptions import TelegramAPIError, TelegramBadRequest
 from aiogram.filters import Command
-from aiogram.types import Message, InlineKeyboardButton, InlineKeyboardMarkup
+from aiogram.types import BufferedInputFile, Message, InlineKeyboardButton, InlineKeyboardMarkup
 from aiogram.utils.keyboard import InlineKeyboardBuilder
 from dotenv import load_dotenv
-from datetime import datetime
+from log_pipeline import VERBOSITY_MODES, EventLog, setup_logging
+from api_scheduler import PRIORITY_CLEAN, ApiScheduler, api_priority
+from classify import ClassificationStage, RuleChecker
+from deletion import DeletionQueue, delete_messages
+from flood import FLOOD_STARTED, FloodLimiter
+from matcher import RULE_EXCLUDE_PREFIX, MatcherCache, RuleError, check_rule, is_exclusion_rule, is_pattern_rule
+from metrics import (
+    API_QUEUE_DEPTH, CACHE_MESSAGES, CHECK_SPAM_SECONDS, DELETION_QUEUE_DEPTH, FLOOD_MESSAGES_TOTAL, MATCHES_TOTAL,
+    MESSAGES_TOTAL, RAID_MESSAGES_TOTAL, RULE_KEYS, RULE_WORDS, SCORER_FLAGGED_TOTAL, start_metrics_server,
+    timed,
+)
+from raid import RaidDetector
+from rules_io import EXPORT_FORMATS, IMPORT_MAX_BYTES, RulesFileError, check_rules, export_rules, parse_rules_file
+from scorer import SCORER_AVAILABLE, SCORER_MODES, ScoreBatcher, SpamScorer
+from sharding import RULES_LIST_SUFFIX, fetch_rules_lists, run_front, shard_data
+from storage import (
+    CACHE_FILE, DATA_FILE, SQLITE_FILE, get_rules_key, open_storage, parse_rules_key, shard_path,
+)
+from webhook import run_webhook
 
 # --- КОНФИГУРАЦИЯ ---
 load_dotenv()
 BOT_TOKEN = os.getenv("BOT_TOKEN", "").strip()
 ADMIN_ID = 417850992  # Ваш ID
+# Движок хранилища: "json" (data.json + cache.jsonl) или "sqlite" (data.db).
+# При первом запуске sqlite данные из data.json переносятся автоматически.
+STORAGE_BACKEND = os.getenv("STORAGE_BACKEND", "json").strip().lower()
+# Запись на диск: раз в FLUSH_INTERVAL секунд или после FLUSH_EVERY изменений
+FLUSH_INTERVAL = float(os.getenv("FLUSH_INTERVAL", "5"))
+FLUSH_EVERY = int(os.getenv("FLUSH_EVERY", "100"))
+# Журнал кэша сообщений переписывается, когда вырастает больше этого размера (байт)
+CACHE_COMPACT_BYTES = int(os.getenv("CACHE_COMPACT_BYTES", "1000000"))
+# Сколько последних сообщений кэшировать для /clean в каждом чате
+CACHE_CAPACITY_PER_CHAT = int(os.getenv("CACHE_CAPACITY_PER_CHAT", "1000"))
+# Сколько часов хранить сообщения для /clean; устаревшие снимаются каждые
+# CACHE_SWEEP_INTERVAL секунд порциями по CACHE_SWEEP_BATCH
+CACHE_RETENTION_HOURS = float(os.getenv("CACHE_RETENTION_HOURS", "48"))
+CACHE_SWEEP_INTERVAL = float(os.getenv("CACHE_SWEEP_INTERVAL", "60"))
+CACHE_SWEEP_BATCH = int(os.getenv("CACHE_SWEEP_BATCH", "1000"))
+# /undo: сколько последних изменений каждой темы помнить и сколько часов (0 — без ограничения)
+HISTORY_DEPTH = int(os.getenv("HISTORY_DEPTH", "50"))
+HISTORY_MAX_AGE_HOURS = float(os.getenv("HISTORY_MAX_AGE_HOURS", "0"))
+# /clean: до CLEAN_CONCURRENCY вызовов deleteMessages одновременно
+CLEAN_CONCURRENCY = int(os.getenv("CLEAN_CONCURRENCY", "3"))
+# Лимиты исходящих запросов к API: всего и на один чат (запросов в секунду)
+API_GLOBAL_RATE = float(os.getenv("API_GLOBAL_RATE", "30"))
+API_CHAT_RATE = float(os.getenv("API_CHAT_RATE", "1"))
+API_CHAT_BURST = float(os.getenv("API_CHAT_BURST", "20"))
+# Очередь удаления спама: размер, число воркеров и окно склейки в пакет (секунды)
+DELETE_QUEUE_SIZE = int(os.getenv("DELETE_QUEUE_SIZE", "10000"))
+DELETE_WORKERS = int(os.getenv("DELETE_WORKERS", "4"))
+DELETE_BATCH_WINDOW = float(os.getenv("DELETE_BATCH_WINDOW", "0.05"))
+# Получение апдейтов: "polling" (по умолчанию) или "webhook" (встроенный HTTP-сервер).
+# Без WEBHOOK_URL setWebhook не вызывается — сервер можно проверять локально POST-запросами.
+UPDATE_MODE = os.getenv("UPDATE_MODE", "polling").strip().lower()
+WEBHOOK_URL = os.getenv("WEBHOOK_URL", "").strip()
+WEBHOOK_HOST = os.getenv("WEBHOOK_HOST", "0.0.0.0")
+WEBHOOK_PORT = int(os.getenv("WEBHOOK_PORT", "8080"))
+WEBHOOK_PATH = os.getenv("WEBHOOK_PATH", "/webhook")
+WEBHOOK_SECRET = os.getenv("WEBHOOK_SECRET", "").strip()
+# Сколько апдейтов обрабатывается одновременно в режиме webhook
+WEBHOOK_MAX_CONCURRENCY = int(os.getenv("WEBHOOK_MAX_CONCURRENCY", "100"))
+# Метрики в формате Prometheus на http://METRICS_HOST:METRICS_PORT/metrics (0 — выключены)
+METRICS_PORT = int(os.getenv("METRICS_PORT", "0"))
+METRICS_HOST = os.getenv("METRICS_HOST", "127.0.0.1")
+# Логи на каждое сообщение группы: quiet / sampled / full (меняется командой /verbose).
+# В режиме sampled пишется каждое LOG_SAMPLE_EVERY-е событие и не больше LOG_EVENT_RATE в секунду.
+LOG_VERBOSITY = os.getenv("LOG_VERBOSITY", "sampled").strip().lower()
+LOG_SAMPLE_EVERY = int(os.getenv("LOG_SAMPLE_EVERY", "100"))
+LOG_EVENT_RATE = float(os.getenv("LOG_EVENT_RATE", "5"))
+# Найденные стоп-слова пишутся все, но не больше LOG_MATCH_RATE в секунду
+LOG_MATCH_RATE = float(os.getenv("LOG_MATCH_RATE", "20"))
+LOG_QUEUE_SIZE = int(os.getenv("LOG_QUEUE_SIZE", "10000"))
+# Проверка сообщений в пуле из CLASSIFY_WORKERS процессов (0 — прямо в цикле событий).
+# Сообщения идут пакетами до CLASSIFY_BATCH_SIZE, пакет ждёт не дольше CLASSIFY_BATCH_WINDOW секунд;
+# если ответа нет за CLASSIFY_TIMEOUT секунд, сообщение пропускается без удаления.
+CLASSIFY_WORKERS = int(os.getenv("CLASSIFY_WORKERS", "0"))
+CLASSIFY_BATCH_SIZE = int(os.getenv("CLASSIFY_BATCH_SIZE", "32"))
+CLASSIFY_BATCH_WINDOW = float(os.getenv("CLASSIFY_BATCH_WINDOW", "0.002"))
+CLASSIFY_TIMEOUT = float(os.getenv("CLASSIFY_TIMEOUT", "0.5"))
+# Оценка сообщений моделью (нужен numpy). Режим и порог чата задаются командой /score;
+# по умолчанию модель выключена, порог — SCORER_THRESHOLD (вероятность спама).
+SCORER_THRESHOLD = float(os.getenv("SCORER_THRESHOLD", "0.95"))
+# Модель применяется, когда в обучении есть хотя бы SCORER_MIN_SAMPLES примеров каждого класса
+SCORER_MIN_SAMPLES = int(os.getenv("SCORER_MIN_SAMPLES", "50"))
+# Обучение раз в SCORER_TRAIN_INTERVAL секунд: сообщения кэша, совпавшие со стоп-словами, — спам,
+# остальные, пролежавшие SCORER_HAM_DELAY секунд и не удалённые, — не спам
+SCORER_TRAIN_INTERVAL = float(os.getenv("SCORER_TRAIN_INTERVAL", "300"))
+SCORER_HAM_DELAY = float(os.getenv("SCORER_HAM_DELAY", "600"))
+SCORER_MODEL_FILE = os.getenv("SCORER_MODEL_FILE", "model.npz")
+# Рейды: похожие сообщения (доля общих шинглов не ниже RAID_SIMILARITY) от RAID_MIN_USERS разных
+# пользователей за RAID_WINDOW секунд удаляются все (0 — выключено). Тексты короче RAID_MIN_LENGTH
+# символов не учитываются, в окне чата хранится не больше RAID_MAX_PER_CHAT сообщений.
+RAID_MIN_USERS = int(os.getenv("RAID_MIN_USERS", "0"))
+RAID_WINDOW = float(os.getenv("RAID_WINDOW", "300"))
+RAID_SIMILARITY = float(os.getenv("RAID_SIMILARITY", "0.8"))
+RAID_MIN_LENGTH = int(os.getenv("RAID_MIN_LENGTH", "30"))
+RAID_MAX_PER_CHAT = int(os.getenv("RAID_MAX_PER_CHAT", "500"))
+# Флуд: больше FLOOD_MESSAGES сообщений за FLOOD_SECONDS секунд от одного пользователя
+# (0 — выключено). Лимит чата меняется командой /flood. При превышении удаляются его
+# сообщения за последние FLOOD_SECONDS секунд и все следующие, пока он не сбавит темп.
+FLOOD_MESSAGES = int(os.getenv("FLOOD_MESSAGES", "0"))
+FLOOD_SECONDS = float(os.getenv("FLOOD_SECONDS", "10"))
+# Администраторы чата под лимит флуда не попадают; их список обновляется раз в FLOOD_ADMINS_TTL секунд
+FLOOD_ADMINS_TTL = float(os.getenv("FLOOD_ADMINS_TTL", "600"))
+# Несколько процессов: при SHARD_COUNT > 1 фронт-процесс получает апдейты и раздаёт их
+# SHARD_COUNT процессам-шардам по chat_id (шард i слушает 127.0.0.1:SHARD_BASE_PORT + i,
+# хранит данные в data.shard<i>.json / data.shard<i>.db). SHARD_INDEX выставляет фронт.
+SHARD_COUNT = max(1, int(os.getenv("SHARD_COUNT", "1")))
+SHARD_INDEX = int(os.environ["SHARD_INDEX"]) if os.getenv("SHARD_INDEX") else None
+SHARD_BASE_PORT = int(os.getenv("SHARD_BASE_PORT", "8100"))
+SHARD_QUEUE_SIZE = int(os.getenv("SHARD_QUEUE_SIZE", "10000"))
+SHARD_FRONT = SHARD_COUNT > 1 and SHARD_INDEX is None
 
-# Настройка логирования
-logging.basicConfig(level=logging.INFO, format='%(asctime)s - %(message)s')
+# Настройка логирования: запись в stderr идёт в отдельном потоке
+setup_logging(
+    level=logging.INFO,
+    fmt='%(asctime)s - ' + (f'[шард {SHARD_INDEX}] ' if SHARD_INDEX is not None else '') + '%(message)s',
+    queue_size=LOG_QUEUE_SIZE
+)
+events = EventLog(LOG_VERBOSITY if LOG_VERBOSITY in VERBOSITY_MODES else "sampled")
+for event in ("received", "no_text", "no_rules"):
+    events.configure(event, every=LOG_SAMPLE_EVERY, rate=LOG_EVENT_RATE)
+events.configure("match", rate=LOG_MATCH_RATE)
+events.configure("score", rate=LOG_MATCH_RATE)
+events.configure("raid", rate=LOG_MATCH_RATE)
+events.configure("flood", rate=LOG_MATCH_RATE)
+events.configure("deleted", rate=LOG_MATCH_RATE)
 bot = Bot(token=BOT_TOKEN)
 dp = Dispatcher()
+# Все исходящие запросы идут через общий планировщик с лимитами и приоритетами
+# Общий лимит бота делится между шардами; лимит на чат — нет, чат живёт в одном шарде
+api_scheduler = ApiScheduler(global_rate=API_GLOBAL_RATE / (SHARD_COUNT if SHARD_INDEX is not None else 1), chat_rate=API_CHAT_RATE, chat_burst=API_CHAT_BURST)
+bot.session.middleware(api_scheduler)
+# check_spam только ставит спам в очередь, удаляют воркеры пакетами
+deletion_queue = DeletionQueue(
+    bot, maxsize=DELETE_QUEUE_SIZE, workers=DELETE_WORKERS, batch_window=DELETE_BATCH_WINDOW, events=events
+)
 
-# --- JSON ХРАНИЛИЩЕ (вместо SQLite) ---
-DATA_FILE = "data.json"
+# --- ХРАНИЛИЩЕ (запись на диск в фоне) ---
+# Фронт-процесс хранилище не открывает: правила и кэш живут в процессах-шардах
+storage = None if SHARD_FRONT else open_storage(
+    STORAGE_BACKEND,
+    data_path=DATA_FILE,
+    cache_path=CACHE_FILE,
+    sqlite_path=SQLITE_FILE,
+    compact_bytes=CACHE_COMPACT_BYTES,
+    cache_capacity=CACHE_CAPACITY_PER_CHAT,
+    cache_max_age=CACHE_RETENTION_HOURS * 3600,
+    history_depth=HISTORY_DEPTH,
+    history_max_age=HISTORY_MAX_AGE_HOURS * 3600 or None,
+    flush_interval=FLUSH_INTERVAL,
+    flush_every=FLUSH_EVERY,
+    shard=None if SHARD_INDEX is None else (SHARD_INDEX, SHARD_COUNT),
+)
+# Скомпилированные автоматы стоп-слов; сбрасываются при изменении правил ключа
+matchers = MatcherCache()
+# Пул процессов для проверки сообщений получает снимок правил после их изменения
+classifier = None
+if CLASSIFY_WORKERS > 0 and not SHARD_FRONT:
+    classifier = ClassificationStage(
+        workers=CLASSIFY_WORKERS,
+        batch_size=CLASSIFY_BATCH_SIZE,
+        batch_window=CLASSIFY_BATCH_WINDOW,
+        timeout=CLASSIFY_TIMEOUT,
+    )
+    classifier.register(RuleChecker, lambda: (storage.rules, storage.inheriting_chats()))
 
-def load_data():
-    """Загружает данные из JSON файла"""
-    if os.path.exists(DATA_FILE):
-        try:
-            with open(DATA_FILE, "r", encoding="utf-8") as f:
-                return json.load(f)
-        except Exception as e:
-            logging.error(f"Ошибка загрузки данных: {e}")
-    return {"rules": {}, "history": [], "cache": []}
+# Подписи последних сообщений чатов для поиска рейдов (только в памяти)
+raids = None
+if RAID_MIN_USERS > 0 and not SHARD_FRONT:
+    raids = RaidDetector(
+        min_users=RAID_MIN_USERS,
+        window=RAID_WINDOW,
+        similarity=RAID_SIMILARITY,
+        max_per_chat=RAID_MAX_PER_CHAT,
+        min_length=RAID_MIN_LENGTH,
+    )
 
-def save_data(data):
-    """Сохраняет данные в JSON файл"""
-    try:
-        with open(DATA_FILE, "w", encoding="utf-8") as f:
-            json.dump(data, f, ensure_ascii=False, indent=2)
-    except Exception as e:
-        logging.error(f"Ошибка сохранения: {e}")
+# Счётчики частоты сообщений по (чат, пользователь); состояние молчащих снимается при очистке кэша
+flood = FloodLimiter()
 
-def get_rules_key(chat_id, topic_id):
-    """
-    Генерирует ключ для правил.
-    topic_id может быть None (для всей группы/"веб-ветки _1") или числом (для настоящих тем).
-    """
-    # Используем "global" для None, чтобы избежать проблем с ключами
-    return f"{chat_id}_{topic_id}" if topic_id is not None else f"{chat_id}_global"
+# --- МОДЕЛЬ ОЦЕНКИ СПАМА ---
+scorer = None
+score_batcher = None
+scorer_model_path = SCORER_MODEL_FILE if SHARD_INDEX is None else shard_path(SCORER_MODEL_FILE, SHARD_INDEX)
+if SCORER_AVAILABLE and not SHARD_FRONT:
+    scorer = SpamScorer(min_samples=SCORER_MIN_SAMPLES)
+    if scorer.load(scorer_model_path):
+        logging.info(f"🧠 Модель загружена: спам {scorer.docs[1]}, не спам {scorer.docs[0]}")
+    score_batcher = ScoreBatcher(scorer)
+# Сообщения, удалённые по оценке модели, как рейд или за флуд: (chat_id, message_id) -> время.
+# Они не попадают в обучение ни как спам (модель не учится на своих решениях), ни как не спам.
+model_deleted = {}
+
+def rules_changed(chat_id, topic_id):
+    """Сбрасывает скомпилированные правила ключа и снимок правил пула проверки"""
+    if topic_id is None and storage.get_setting(chat_id, "inherit_rules", False):
+        # Правила всей группы входят в правила каждой темы чата
+        matchers.invalidate_group(chat_id)
+    else:
+        matchers.invalidate(get_rules_key(chat_id, topic_id))
+    if classifier is not None:
+        classifier.invalidate()
 
 def get_rules(chat_id, topic_id=None):
     """
@@ -54,9 +222,23 @@ def get_rules(chat_id, topic_id=None):
     topic_id = None соответствует "веб-ветке _1" или всей основной группе.
     topic_id = число соответствует настоящей теме (topic).
     """
-    data = load_data()
-    key = get_rules_key(chat_id, topic_id)
-    return data["rules"].get(key, [])
+    return storage.get_rules(chat_id, topic_id)
+
+def get_matcher(chat_id, topic_id=None):
+    """
+    Возвращает скомпилированный автомат стоп-слов для чата/темы (с унаследованными правилами).
+    Ключи группируются по чату: изменение правил всей группы сбрасывает автоматы всех тем.
+    """
+    return matchers.get(
+        get_rules_key(chat_id, topic_id), lambda: storage.get_effective_rules(chat_id, topic_id), group=chat_id
+    )
+
+def set_inherit_rules(chat_id, enabled):
+    """Включает или выключает наследование правил всей группы в темах чата"""
+    storage.set_setting(chat_id, "inherit_rules", True if enabled else None)
+    matchers.invalidate_group(chat_id)
+    if classifier is not None:
+        classifier.invalidate()
 
 def add_rule(chat_id, topic_id, word):
     """
@@ -64,24 +246,8 @@ def add_rule(chat_id, topic_id, word):
     topic_id = None используется для "веб-ветки _1" и всей основной группы.
     topic_id = число используется для настоящих тем (topics).
     """
-    data = load_data()
-    key = get_rules_key(chat_id, topic_id)
-    
-    if key not in data["rules"]:
-        data["rules"][key] = []
-    
-    if word not in data["rules"][key]:
-        # Сохраняем историю для отката
-        data["history"].append({
-            "chat_id": chat_id,
-            "topic_id": topic_id,
-            "action": "add",
-            "word": word,
-            "old_words": data["rules"][key].copy(),
-            "timestamp": datetime.now().isoformat()
-        })
-        data["rules"][key].append(word)
-        save_data(data)
+    if storage.add_rule(chat_id, topic_id, word):
+        rules_changed(chat_id, topic_id)
         return True
     return False
 
@@ -91,122 +257,54 @@ def del_rule(chat_id, topic_id, word):
     topic_id = None используется для "веб-ветки _1" и всей основной группы.
     topic_id = число используется для настоящих тем (topics).
     """
-    data = load_data()
-    key = get_rules_key(chat_id, topic_id)
-    
-    if key in data["rules"] and word in data["rules"][key]:
-        # Сохраняем историю для отката
-        data["history"].append({
-            "chat_id": chat_id,
-            "topic_id": topic_id,
-            "action": "del",
-            "word": word,
-            "old_words": data["rules"][key].copy(),
-            "timestamp": datetime.now().isoformat()
-        })
-        data["rules"][key].remove(word)
-        save_data(data)
+    if storage.del_rule(chat_id, topic_id, word):
+        rules_changed(chat_id, topic_id)
         return True
     return False
 
-def undo_last_change(chat_id, topic_id):
+def import_rules(chat_id, topic_id, words):
+    """
+    Добавляет список правил одним изменением (одна запись отката, одна пересборка автомата).
+    Возвращает добавленные (без тех, что уже были в списке).
     """
-    Откатывает последнее изменение.
+    added = storage.import_rules(chat_id, topic_id, words)
+    if added:
+        rules_changed(chat_id, topic_id)
+    return added
+
+def undo_last_change(chat_id, topic_id, steps=1):
+    """
+    Откатывает до steps последних изменений; возвращает число откаченных.
     topic_id = None используется для "веб-ветки _1" и всей основной группы.
     topic_id = число используется для настоящих тем (topics).
     """
-    data = load_data()
-    # Ищем последнее изменение для этого чата/топика
-    for i in range(len(data["history"]) - 1, -1, -1):
-        h = data["history"][i]
-        if h["chat_id"] == chat_id and h["topic_id"] == topic_id:
-            # Восстанавливаем
-            key = get_rules_key(chat_id, topic_id)
-            data["rules"][key] = h["old_words"]
-            # Удаляем запись истории
-            data["history"].pop(i)
-            save_data(data)
-            return True
-    return False
+    undone = storage.undo_last_change(chat_id, topic_id, steps)
+    if undone:
+        rules_changed(chat_id, topic_id)
+    return undone
 
 def cache_message(message_id, chat_id, topic_id, user_id, text):
     """Кэширует сообщение"""
-    data = load_data()
-    # Добавляем в кэш
-    data["cache"].append({
-        "message_id": message_id,
-        "chat_id": chat_id,
-        "topic_id": topic_id,
-        "user_id": user_id,
-        "text": text,
-        "timestamp": datetime.now().isoformat()
-    })
-    # Храним только последние 1000 сообщений
-    if len(data["cache"]) > 1000:
-        data["cache"] = data["cache"][-1000:]
-    save_data(data)
-
-def get_user_messages(chat_id, user_id, topic_id=None):
-    """Получает сообщения пользователя"""
-    data = load_data()
-    messages = []
-    for msg in data["cache"]:
-        if msg["chat_id"] == chat_id and msg["user_id"] == user_id:
-            if topic_id is None or msg["topic_id"] == topic_id:
-                messages.append(msg["message_id"])
-    return messages
+    storage.cache_message(message_id, chat_id, topic_id, user_id, text)
+
+async def get_user_messages(chat_id, user_id, topic_id=None, since=None):
+    """Получает сообщения пользователя (since — не старше этого времени Unix)"""
+    return await storage.get_user_messages(chat_id, user_id, topic_id, since)
 
 def clear_user_cache(chat_id, user_id, topic_id=None):
     """Очищает кэш пользователя"""
-    data = load_data()
-    data["cache"] = [
-        msg for msg in data["cache"]
-        if not (msg["chat_id"] == chat_id and 
-                msg["user_id"] == user_id and 
-                (topic_id is None or msg["topic_id"] == topic_id))
-    ]
-    save_data(data)
-
-def clear_old_cache():
-    """Очищает старый кэш (старше 48 часов)"""
-    data = load_data()
-    cutoff = datetime.now().timestamp() - (48 * 3600)  # 48 часов
-    data["cache"] = [
-        msg for msg in data["cache"]
-        if datetime.fromisoformat(msg["timestamp"]).timestamp() > cutoff
-    ]
-    save_data(data)
-
-def get_all_rules_summary():
-    """Возвращает все правила для отображения"""
-    data = load_data()
-    result = []
-    for key, words in data["rules"].items():
-        parts = key.rsplit("_", 1)
-        chat_id = int(parts[0])
-        # Проверяем, является ли последняя часть числом (topic_id) или "global"
-        if parts[1] == "global":
-            topic_id = None
-        else:
-            topic_id = int(parts[1])
-        result.append((chat_id, topic_id, words))
-    # Сортируем: сначала по chat_id, потом None (вся группа) идут первыми, затем по topic_id
-    return sorted(result, key=lambda x: (x[0], x[1] is not None, x[1] or 0))
+    storage.clear_user_cache(chat_id, user_id, topic_id)
+
+def clear_old_cache(limit=None):
+    """Очищает старый кэш (старше CACHE_RETENTION_HOURS); возвращает число удалённых, если оно известно"""
+    return storage.clear_old_cache(limit=limit)
 
 def get_all_topics_for_chat(chat_id):
     """
     Возвращает все настоящие темы (не включая "веб-ветку _1" или всю группу) для чата.
     Используется в интерфейсе для отображения списка тем.
     """
-    data = load_data()
-    result = []
-    for key, words in data["rules"].items():
-        parts = key.rsplit("_", 1)
-        stored_chat_id = int(parts[0])
-        if stored_chat_id == chat_id and parts[1] != "global":
-            topic_id = int(parts[1])
-            result.append((topic_id, words))
-    return sorted(result, key=lambda x: x[0])
+    return storage.topics_for_chat(chat_id)
 
 # --- ВСПОМОГАТЕЛЬНЫЕ ФУНКЦИИ ---
 def get_chat_type_name(topic_id):
@@ -218,15 +316,19 @@ def get_chat_type_emoji(topic_id):
 def get_chat_type_prefix(topic_id):
     return "Тема #" if topic_id is not None else "Вся группа / Веб-ветка _1"
 
+def shard_callback(data):
+    """callback_data кнопок со списком правил: в режиме шардов нажатие вернётся в этот же шард"""
+    return data if SHARD_INDEX is None else shard_data(data, SHARD_INDEX)
+
 def create_navigation_keyboard(current_chat_id=None):
     """Создает клавиатуру навигации"""
     builder = InlineKeyboardBuilder()
     
     # Кнопки для навигации
     if current_chat_id:
-        builder.button(text="◀️ Назад к списку чатов", callback_data="all_chats")
+        builder.button(text="◀️ Назад к списку чатов", callback_data=shard_callback("all_chats"))
     else:
-        builder.button(text="🔄 Обновить", callback_data="refresh")
+        builder.button(text="🔄 Обновить", callback_data=shard_callback("refresh"))
     
     builder.adjust(1)
     return builder.as_markup()
@@ -262,16 +364,20 @@ async def cmd_start(message: Message):
             "• Удаление сообщений по стоп-словам\n"
             "• Поддержка групп и <u>настоящих тем (форумов)</u>\n"
             "• Также работает с \"веб-веткой _1\" (где <code>message_thread_id = None</code>)\n"
-            "• Учитывает регистр при проверке слов\n"
+            "• Не обманывается регистром, похожими буквами (a/а, o/о) и невидимыми символами\n"
             "• Удобное управление через команды\n"
+            "• Удаление рейдов: одинаковых сообщений от многих пользователей (если включено)\n"
             "• Быстрая очистка сообщений\n\n"
             "📌 <b>Доступные команды:</b>\n\n"
             "➕ <b>/add &lt;chat_id&gt; &lt;topic_id&gt; &lt;слово&gt;</b>\n"
             "   Добавляет стоп-слово в правила\n"
             "   Пример: /add -1001234567890 0 казино\n"
-            "   Пример (тема): /add -1001234567890 123 /dick\n\n"
+            "   Пример (тема): /add -1001234567890 123 /dick\n"
+            "   Шаблоны: <code>re:регулярка</code> или <code>glob:каз*но</code>\n\n"
             "   <b>ВАЖНО:</b> <code>topic_id = 0</code> используется для \"веб-ветки _1\" и всей основной группы.\n"
-            "   Правила, добавленные для <code>topic_id = 0</code>, <u>работают ТОЛЬКО</u> в \"веб-ветке _1\" и НЕ действуют в других темах!\n\n"
+            "   Правила, добавленные для <code>topic_id = 0</code>, работают в \"веб-ветке _1\" и в другие темы "
+            "<u>не переходят</u>, пока для чата не включено наследование (/inherit). Тогда они действуют во всех темах, "
+            "а тема может отменить правило исключением <code>not:слово</code>\n\n"
             "➖ <b>/del &lt;chat_id&gt; &lt;topic_id&gt; &lt;слово&gt;</b>\n"
             "   Удаляет стоп-слово из правил\n"
             "   Пример: /del -1001234567890 123 /dick\n\n"
@@ -280,19 +386,31 @@ async def cmd_start(message: Message):
             "   Пример: /rules -1001234567890 123\n\n"
             "📊 <b>/all</b>\n"
             "   Показывает все правила во всех чатах\n\n"
-            "↩️ <b>/undo &lt;chat_id&gt; &lt;topic_id&gt;</b>\n"
-            "   Откатывает последнее изменение правил\n"
-            "   Пример: /undo -1001234567890 123\n\n"
+            "↩️ <b>/undo &lt;chat_id&gt; &lt;topic_id&gt; [n]</b>\n"
+            "   Откатывает последнее изменение правил (или n последних)\n"
+            "   Пример: /undo -1001234567890 123 3\n\n"
             "🗑 <b>/clean &lt;chat_id&gt; &lt;topic_id&gt; &lt;user_id&gt;</b>\n"
             "   Удаляет все сообщения пользователя из кэша\n"
             "   Пример: /clean -1001234567890 0 1264548383\n\n"
             "ℹ️ <b>/info</b>\n"
             "   Показывает как узнать ID чата или темы\n\n"
+            "📥 <b>/import &lt;chat_id&gt; &lt;topic_id&gt;</b> (подпись к файлу)\n"
+            "   Добавляет правила из файла .txt, .csv или .json одним изменением\n\n"
+            "📤 <b>/export &lt;chat_id&gt; &lt;topic_id&gt; [txt|json|csv]</b>\n"
+            "   Присылает правила файлом\n\n"
+            "🔗 <b>/inherit &lt;chat_id&gt; [on|off]</b>\n"
+            "   Правила всей группы действуют во всех темах\n\n"
+            "🧠 <b>/score &lt;chat_id&gt; [off|shadow|on] [порог]</b>\n"
+            "   Оценка сообщений моделью, обученной на удалённом спаме\n\n"
+            "🌊 <b>/flood &lt;chat_id&gt; [&lt;сообщений&gt; &lt;секунд&gt;|off|default]</b>\n"
+            "   Лимит частоты сообщений одного пользователя\n\n"
+            "🔊 <b>/verbose [quiet|sampled|full]</b>\n"
+            "   Подробность логов по каждому сообщению\n\n"
             "💡 <b>Совет:</b>\n"
             "• Используйте <code>0</code> вместо <code>topic_id</code>, чтобы применить правило к \"веб-ветке _1\" или всей группе\n"
             "• <code>topic_id</code> — это <u>числовой ID настоящей темы</u> (форума)\n"
-            "• Бот учитывает регистр при проверке слов\n"
-            "• Бот удаляет только сообщения за последние 48 часов"
+            "• Регистр, похожие латинские/кириллические буквы и невидимые символы не мешают поиску\n"
+            f"• Бот удаляет только сообщения за последние {CACHE_RETENTION_HOURS:g} ч"
         )
         
         await message.answer(
@@ -306,6 +424,166 @@ async def cmd_start(message: Message):
             "Обратитесь к администратору для получения доступа."
         )
 
+# --- СПИСОК ВСЕХ ПРАВИЛ (/all): СТРАНИЦЫ И КЭШ ОТРИСОВКИ ---
+# Строки каждого чата отрисовываются один раз и хранятся, пока не изменится версия правил
+# чата; разбивка на страницы пересобирается из готовых строк, когда растёт общая версия.
+# Запас до лимита Telegram (4096 символов) — на заголовок и номер страницы
+RULES_PAGE_LIMIT = 3500
+# В списке показываются первые RULES_PAGE_WORDS правил темы, длинные правила обрезаются
+RULES_PAGE_WORDS = 20
+RULES_PAGE_WORD_LENGTH = 100
+# Счётчики версий правил живут в памяти и после перезапуска начинаются заново: эпоха процесса
+# отличает версию до перезапуска от той же по номеру версии после него
+RULES_RENDER_EPOCH = secrets.token_hex(4)
+# {chat_id: (версия правил чата, строки)}
+rendered_chats = {}
+# (версия списка, страницы)
+rendered_pages = (None, [])
+
+def rules_render_version():
+    """Версия списка всех правил для кэша страниц и кнопки обновления: "<эпоха>.<версия>" """
+    return f"{RULES_RENDER_EPOCH}.{storage.rules_version}"
+
+def render_chat_lines(chat_id):
+    """Строки чата для списка всех правил (из кэша, если правила чата не менялись)"""
+    version = storage.chat_rules_versions.get(chat_id, 0)
+    cached = rendered_chats.get(chat_id)
+    if cached is not None and cached[0] == version:
+        return cached[1]
+    lines = []
+    for topic_id, words in storage.chat_rules_summary(chat_id):
+        topic_name = get_chat_type_prefix(topic_id) + ("" if topic_id is None else f" #{topic_id}")
+        lines.append(f"  📌 <b>{topic_name}:</b> {len(words)} стоп-слов")
+        for i, word in enumerate(words[:RULES_PAGE_WORDS], 1):
+            if len(word) > RULES_PAGE_WORD_LENGTH:
+                word = word[:RULES_PAGE_WORD_LENGTH] + "…"
+            lines.append(f"     {i}. <code>{html.escape(word)}</code>")
+        if len(words) > RULES_PAGE_WORDS:
+            lines.append(f"     • ... и ещё {len(words) - RULES_PAGE_WORDS} стоп-слов")
+        lines.append("")
+    rendered_chats[chat_id] = (version, lines)
+    return lines
+
+def local_rules_chats():
+    """[(chat_id, строки)] чатов с правилами в этом процессе, по возрастанию id"""
+    return [(chat_id, render_chat_lines(chat_id)) for chat_id in storage.rules_chats()]
+
+def rules_list_answer(query):
+    """Ответ шарда на запрос сводного /all (GET <WEBHOOK_PATH>/rules): без строк, если версия та же"""
+    version = rules_render_version()
+    if query.get("version") == version:
+        return {"version": version}
+    return {"version": version, "chats": local_rules_chats()}
+
+# Списки правил других шардов для сводного /all: {номер шарда: (версия, [(chat_id, строки)])}
+shard_rules = {}
+
+async def collect_shard_rules():
+    """
+    Версия и чаты с правилами всех шардов. /all приходит только в первый шард, он собирает
+    списки остальных (каждый отдаёт строки, только если его версия изменилась).
+    Возвращает (версия, [(chat_id, строки)], номера шардов без ответа).
+    """
+    others = [index for index in range(SHARD_COUNT) if index != SHARD_INDEX]
+    known = {index: shard_rules[index][0] for index in others if index in shard_rules}
+    answers = await fetch_rules_lists(others, SHARD_BASE_PORT, WEBHOOK_PATH, WEBHOOK_SECRET, known)
+    versions = [rules_render_version()]
+    chats = local_rules_chats()
+    missing = []
+    for index in others:
+        answer = answers[index]
+        if answer is not None and "chats" in answer:
+            shard_rules[index] = (answer["version"], [(chat_id, lines) for chat_id, lines in answer["chats"]])
+        elif answer is None or index not in shard_rules:
+            shard_rules.pop(index, None)
+            missing.append(index)
+            versions.append("-")
+            continue
+        versions.append(shard_rules[index][0])
+        chats.extend(shard_rules[index][1])
+    chats.sort(key=lambda chat: chat[0])
+    # Версия для callback_data: короткая сумма версий всех шардов
+    return f"{zlib.crc32('|'.join(versions).encode()):08x}", chats, missing
+
+def build_rules_pages(chats):
+    """Страницы списка всех правил; чат, не поместившийся на страницу, продолжается на следующей"""
+    pages = []
+    page = []
+    size = 0
+    for chat_id, lines in chats:
+        header = f"━━━━━━━━━━━━━━━━━━━━\n🆔 <b>Группа:</b> <code>{chat_id}</code>"
+        # Заголовок чата не остаётся последней строкой страницы
+        if page and size + len(header) + len(lines[0] if lines else "") + 2 > RULES_PAGE_LIMIT:
+            pages.append("\n".join(page))
+            page = []
+            size = 0
+        page.append(header)
+        size += len(header) + 1
+        for line in lines:
+            if size + len(line) + 1 > RULES_PAGE_LIMIT:
+                pages.append("\n".join(page))
+                page = [header + " (продолжение)"]
+                size = len(page[0]) + 1
+            page.append(line)
+            size += len(line) + 1
+    if page:
+        pages.append("\n".join(page))
+    return pages
+
+async def get_rules_pages():
+    """(версия, страницы) списка всех правил; страницы пересобираются, только когда меняется версия"""
+    global rendered_pages
+    if SHARD_INDEX is None:
+        version = rules_render_version()
+        if rendered_pages[0] != version:
+            rendered_pages = (version, build_rules_pages(local_rules_chats()))
+        return rendered_pages
+    version, chats, missing = await collect_shard_rules()
+    if rendered_pages[0] != version:
+        pages = build_rules_pages(chats)
+        if missing:
+            notice = "⚠️ Нет ответа от шардов: " + ", ".join(str(index + 1) for index in missing) + "\n\n"
+            pages = [notice + page for page in pages] or [notice]
+        rendered_pages = (version, pages)
+    return rendered_pages
+
+def render_rules_page(version, pages, page):
+    """Текст и клавиатура страницы page (номер приводится к допустимому)"""
+    if not pages:
+        keyboard = InlineKeyboardBuilder()
+        keyboard.button(text="🔄 Обновить", callback_data=shard_callback(f"allrefresh_0_{version}"))
+        return (
+            "ostringstream <b>Нет настроенных правил</b>\n\n"
+            "Вы можете добавить правила с помощью команды /add",
+            keyboard.as_markup()
+        )
+    page = max(0, min(page, len(pages) - 1))
+    text = "📊 <b>Все правила во всех чатах</b>\n\n" + pages[page]
+    keyboard = InlineKeyboardBuilder()
+    navigation = 0
+    if len(pages) > 1:
+        text += f"\n📄 Страница {page + 1} из {len(pages)}"
+        if page > 0:
+            keyboard.button(text="◀️ Назад", callback_data=shard_callback(f"allpage_{page - 1}"))
+            navigation += 1
+        if page < len(pages) - 1:
+            keyboard.button(text="Вперёд ▶️", callback_data=shard_callback(f"allpage_{page + 1}"))
+            navigation += 1
+    keyboard.button(text="🔄 Обновить", callback_data=shard_callback(f"allrefresh_{page}_{version}"))
+    keyboard.adjust(*((navigation, 1) if navigation else (1,)))
+    return text, keyboard.as_markup()
+
+async def show_rules_page(callback, page, rules_pages=None):
+    version, pages = rules_pages or await get_rules_pages()
+    text, keyboard = render_rules_page(version, pages, page)
+    try:
+        await callback.message.edit_text(text, parse_mode="HTML", reply_markup=keyboard)
+    except TelegramBadRequest as e:
+        # На экране уже эта же страница
+        if "not modified" not in str(e).lower():
+            raise
+    await callback.answer()
+
 # --- КОЛЛБЭКИ ДЛЯ ИНЛЕНЙ КНОПОК ---
 @dp.callback_query(F.data == "view_rules")
 async def callback_view_rules(callback: types.CallbackQuery):
@@ -332,7 +610,8 @@ async def callback_add_rule(callback: types.CallbackQuery):
         "/add -1001234567890 0 казино — для всей группы / веб-ветки _1\n"
         "/add -1001234567890 123 /dick — для темы 123\n\n"
         "💡 Используйте <code>0</code> для всей группы / веб-ветки _1 или числовой ID темы.\n"
-        "💡 Правила для <code>topic_id = 0</code> работают ТОЛЬКО в \"веб-ветке _1\" и НЕ действуют в других темах!",
+        "💡 Правила для <code>topic_id = 0</code> действуют в других темах, только если включён /inherit "
+        "(отменить правило в теме: <code>not:слово</code>).",
         parse_mode="HTML",
         reply_markup=create_navigation_keyboard(None)
     )
@@ -366,7 +645,9 @@ async def callback_help(callback: types.CallbackQuery):
         "• Например: /add -1001234567890 0 казино\n"
         "• Или (для темы): /add -1001234567890 123 /dick\n"
         "• <b>ВАЖНО:</b> <code>topic_id = 0</code> используется для \"веб-ветки _1\" и всей основной группы.\n"
-        "• Правила, добавленные для <code>topic_id = 0</code>, <u>работают ТОЛЬКО</u> в \"веб-ветке _1\" и НЕ действуют в других темах!\n\n"
+        "• Правила, добавленные для <code>topic_id = 0</code>, работают в \"веб-ветке _1\" и в другие темы "
+        "<u>не переходят</u>, пока для чата не включено наследование (/inherit). Тогда они действуют во всех темах, "
+        "а тема может отменить правило исключением <code>not:слово</code>\n\n"
         
         "<b>3. Просмотр правил</b>\n"
         "• /rules <code>&lt;chat_id&gt;</code> — все правила для чата\n"
@@ -381,9 +662,10 @@ async def callback_help(callback: types.CallbackQuery):
         "💡 <b>Совет:</b>\n"
         "• Используйте <code>0</code> вместо <code>topic_id</code>, чтобы применить правило к \"веб-ветке _1\" или всей группе\n"
         "• <code>topic_id</code> — это <u>числовой ID настоящей темы</u> (форума)\n"
-        "• Бот учитывает регистр при проверке слов\n"
-        "• Правила для <code>topic_id = 0</code> работают ТОЛЬКО в \"веб-ветке _1\" и НЕ действуют в других темах!\n"
-        "• Бот удаляет только сообщения за последние 48 часов"
+        "• Регистр, похожие латинские/кириллические буквы и невидимые символы не мешают поиску\n"
+        "• Правила для <code>topic_id = 0</code> действуют в других темах, только если включён /inherit "
+        "(исключение в теме: <code>not:слово</code>)\n"
+        f"• Бот удаляет только сообщения за последние {CACHE_RETENTION_HOURS:g} ч"
     )
     
     await callback.message.edit_text(
@@ -393,59 +675,24 @@ async def callback_help(callback: types.CallbackQuery):
     )
     await callback.answer()
 
-@dp.callback_query(F.data == "all_chats")
+@dp.callback_query(F.data.in_({"all_chats", "refresh"}))
 async def callback_all_chats(callback: types.CallbackQuery):
-    rules = get_all_rules_summary()
-    
-    if not rules:
-        await callback.message.edit_text(
-            "ostringstream <b>Нет настроенных правил</b>\n\n"
-            "Вы можете добавить правила с помощью команды /add",
-            parse_mode="HTML",
-            reply_markup=create_navigation_keyboard(None)
-        )
-        await callback.answer()
-        return
-    
-    text = "📊 <b>Все правила во всех чатах</b>\n\n"
-    current_chat = None
-    
-    for chat_id, topic_id, words in rules:
-        if chat_id != current_chat:
-            current_chat = chat_id
-            text += f"━━━━━━━━━━━━━━━━━━━━\n"
-            text += f"🆔 <b>Группа:</b> <code>{chat_id}</code>\n"
-        
-        topic_name = get_chat_type_prefix(topic_id) + ("" if topic_id is None else f" #{topic_id}")
-        text += f"  📌 <b>{topic_name}:</b> {len(words)} стоп-слов\n"
-        
-        if words:
-            # Показываем все слова (максимум 20, чтобы не перегружать)
-            for i, word in enumerate(words[:20], 1):
-                text += f"     {i}. <code>{word}</code>\n"
-            if len(words) > 20:
-                text += f"     • ... и ещё {len(words) - 20} стоп-слов\n"
-        
-        text += "\n"
-    
-    await callback.message.edit_text(
-        text,
-        parse_mode="HTML",
-        reply_markup=create_navigation_keyboard(None)
-    )
-    await callback.answer()
+    await show_rules_page(callback, 0)
+
+@dp.callback_query(F.data.startswith("allpage_"))
+async def callback_rules_page(callback: types.CallbackQuery):
+    await show_rules_page(callback, int(callback.data.split("_")[1]))
 
-@dp.callback_query(F.data == "refresh")
+@dp.callback_query(F.data.startswith("allrefresh_"))
 async def callback_refresh(callback: types.CallbackQuery):
-    await callback.message.edit_text(
-        "🔄 <b>Обновление данных...</b>",
-        parse_mode="HTML"
-    )
-    
-    # Небольшая задержка для имитации загрузки
-    await asyncio.sleep(0.5)
-    
-    await callback_all_chats(callback)
+    # allrefresh_<страница>_<версия списка, с которой страница показана>
+    _, page, version = callback.data.split("_")
+    rules_pages = await get_rules_pages()
+    if version == rules_pages[0]:
+        # Правила не менялись — страница на экране актуальна, редактировать нечего
+        await callback.answer("✅ Список не изменился")
+        return
+    await show_rules_page(callback, int(page), rules_pages)
 
 # --- ОСНОВНЫЕ КОМАНДЫ ---
 
@@ -463,10 +710,7 @@ async def cmd_info(message: Message):
         
         chat_name = fwd.chat.title or "Чат"
         
-        # ДОБАВЛЯЕМ ДЕТАЛЬНОЕ ЛОГИРОВАНИЕ
-        logging.info(f"ℹ️ Получен запрос info для чата: {chat_id}, тема: {topic_id}")
-        logging.info(f"ℹ️ Тип объекта: {type(fwd)}")
-        logging.info(f"ℹ️ Доступные атрибуты: {dir(fwd)}")
+        logging.info("ℹ️ Получен запрос info для чата: %s, тема: %s", chat_id, topic_id)
         
         text = (
             "🔍 <b>Информация о чате/теме</b>\n\n"
@@ -501,7 +745,8 @@ async def cmd_info(message: Message):
             "• <u>Topic ID</u> — это <b>числовой идентификатор настоящей темы (форума)</b> в Telegram API.\n"
             "• Если <b>Topic ID: 0</b>, это может быть <b>веб-ветка _1</b> или <b>вся основная группа</b>.\n"
             "• Используйте <b>ID 0</b> в командах для настройки правил для \"веб-ветки _1\".\n"
-            "• Правила, добавленные для <code>topic_id = 0</code>, НЕ действуют в других темах!\n"
+            "• Правила, добавленные для <code>topic_id = 0</code>, действуют в других темах, только если включён /inherit "
+            "(исключение в теме: <code>not:слово</code>)\n"
             "• Пример правильной команды:\n"
             f"<code>/add {chat_id} 0 /dick</code>",
             parse_mode="HTML"
@@ -521,43 +766,9 @@ async def cmd_all(message: Message):
     if not await is_admin_in_pm(message):
         return
     
-    rules = get_all_rules_summary()
-    
-    if not rules:
-        await message.answer(
-            "ostringstream <b>Нет настроенных правил</b>\n\n"
-            "Вы можете добавить правила с помощью команды /add",
-            parse_mode="HTML"
-        )
-        return
-    
-    text = "📊 <b>Все правила во всех чатах</b>\n\n"
-    current_chat = None
-    
-    for chat_id, topic_id, words in rules:
-        if chat_id != current_chat:
-            current_chat = chat_id
-            text += f"━━━━━━━━━━━━━━━━━━━━\n"
-            text += f"🆔 <b>Группа:</b> <code>{chat_id}</code>\n"
-        
-        topic_name = get_chat_type_prefix(topic_id) + ("" if topic_id is None else f" #{topic_id}")
-        text += f"  📌 <b>{topic_name}:</b> {len(words)} стоп-слов\n"
-        
-        if words:
-            # Показываем все слова (максимум 20, чтобы не перегружать)
-            for i, word in enumerate(words[:20], 1):
-                text += f"     {i}. <code>{word}</code>\n"
-            if len(words) > 20:
-                text += f"     • ... и ещё {len(words) - 20} стоп-слов\n"
-        
-        text += "\n"
-    
-    # Создаем клавиатуру с кнопкой обновления
-    keyboard = InlineKeyboardBuilder()
-    keyboard.button(text="🔄 Обновить", callback_data="refresh")
-    keyboard.adjust(1)
-    
-    await message.answer(text, parse_mode="HTML", reply_markup=keyboard.as_markup())
+    # В режиме шардов /all приходит в первый шард, и он отвечает списком всех шардов
+    text, keyboard = render_rules_page(*await get_rules_pages(), 0)
+    await message.answer(text, parse_mode="HTML", reply_markup=keyboard)
 
 @dp.message(Command("rules"))
 async def cmd_rules(message: Message):
@@ -583,12 +794,15 @@ async def cmd_rules(message: Message):
         topic_id = int(args[2]) if len(args) > 2 and args[2] != "0" else None
         
         words = get_rules(chat_id, topic_id)
+        inherited = ""
+        if topic_id is not None and storage.get_setting(chat_id, "inherit_rules", False):
+            inherited = f"\n🔗 С правилами всей группы в теме действует: {len(storage.get_effective_rules(chat_id, topic_id))}"
         
         if not words:
             await message.answer(
                 f"ostringstream <b>Нет правил для {get_chat_type_prefix(topic_id)}{'' if topic_id is None else f' #{topic_id}'}</b>\n\n"
                 "Вы можете добавить правила с помощью команды:\n"
-                f"/add <code>{chat_id}</code> <code>{topic_id or 0}</code> <code>&lt;слово&gt;</code>",
+                f"/add <code>{chat_id}</code> <code>{topic_id or 0}</code> <code>&lt;слово&gt;</code>" + inherited,
                 parse_mode="HTML"
             )
             return
@@ -600,9 +814,9 @@ async def cmd_rules(message: Message):
         )
         
         for i, word in enumerate(words, 1):
-            text += f"{i}. <code>{word}</code>\n"
+            text += f"{i}. <code>{html.escape(word)}</code>\n"
         
-        text += f"\nВсего: {len(words)} стоп-слов"
+        text += f"\nВсего: {len(words)} стоп-слов" + inherited
         
         # Создаем клавиатуру с действиями
         keyboard = InlineKeyboardBuilder()
@@ -632,6 +846,11 @@ async def cmd_add(message: Message):
             "📌 <b>Примеры:</b>\n"
             "/add -1001234567890 0 казино — для всей группы / веб-ветки _1\n"
             "/add -1001234567890 123 /dick — для темы 123\n\n"
+            "🧩 <b>Шаблоны:</b>\n"
+            "/add -1001234567890 0 re:к\\s*а\\s*з\\s*и\\s*н\\s*о — регулярное выражение\n"
+            "/add -1001234567890 0 glob:каз*но — <code>*</code> любые символы в слове, <code>?</code> один символ\n\n"
+            "🔗 <b>Наследование</b> (/inherit):\n"
+            f"/add -1001234567890 123 {RULE_EXCLUDE_PREFIX}казино — не применять в теме 123 правило всей группы\n\n"
             "💡 Используйте <code>0</code> для всей группы / веб-ветки _1 или числовой ID темы.",
             parse_mode="HTML"
         )
@@ -641,6 +860,11 @@ async def cmd_add(message: Message):
         chat_id = int(args[1])
         topic_id = int(args[2]) if args[2] != "0" else None
         word = " ".join(args[3:])
+        if is_pattern_rule(word) or is_exclusion_rule(word):
+            # Шаблон берём как есть, без схлопывания пробелов
+            word = message.text.split(maxsplit=3)[3].strip()
+        if is_pattern_rule(word):
+            await check_rule(word)
         
         if add_rule(chat_id, topic_id, word):
             topic_name = get_chat_type_prefix(topic_id) + ("" if topic_id is None else f" #{topic_id}")
@@ -649,7 +873,7 @@ async def cmd_add(message: Message):
                 f"✅ <b>Стоп-слово добавлено!</b>\n\n"
                 f"📌 <b>Группа:</b> <code>{chat_id}</code>\n"
                 f"🏷 <b>{topic_name}:</b>\n"
-                f"   • <code>{word}</code>\n\n"
+                f"   • <code>{html.escape(word)}</code>\n\n"
                 f"Всего стоп-слов в этой секции: {len(get_rules(chat_id, topic_id))}",
                 parse_mode="HTML"
             )
@@ -660,6 +884,12 @@ async def cmd_add(message: Message):
                 f"Тема: <code>{topic_id or 'вся группа / веб-ветка _1'}</code>",
                 parse_mode="HTML"
             )
+    except RuleError as e:
+        await message.answer(
+            f"❌ <b>Шаблон не принят</b>: {html.escape(str(e))}\n\n"
+            f"<code>{html.escape(word)}</code>",
+            parse_mode="HTML"
+        )
     except ValueError:
         await message.answer(
             "❌ <b>Ошибка</b>: ID должны быть числами\n\n"
@@ -688,6 +918,8 @@ async def cmd_del(message: Message):
         chat_id = int(args[1])
         topic_id = int(args[2]) if args[2] != "0" else None
         word = " ".join(args[3:])
+        if is_pattern_rule(word) or is_exclusion_rule(word):
+            word = message.text.split(maxsplit=3)[3].strip()
         
         if del_rule(chat_id, topic_id, word):
             topic_name = get_chat_type_prefix(topic_id) + ("" if topic_id is None else f" #{topic_id}")
@@ -696,7 +928,7 @@ async def cmd_del(message: Message):
                 f"✅ <b>Стоп-слово удалено!</b>\n\n"
                 f"📌 <b>Группа:</b> <code>{chat_id}</code>\n"
                 f"🏷 <b>{topic_name}:</b>\n"
-                f"   • <code>{word}</code>\n\n"
+                f"   • <code>{html.escape(word)}</code>\n\n"
                 f"Осталось стоп-слов в этой секции: {len(get_rules(chat_id, topic_id))}",
                 parse_mode="HTML"
             )
@@ -739,41 +971,64 @@ async def cmd_clean(message: Message):
         topic_id = int(args[2]) if args[2] != "0" else None
         user_id = int(args[3])
         
-        await message.answer(f"🔄 Удаляю сообщения пользователя <code>{user_id}</code>...", parse_mode="HTML")
+        status = await message.answer(f"🔄 Удаляю сообщения пользователя <code>{user_id}</code>...", parse_mode="HTML")
         
-        msg_ids = get_user_messages(chat_id, user_id, topic_id)
-        deleted = 0
+        msg_ids = await get_user_messages(chat_id, user_id, topic_id)
+        last_progress = 0.0
         
-        for msg_id in msg_ids:
+        async def show_progress(done, total):
+            # Обновляем статус не чаще раза в секунду
+            nonlocal last_progress
+            now = asyncio.get_running_loop().time()
+            if done < total and now - last_progress < 1:
+                return
+            last_progress = now
             try:
-                await bot.delete_message(chat_id=chat_id, message_id=msg_id)
-                deleted += 1
-                await asyncio.sleep(0.1)
+                await status.edit_text(
+                    f"🔄 Удаляю сообщения пользователя <code>{user_id}</code>: {done}/{total}",
+                    parse_mode="HTML"
+                )
             except Exception as e:
-                logging.error(f"❌ Не удалил {msg_id}: {e}")
+                logging.warning(f"⚠️ Не удалось обновить прогресс: {e}")
+        
+        # Удаления /clean уступают удалению спама, но опережают ответы админу
+        token = api_priority.set(PRIORITY_CLEAN)
+        try:
+            report = await delete_messages(
+                bot, chat_id, msg_ids,
+                concurrency=CLEAN_CONCURRENCY,
+                on_progress=show_progress
+            )
+        finally:
+            api_priority.reset(token)
         
         clear_user_cache(chat_id, user_id, topic_id)
         
         topic_name = get_chat_type_prefix(topic_id) + ("" if topic_id is None else f" #{topic_id}")
         
-        if deleted == 0:
+        if not msg_ids:
             await message.answer(
                 f"⚠️ <b>Нет сообщений для удаления</b>\n\n"
                 f"📌 <b>Группа:</b> <code>{chat_id}</code>\n"
                 f"🏷 <b>{topic_name}</b>\n"
                 f"👤 <b>Пользователь:</b> <code>{user_id}</code>\n\n"
                 "❌ Кэш пуст. Бот не сохранил сообщения.\n"
-                "💡 Сообщения удаляются только за последние 48 часов.",
+                f"💡 Сообщения удаляются только за последние {CACHE_RETENTION_HOURS:g} ч.",
                 parse_mode="HTML"
             )
         else:
-            await message.answer(
-                f"✅ <b>Успешно удалено: {deleted} сообщений</b>\n\n"
+            text = (
+                f"✅ <b>Успешно удалено: {report.deleted} сообщений</b>\n\n"
                 f"📌 <b>Группа:</b> <code>{chat_id}</code>\n"
                 f"🏷 <b>{topic_name}</b>\n"
-                f"👤 <b>Пользователь:</b> <code>{user_id}</code>",
-                parse_mode="HTML"
+                f"👤 <b>Пользователь:</b> <code>{user_id}</code>\n\n"
+                f"🗑 Удалено: {report.deleted}\n"
+                f"👻 Уже удалены: {report.gone}\n"
+                f"🚫 Нет прав на удаление: {report.forbidden}"
             )
+            if report.failed:
+                text += f"\n❌ Ошибки: {report.failed}"
+            await message.answer(text, parse_mode="HTML")
     except ValueError:
         await message.answer(
             "❌ <b>Ошибка</b>: ID должны быть числами\n\n"
@@ -781,6 +1036,123 @@ async def cmd_clean(message: Message):
             parse_mode="HTML"
         )
 
+@dp.message(Command("import"))
+async def cmd_import(message: Message):
+    if not await is_admin_in_pm(message):
+        return
+    
+    # Команда приходит подписью к файлу или ответом на сообщение с файлом
+    args = (message.text or message.caption or "").split()
+    document = message.document
+    if document is None and message.reply_to_message is not None:
+        document = message.reply_to_message.document
+    if len(args) < 3 or document is None:
+        await message.answer(
+            "📥 <b>Как импортировать правила?</b>\n\n"
+            "Отправьте файл с подписью:\n"
+            "/import <code>&lt;chat_id&gt;</code> <code>&lt;topic_id&gt;</code>\n"
+            "или ответьте этой командой на сообщение с файлом.\n\n"
+            "📄 <b>Форматы:</b>\n"
+            "• <code>.txt</code> — по правилу в строке\n"
+            "• <code>.csv</code> — правило в первом столбце\n"
+            "• <code>.json</code> — список строк или файл из /export\n\n"
+            "Повторы пропускаются, шаблоны проверяются как в /add. "
+            "Весь импорт — одно изменение: /undo отменяет его целиком.",
+            parse_mode="HTML"
+        )
+        return
+    
+    try:
+        chat_id = int(args[1])
+        topic_id = int(args[2]) if args[2] != "0" else None
+    except ValueError:
+        await message.answer(
+            "❌ <b>Ошибка</b>: ID должны быть числами\n\n"
+            "Убедитесь, что вы правильно указали chat_id и topic_id",
+            parse_mode="HTML"
+        )
+        return
+    if document.file_size and document.file_size > IMPORT_MAX_BYTES:
+        await message.answer(f"❌ <b>Файл слишком большой</b>: не больше {IMPORT_MAX_BYTES // 1024} КБ", parse_mode="HTML")
+        return
+    
+    status = await message.answer("🔄 Загружаю и проверяю правила...")
+    try:
+        content = (await bot.download(document)).read()
+        rules = parse_rules_file(content, document.file_name or "")
+    except RulesFileError as e:
+        await status.edit_text(f"❌ <b>Файл не принят</b>: {html.escape(str(e))}", parse_mode="HTML")
+        return
+    
+    accepted, rejected = await check_rules(rules)
+    added = import_rules(chat_id, topic_id, accepted)
+    topic_name = get_chat_type_prefix(topic_id) + ("" if topic_id is None else f" #{topic_id}")
+    
+    text = (
+        f"📥 <b>Импорт завершён</b>\n\n"
+        f"📌 <b>Группа:</b> <code>{chat_id}</code>\n"
+        f"🏷 <b>{topic_name}</b>\n\n"
+        f"➕ Добавлено: {len(added)}\n"
+        f"♻️ Уже были в списке: {len(accepted) - len(added)}\n"
+        f"🚫 Отклонено шаблонов: {len(rejected)}\n"
+        f"Всего стоп-слов в этой секции: {len(get_rules(chat_id, topic_id))}"
+    )
+    for rule, error in rejected[:10]:
+        text += f"\n   • <code>{html.escape(rule[:100])}</code>: {html.escape(error)}"
+    if len(rejected) > 10:
+        text += f"\n   • ... и ещё {len(rejected) - 10}"
+    if added:
+        text += f"\n\n↩️ Отменить импорт: /undo {chat_id} {topic_id or 0}"
+    await status.edit_text(text, parse_mode="HTML")
+
+@dp.message(Command("export"))
+async def cmd_export(message: Message):
+    if not await is_admin_in_pm(message):
+        return
+    
+    args = message.text.split()
+    if len(args) < 3:
+        await message.answer(
+            "📤 <b>Как экспортировать правила?</b>\n\n"
+            "Введите команду:\n"
+            "/export <code>&lt;chat_id&gt;</code> <code>&lt;topic_id&gt;</code> [<code>txt|json|csv</code>]\n\n"
+            "📌 <b>Пример:</b>\n"
+            "/export -1001234567890 0 json\n\n"
+            "💡 Файл можно загрузить в другой чат командой /import.",
+            parse_mode="HTML"
+        )
+        return
+    
+    try:
+        chat_id = int(args[1])
+        topic_id = int(args[2]) if args[2] != "0" else None
+        fmt = args[3].lower() if len(args) > 3 else "txt"
+        if fmt not in EXPORT_FORMATS:
+            raise ValueError(fmt)
+    except ValueError:
+        await message.answer(
+            "❌ <b>Ошибка</b>: ID должны быть числами, формат — txt / json / csv\n\n"
+            "Пример: /export -1001234567890 0 json",
+            parse_mode="HTML"
+        )
+        return
+    
+    words = get_rules(chat_id, topic_id)
+    topic_name = get_chat_type_prefix(topic_id) + ("" if topic_id is None else f" #{topic_id}")
+    if not words:
+        await message.answer(
+            f"📭 <b>Нет правил для {topic_name}</b>\n\n"
+            f"Группа: <code>{chat_id}</code>",
+            parse_mode="HTML"
+        )
+        return
+    
+    content = export_rules(words, chat_id, topic_id or 0, fmt)
+    await message.answer_document(
+        BufferedInputFile(content, filename=f"rules_{chat_id}_{topic_id or 0}.{fmt}"),
+        caption=f"📤 {topic_name}, группа {chat_id}: {len(words)} стоп-слов"
+    )
+
 @dp.message(Command("undo"))
 async def cmd_undo(message: Message):
     if not await is_admin_in_pm(message):
@@ -791,9 +1163,11 @@ async def cmd_undo(message: Message):
         await message.answer(
             "↩️ <b>Как откатить изменения?</b>\n\n"
             "Введите команду:\n"
-            "/undo <code>&lt;chat_id&gt;</code> <code>&lt;topic_id&gt;</code>\n\n"
-            "📌 <b>Пример:</b>\n"
-            "/undo -1001234567890 123",
+            "/undo <code>&lt;chat_id&gt;</code> <code>&lt;topic_id&gt;</code> [<code>n</code>]\n\n"
+            "📌 <b>Примеры:</b>\n"
+            "/undo -1001234567890 123 — отменить последнее изменение\n"
+            "/undo -1001234567890 123 3 — отменить три последних изменения\n\n"
+            f"💡 Для каждой темы хранятся последние {HISTORY_DEPTH} изменений.",
             parse_mode="HTML"
         )
         return
@@ -801,15 +1175,19 @@ async def cmd_undo(message: Message):
     try:
         chat_id = int(args[1])
         topic_id = int(args[2]) if args[2] != "0" else None
+        steps = max(1, int(args[3])) if len(args) > 3 else 1
         
-        if undo_last_change(chat_id, topic_id):
+        undone = undo_last_change(chat_id, topic_id, steps)
+        if undone:
             topic_name = get_chat_type_prefix(topic_id) + ("" if topic_id is None else f" #{topic_id}")
             
             await message.answer(
                 f"↩️ <b>Изменения откачены!</b>\n\n"
                 f"📌 <b>Группа:</b> <code>{chat_id}</code>\n"
                 f"🏷 <b>{topic_name}</b>\n\n"
-                "Последнее изменение было отменено.",
+                + ("Последнее изменение было отменено." if undone == 1 else f"Отменено изменений: {undone}.")
+                + (f"\nЗапрошено {steps}, но история короче." if undone < steps else "")
+                + f"\nМожно откатить ещё: {storage.undo_depth(chat_id, topic_id)}",
                 parse_mode="HTML"
             )
         else:
@@ -822,69 +1200,455 @@ async def cmd_undo(message: Message):
             )
     except ValueError:
         await message.answer(
-            "❌ <b>Ошибка</b>: ID должны быть числами\n\n"
-            "Убедитесь, что вы правильно указали chat_id и topic_id",
+            "❌ <b>Ошибка</b>: ID и число шагов должны быть числами\n\n"
+            "Убедитесь, что вы правильно указали chat_id, topic_id и n",
             parse_mode="HTML"
         )
 
+@dp.message(Command("inherit"))
+async def cmd_inherit(message: Message):
+    if not await is_admin_in_pm(message):
+        return
+
+    args = message.text.split()
+    if len(args) < 2:
+        await message.answer(
+            "🔗 <b>Наследование правил</b>\n\n"
+            "Введите команду:\n"
+            "/inherit <code>&lt;chat_id&gt;</code> [<code>on|off</code>]\n\n"
+            "Когда наследование включено, правила всей группы (<code>topic_id = 0</code>) "
+            "действуют и во всех темах вместе с правилами самой темы. "
+            "Одно слово для всего форума добавляется один раз.\n\n"
+            "🚫 <b>Исключение в теме:</b>\n"
+            f"/add -1001234567890 123 {RULE_EXCLUDE_PREFIX}казино — правило всей группы «казино» не действует в теме 123\n\n"
+            "📌 <b>Пример:</b>\n"
+            "/inherit -1001234567890 on",
+            parse_mode="HTML"
+        )
+        return
+
+    try:
+        chat_id = int(args[1])
+        if len(args) > 2:
+            mode = args[2].lower()
+            if mode not in ("on", "off"):
+                raise ValueError(mode)
+            set_inherit_rules(chat_id, mode == "on")
+    except ValueError:
+        await message.answer(
+            "❌ <b>Ошибка</b>: chat_id должен быть числом, режим — on / off\n\n"
+            "Пример: /inherit -1001234567890 on",
+            parse_mode="HTML"
+        )
+        return
+
+    enabled = storage.get_setting(chat_id, "inherit_rules", False)
+    await message.answer(
+        f"🔗 <b>Наследование правил в чате</b> <code>{chat_id}</code>: "
+        + ("включено\n\nПравила всей группы действуют во всех темах." if enabled
+           else "выключено\n\nВ каждой теме действуют только её собственные правила."),
+        parse_mode="HTML"
+    )
+
+@dp.message(Command("score"))
+async def cmd_score(message: Message):
+    if not await is_admin_in_pm(message):
+        return
+
+    if scorer is None:
+        await message.answer(
+            "❌ <b>Оценка моделью недоступна</b>\n\n"
+            "Для неё нужен пакет numpy: <code>pip install numpy</code>",
+            parse_mode="HTML"
+        )
+        return
+
+    args = message.text.split()
+    if len(args) < 2:
+        await message.answer(
+            "🧠 <b>Оценка сообщений моделью</b>\n\n"
+            "Введите команду:\n"
+            "/score <code>&lt;chat_id&gt;</code> [<code>off|shadow|on</code>] [<code>порог</code>]\n\n"
+            "• <code>off</code> — модель не применяется (по умолчанию)\n"
+            "• <code>shadow</code> — только запись в лог, сообщения не удаляются\n"
+            "• <code>on</code> — удаление сообщений с вероятностью спама не ниже порога\n\n"
+            "📌 <b>Пример:</b>\n"
+            "/score -1001234567890 shadow 0.9\n\n"
+            f"📊 Обучено: спам {scorer.docs[1]}, не спам {scorer.docs[0]}"
+            + ("" if scorer.ready else f" (модель включится после {SCORER_MIN_SAMPLES} примеров каждого вида)"),
+            parse_mode="HTML"
+        )
+        return
+
+    try:
+        chat_id = int(args[1])
+        for arg in args[2:]:
+            if arg.lower() in SCORER_MODES:
+                storage.set_setting(chat_id, "scorer_mode", None if arg.lower() == "off" else arg.lower())
+            else:
+                threshold = float(arg)
+                if not 0 < threshold < 1:
+                    raise ValueError(arg)
+                storage.set_setting(chat_id, "scorer_threshold", threshold)
+    except ValueError:
+        await message.answer(
+            "❌ <b>Ошибка</b>: chat_id должен быть числом, режим — off / shadow / on, порог — число от 0 до 1\n\n"
+            "Пример: /score -1001234567890 on 0.97",
+            parse_mode="HTML"
+        )
+        return
+
+    await message.answer(
+        f"🧠 <b>Модель в чате</b> <code>{chat_id}</code>\n\n"
+        f"Режим: <code>{storage.get_setting(chat_id, 'scorer_mode', 'off')}</code>\n"
+        f"Порог: <code>{storage.get_setting(chat_id, 'scorer_threshold', SCORER_THRESHOLD):g}</code>\n"
+        f"Обучено: спам {scorer.docs[1]}, не спам {scorer.docs[0]}"
+        + ("" if scorer.ready else " — пока мало примеров, модель не применяется"),
+        parse_mode="HTML"
+    )
+
+@dp.message(Command("flood"))
+async def cmd_flood(message: Message):
+    if not await is_admin_in_pm(message):
+        return
+
+    args = message.text.split()
+    if len(args) < 2:
+        await message.answer(
+            "🌊 <b>Лимит флуда</b>\n\n"
+            "Введите команду:\n"
+            "/flood <code>&lt;chat_id&gt;</code> [<code>&lt;сообщений&gt; &lt;секунд&gt;</code>|<code>off</code>|<code>default</code>]\n\n"
+            "Если пользователь пишет чаще лимита, бот удаляет его сообщения за последние "
+            "<code>секунд</code> и все следующие, пока он не сбавит темп.\n\n"
+            "📌 <b>Примеры:</b>\n"
+            "/flood -1001234567890 10 5 — не больше 10 сообщений за 5 секунд\n"
+            "/flood -1001234567890 off — выключить в чате\n"
+            "/flood -1001234567890 default — вернуть лимит по умолчанию\n\n"
+            + (f"По умолчанию: {FLOOD_MESSAGES} сообщений за {FLOOD_SECONDS:g} с" if FLOOD_MESSAGES else "По умолчанию выключен"),
+            parse_mode="HTML"
+        )
+        return
+
+    try:
+        chat_id = int(args[1])
+        if len(args) > 2:
+            mode = args[2].lower()
+            if mode == "default":
+                storage.set_setting(chat_id, "flood_limit", None)
+            elif mode == "off":
+                storage.set_setting(chat_id, "flood_limit", [0, FLOOD_SECONDS])
+            else:
+                count, period = int(args[2]), float(args[3])
+                if count < 1 or period <= 0:
+                    raise ValueError(args[2])
+                storage.set_setting(chat_id, "flood_limit", [count, period])
+    except (ValueError, IndexError):
+        await message.answer(
+            "❌ <b>Ошибка</b>: chat_id и лимит должны быть числами (сообщений ≥ 1, секунд &gt; 0)\n\n"
+            "Пример: /flood -1001234567890 10 5",
+            parse_mode="HTML"
+        )
+        return
+
+    count, period = storage.get_setting(chat_id, "flood_limit", (FLOOD_MESSAGES, FLOOD_SECONDS))
+    await message.answer(
+        f"🌊 <b>Лимит флуда в чате</b> <code>{chat_id}</code>\n\n"
+        + (f"Не больше {count} сообщений за {period:g} с от одного пользователя" if count else "Выключен"),
+        parse_mode="HTML"
+    )
+
+@dp.message(Command("verbose"))
+async def cmd_verbose(message: Message):
+    if not await is_admin_in_pm(message):
+        return
+
+    args = message.text.split()
+    if len(args) >= 2:
+        if args[1].lower() not in VERBOSITY_MODES:
+            # /verbose получают все шарды: об ошибке тоже сообщает только первый
+            if SHARD_INDEX:
+                return
+            await message.answer(
+                "❌ <b>Ошибка</b>: Неизвестный режим\n\n"
+                f"Доступные режимы: <code>{' / '.join(VERBOSITY_MODES)}</code>",
+                parse_mode="HTML"
+            )
+            return
+        events.set_mode(args[1].lower())
+        logging.info(f"🔊 Режим логов сообщений: {events.mode}")
+
+    # /verbose получают все шарды: режим меняет каждый, отвечает только первый
+    if SHARD_INDEX:
+        return
+
+    skipped = ", ".join(f"{event}: {count}" for event, count in events.skipped().items() if count)
+    await message.answer(
+        f"🔊 <b>Логи сообщений:</b> <code>{events.mode}</code>\n\n"
+        "• <code>quiet</code> — не писать события сообщений\n"
+        f"• <code>sampled</code> — каждое {LOG_SAMPLE_EVERY}-е, не чаще {LOG_EVENT_RATE:g}/с "
+        f"(стоп-слова — все, не чаще {LOG_MATCH_RATE:g}/с)\n"
+        "• <code>full</code> — каждое сообщение\n\n"
+        + (f"Пропущено с последней записи: {skipped}\n\n" if skipped else "")
+        + "Пример: /verbose full",
+        parse_mode="HTML"
+    )
+
 # --- ПРОВЕРКА СПАМА (В ГРУППАХ) ---
+# Администраторы чатов для лимита флуда: {chat_id: (время загрузки, множество id)}
+chat_admins = {}
+
+async def is_chat_admin(chat_id, user_id):
+    """Администратор ли пользователь в чате; список запрашивается, только когда пользователь превысил лимит"""
+    cached = chat_admins.get(chat_id)
+    if cached is None or time.monotonic() - cached[0] > FLOOD_ADMINS_TTL:
+        try:
+            admins = {member.user.id for member in await bot.get_chat_administrators(chat_id)}
+        except TelegramAPIError as e:
+            logging.warning(f"⚠️ Не удалось получить администраторов чата {chat_id}: {e}")
+            # Прежний список лучше пустого: без него админов удаляли бы как флуд
+            admins = cached[1] if cached is not None else set()
+        cached = chat_admins[chat_id] = (time.monotonic(), admins)
+    return user_id in cached[1]
+
+async def delete_flood(verdict, message_id, chat_id, topic_id, user_id, count, period, history=True):
+    """
+    Первое сообщение сверх лимита удаляет и недавние сообщения пользователя из кэша
+    (за последние period секунд, во всех темах), следующие — только сами себя.
+    history=False — только это сообщение: у пишущих от имени канала в кэше общий служебный id.
+    """
+    message_ids = [message_id]
+    if verdict == FLOOD_STARTED and history:
+        message_ids = await get_user_messages(chat_id, user_id, since=time.time() - period)
+        if message_id not in message_ids:
+            message_ids.append(message_id)
+        events.log(
+            "flood", "🌊 ФЛУД: user=%s в чате %s (тема %s), удаляю сообщений: %s",
+            user_id, chat_id, topic_id, len(message_ids)
+        )
+    FLOOD_MESSAGES_TOTAL.inc(len(message_ids))
+    reason = f"флуд: больше {count} сообщений за {period:g} с"
+    for flood_id in message_ids:
+        if scorer is not None:
+            # Удалённое за флуд не обучает модель: это не спам по тексту, но и не обычное сообщение
+            model_deleted[(chat_id, flood_id)] = time.time()
+        await deletion_queue.put(chat_id, flood_id, reason)
+
 @dp.message()
 async def check_spam(message: Message):
     if message.chat.type == "private":
         return
     
-    chat_id = message.chat.id
-    # ПРАВИЛЬНЫЙ СПОСОБ ОПРЕДЕЛЕНИЯ ТЕМЫ В AIOTGRAM 3.X
-    topic_id = message.message_thread_id # Это ключевая строка
-    user_id = message.from_user.id
-    is_bot = message.from_user.is_bot
-    text = message.text or ""
+    MESSAGES_TOTAL.inc()
+    # Время обработки пишется в гистограмму, в том числе при ранних return
+    with timed(CHECK_SPAM_SECONDS):
+        chat_id = message.chat.id
+        # ПРАВИЛЬНЫЙ СПОСОБ ОПРЕДЕЛЕНИЯ ТЕМЫ В AIOTGRAM 3.X
+        topic_id = message.message_thread_id # Это ключевая строка
+        user_id = message.from_user.id
+        is_bot = message.from_user.is_bot
+        text = message.text or ""
     
-    # 🔥 ДОБАВЬТЕ ЭТО ЛОГИРОВАНИЕ
-    logging.info(f"📨 Получено сообщение: chat={chat_id}, topic={topic_id}, user={user_id}, is_bot={is_bot}, text='{text[:50]}'")
+        # Строка собирается только если событие попало в выборку (см. /verbose)
+        events.log(
+            "received", "📨 Получено сообщение: chat=%s, topic=%s, user=%s, is_bot=%s, text='%.50s'",
+            chat_id, topic_id, user_id, is_bot, text
+        )
     
-    # Кэшируем сообщение (для функции /clean)
-    cache_message(message.message_id, chat_id, topic_id, user_id, text)
+        # Кэшируем сообщение (для функции /clean)
+        cache_message(message.message_id, chat_id, topic_id, user_id, text)
+
+        # Флуд: считаются все сообщения, в том числе без текста (стикеры, медиа).
+        # Анонимные админы (от имени группы) и автопересылки из связанного канала не ограничиваются:
+        # у всех них общий служебный from_user. Пишущие от имени своего канала считаются по каналу.
+        flood_count, flood_period = storage.get_setting(chat_id, "flood_limit", (FLOOD_MESSAGES, FLOOD_SECONDS))
+        sender_chat = message.sender_chat
+        if flood_count and not message.is_automatic_forward and (sender_chat is None or sender_chat.id != chat_id):
+            flood_key = user_id if sender_chat is None else sender_chat.id
+            verdict = flood.check(chat_id, flood_key, flood_count, flood_period)
+            if verdict is not None and not await is_chat_admin(chat_id, user_id):
+                await delete_flood(
+                    verdict, message.message_id, chat_id, topic_id, flood_key, flood_count, flood_period,
+                    history=sender_chat is None
+                )
+                return
     
-    # Если нет текста — пропускаем
-    if not text:
-        logging.info("⚠️ Нет текста, пропускаем")
-        return
+        # Если нет текста — пропускаем
+        if not text:
+            events.log("no_text", "⚠️ Нет текста, пропускаем")
+            return
     
-    # --- ИЗМЕНЕННАЯ ЛОГИКА (РЕВЕРС-БЛОКИНГ) ---
-    # Загружаем правила: ТОЛЬКО для темы, в которой отправлено сообщение
-    # topic_id может быть None (для "веб-ветки _1") или числом (для настоящей темы)
-    words = get_rules(chat_id, topic_id)
+        # --- ИЗМЕНЕННАЯ ЛОГИКА (РЕВЕРС-БЛОКИНГ) ---
+        # Загружаем правила темы, в которой отправлено сообщение (и всей группы, если чат их наследует)
+        # topic_id может быть None (для "веб-ветки _1") или числом (для настоящей темы)
+        matcher = get_matcher(chat_id, topic_id)
 
-    if not words:
-        logging.info(f"ℹ️ Нет правил для этой темы (chat={chat_id}, topic={topic_id}). Сообщение не удаляется.")
-        return # <-- ВАЖНО: выходим, если нет правил для конкретной темы
+        # Проверка стоп-слов: текст нормализуется один раз (регистр, похожие буквы, невидимые символы)
+        word = None
+        if matcher:
+            if classifier is not None:
+                # В пуле процессов; при таймауте или перегрузке пула — None, сообщение остаётся
+                word = await classifier.classify((chat_id, topic_id), text)
+            else:
+                word = matcher.find(text)
+        if word is not None:
+            MATCHES_TOTAL.inc(labels=(chat_id, "global" if topic_id is None else topic_id))
+            events.log("match", "🗑 СТОП-СЛОВО НАЙДЕНО: '%s' в теме %s", word, topic_id)
+            await deletion_queue.put(chat_id, message.message_id, f"стоп-слово '{word}'")
+            return
+        # --- КОНЕЦ ИЗМЕНЕННОЙ ЛОГИКИ ---
 
-    # Проверка стоп-слов
-    for word in words:
-        if word.lower() in text.lower():  # <-- Проверка без учёта регистра
-            logging.info(f"🗑 СТОП-СЛОВО НАЙДЕНО: '{word}' в теме {topic_id}")
-            try:
-                await message.delete()
-                logging.info(f"✅ УСПЕШНО УДАЛЕНО")
-            except Exception as e:
-                logging.error(f"❌ ОШИБКА УДАЛЕНИЯ: {type(e).__name__}: {e}")
-            break
-    # --- КОНЕЦ ИЗМЕНЕННОЙ ЛОГИКИ ---
+        # Рейд: одно и то же сообщение от многих пользователей; работает и в темах без правил
+        if raids is not None:
+            raid_ids = raids.check(chat_id, user_id, message.message_id, text)
+            if raid_ids:
+                RAID_MESSAGES_TOTAL.inc(len(raid_ids))
+                events.log("raid", "🗑 РЕЙД: удаляю похожих сообщений: %s (chat=%s, topic=%s)", len(raid_ids), chat_id, topic_id)
+                for raid_id in raid_ids:
+                    if scorer is not None:
+                        # Иначе сообщения рейда останутся в кэше и попадут в обучение как не спам
+                        model_deleted[(chat_id, raid_id)] = time.time()
+                    await deletion_queue.put(chat_id, raid_id, "рейд: похожие сообщения разных пользователей")
+                return
+
+        score_mode = storage.get_setting(chat_id, "scorer_mode", "off") if scorer is not None else "off"
+        if not matcher and score_mode == "off":
+            events.log("no_rules", "ℹ️ Нет правил для этой темы (chat=%s, topic=%s). Сообщение не удаляется.", chat_id, topic_id)
+            return # <-- ВАЖНО: выходим, если нет правил для конкретной темы
+
+        # Оценка моделью: сообщения параллельных обработчиков оцениваются одним пакетом
+        if score_mode != "off" and scorer.ready:
+            spam_score = await score_batcher.score(text)
+            if spam_score >= storage.get_setting(chat_id, "scorer_threshold", SCORER_THRESHOLD):
+                SCORER_FLAGGED_TOTAL.inc(labels=(score_mode,))
+                if score_mode == "shadow":
+                    events.log(
+                        "score", "🔎 Модель: спам %.3f (теневой режим, не удаляю): chat=%s, topic=%s, text='%.50s'",
+                        spam_score, chat_id, topic_id, text
+                    )
+                else:
+                    events.log("score", "🗑 Модель: спам %.3f в теме %s", spam_score, topic_id)
+                    model_deleted[(chat_id, message.message_id)] = time.time()
+                    await deletion_queue.put(chat_id, message.message_id, f"оценка модели {spam_score:.2f}")
 
-# --- ОЧИСТКА КЭША (каждые 6 часов) ---
+# --- ОЧИСТКА КЭША (часто и небольшими порциями) ---
 async def clear_cache_periodically():
     while True:
-        await asyncio.sleep(21600)  # 6 часов
-        clear_old_cache()
-        logging.info("🧹 Старый кэш очищен")
+        await asyncio.sleep(CACHE_SWEEP_INTERVAL)
+        removed = total = clear_old_cache(CACHE_SWEEP_BATCH)
+        # Порция заполнена целиком — устаревшие ещё есть, даём поработать хендлерам и продолжаем
+        while removed == CACHE_SWEEP_BATCH:
+            await asyncio.sleep(0)
+            removed = clear_old_cache(CACHE_SWEEP_BATCH)
+            total += removed
+        if total:
+            logging.info(f"🧹 Из кэша удалено устаревших сообщений: {total}")
+        if raids is not None:
+            raids.expire()
+        flood.expire()
+
+# --- ОБУЧЕНИЕ МОДЕЛИ (по кэшу сообщений) ---
+def _train_scorer(spam, ham, until):
+    """Выполняется в отдельном потоке: оценка в цикле событий продолжает работать со старыми весами"""
+    scorer.learn(spam, 1)
+    scorer.learn(ham, 0)
+    scorer.trained_until = until
+    scorer.save(scorer_model_path)
+
+async def train_scorer_periodically():
+    while True:
+        await asyncio.sleep(SCORER_TRAIN_INTERVAL)
+        until = time.time() - SCORER_HAM_DELAY
+        try:
+            records = await storage.cached_between(scorer.trained_until, until)
+            spam, ham = [], []
+            for i, msg in enumerate(records):
+                if not msg.text or (msg.chat_id, msg.message_id) in model_deleted:
+                    continue
+                # Совпадение с текущими стоп-словами — то, что check_spam удалил (или удалил бы)
+                if get_matcher(msg.chat_id, msg.topic_id).find(msg.text) is not None:
+                    spam.append(msg.text)
+                else:
+                    ham.append(msg.text)
+                if i % 500 == 499:
+                    await asyncio.sleep(0)
+            await asyncio.to_thread(_train_scorer, spam, ham, until)
+        except Exception as e:
+            logging.error(f"❌ Ошибка обучения модели: {type(e).__name__}: {e}")
+            continue
+        for key in [key for key, deleted_at in model_deleted.items() if deleted_at <= until]:
+            del model_deleted[key]
+        if spam or ham:
+            logging.info(
+                f"🧠 Модель дообучена: +{len(spam)} спам, +{len(ham)} не спам "
+                f"(всего {scorer.docs[1]} / {scorer.docs[0]})"
+            )
+
+# --- МЕТРИКИ ---
+async def collect_metrics():
+    """Обновляет датчики перед отдачей /metrics (на горячем пути они не считаются)"""
+    CACHE_MESSAGES.set(await storage.cached_count())
+    RULE_WORDS.clear()
+    words_per_chat = {}
+    for key, words in storage.rules.items():
+        chat_id = parse_rules_key(key)[0]
+        words_per_chat[chat_id] = words_per_chat.get(chat_id, 0) + len(words)
+    for chat_id, count in words_per_chat.items():
+        RULE_WORDS.set(count, (chat_id,))
+    RULE_KEYS.set(sum(1 for words in storage.rules.values() if words))
+    DELETION_QUEUE_DEPTH.set(deletion_queue.depth)
+    API_QUEUE_DEPTH.set(api_scheduler.depth)
 
 # --- ЗАПУСК ---
 async def main():
+    if SHARD_FRONT:
+        # Фронт только раздаёт апдейты; секрет защищает порты шардов от чужих запросов
+        await run_front(
+            BOT_TOKEN, os.path.abspath(__file__), SHARD_COUNT, SHARD_BASE_PORT,
+            path=WEBHOOK_PATH,
+            secret=WEBHOOK_SECRET or secrets.token_urlsafe(32),
+            queue_size=SHARD_QUEUE_SIZE,
+            metrics_port=METRICS_PORT,
+        )
+        return
+    if classifier is not None:
+        # До запуска потоков хранилища: процессы пула создаются через fork
+        await classifier.start()
     asyncio.create_task(clear_cache_periodically())
-    me = await bot.get_me()
-    logging.info(f"🤖 Бот запущен: @{me.username}")
-    await dp.start_polling(bot)
+    if scorer is not None:
+        asyncio.create_task(train_scorer_periodically())
+    flusher = asyncio.create_task(storage.run_flusher())
+    deletion_queue.start()
+    metrics_runner = None
+    if METRICS_PORT:
+        metrics_runner = await start_metrics_server(METRICS_HOST, METRICS_PORT, collect_metrics)
+    try:
+        if UPDATE_MODE == "webhook":
+            await run_webhook(
+                dp, bot,
+                host=WEBHOOK_HOST,
+                port=WEBHOOK_PORT,
+                path=WEBHOOK_PATH,
+                secret_token=WEBHOOK_SECRET,
+                public_url=WEBHOOK_URL,
+                max_concurrency=WEBHOOK_MAX_CONCURRENCY,
+                # Шард: сообщения чата по порядку и свой список правил для сводного /all первого шарда
+                ordered=SHARD_INDEX is not None,
+                routes={WEBHOOK_PATH + RULES_LIST_SUFFIX: rules_list_answer} if SHARD_INDEX is not None else None,
+            )
+        else:
+            me = await bot.get_me()
+            logging.info(f"🤖 Бот запущен: @{me.username}")
+            await dp.start_polling(bot)
+    finally:
+        if metrics_runner is not None:
+            await metrics_runner.cleanup()
+        await deletion_queue.close()
+        if classifier is not None:
+            await classifier.close()
+        flusher.cancel()
+        # Принудительно сохраняем всё, что не успело записаться
+        storage.close()
+        logging.info("💾 Данные сохранены")
 
 if __name__ == "__main__":
     try:
@@ -0,0 +1,328 @@
+# --- МНОГОШАБЛОННЫЙ ПОИСК СТОП-СЛОВ (Aho-Corasick) ---
+import asyncio
+import logging
+import re
+import sys
+from collections import deque
+from normalize import normalize_pattern, normalize_text
+
+# Типы правил: обычное слово (подстрока), регулярное выражение и шаблон с * и ?
+RULE_REGEX_PREFIX = "re:"
+RULE_GLOB_PREFIX = "glob:"
+# Исключение в теме: "not:казино" отменяет унаследованное правило всей группы "казино"
+RULE_EXCLUDE_PREFIX = "not:"
+# Ограничения для шаблонов, которые вводит админ
+MAX_PATTERN_LENGTH = 200
+PROBE_TIMEOUT = 1.0
+
+
+class RuleError(ValueError):
+    """Правило-шаблон не прошло проверку; текст ошибки показывается админу"""
+
+
+class StopWordMatcher:
+    """
+    Автомат Ахо-Корасик для списка стоп-слов.
+    Строится один раз на список правил и находит совпадения за один проход по тексту.
+    Поиск без учёта регистра: слова и текст приводятся к нижнему регистру.
+    Если переданы keys (уже нормализованные формы слов), автомат строится по ним,
+    а текст должен приходить нормализованным той же функцией.
+    """
+
+    __slots__ = ("words", "_lower", "_goto", "_fail", "_out")
+
+    def __init__(self, words, keys=None):
+        self.words = list(words)
+        self._lower = keys is None
+        if keys is None:
+            keys = [word.lower() for word in self.words]
+        # Узел 0 — корень. _out[s] — индекс слова, заканчивающегося в s (или через суффиксные ссылки)
+        self._goto = [{}]
+        self._fail = [0]
+        self._out = [-1]
+
+        for index, pattern in enumerate(keys):
+            if not pattern:
+                continue
+            state = 0
+            for ch in pattern:
+                nxt = self._goto[state].get(ch)
+                if nxt is None:
+                    nxt = len(self._goto)
+                    self._goto[state][ch] = nxt
+                    self._goto.append({})
+                    self._fail.append(0)
+                    self._out.append(-1)
+                state = nxt
+            if self._out[state] == -1:
+                self._out[state] = index
+
+        # Суффиксные ссылки обходом в ширину
+        queue = deque(self._goto[0].values())
+        while queue:
+            state = queue.popleft()
+            for ch, nxt in self._goto[state].items():
+                queue.append(nxt)
+                fail = self._fail[state]
+                while fail and ch not in self._goto[fail]:
+                    fail = self._fail[fail]
+                target = self._goto[fail].get(ch, 0)
+                self._fail[nxt] = target if target != nxt else 0
+                if self._out[nxt] == -1:
+                    self._out[nxt] = self._out[self._fail[nxt]]
+
+    def __bool__(self):
+        return any(out != -1 for out in self._out)
+
+    def _scan(self, text):
+        goto, fail, out = self._goto, self._fail, self._out
+        state = 0
+        for ch in (text.lower() if self._lower else text):
+            while state and ch not in goto[state]:
+                state = fail[state]
+            state = goto[state].get(ch, 0)
+            if out[state] != -1:
+                yield state
+
+    def find(self, text):
+        """Возвращает первое найденное в тексте стоп-слово (в исходном виде) или None"""
+        for state in self._scan(text):
+            return self.words[self._out[state]]
+        return None
+
+
+def is_pattern_rule(rule):
+    return rule.startswith((RULE_REGEX_PREFIX, RULE_GLOB_PREFIX))
+
+
+def is_exclusion_rule(rule):
+    return rule.startswith(RULE_EXCLUDE_PREFIX)
+
+
+def merge_rules(chat_rules, topic_rules):
+    """
+    Правила темы с наследованием: правила всей группы, кроме исключённых в теме,
+    затем собственные правила темы (без повторов). Исключения в результат не попадают.
+    """
+    excluded = {rule[len(RULE_EXCLUDE_PREFIX):] for rule in topic_rules if is_exclusion_rule(rule)}
+    merged = [rule for rule in chat_rules if rule not in excluded and not is_exclusion_rule(rule)]
+    seen = set(merged)
+    merged.extend(rule for rule in topic_rules if rule not in seen and not is_exclusion_rule(rule))
+    return merged
+
+
+def glob_to_regex(glob):
+    """* — любые символы внутри слова, ? — один символ, остальное ищется буквально (после нормализации)"""
+    return "".join(
+        r"\S*" if ch == "*" else r"\S" if ch == "?" else re.escape(ch)
+        for ch in normalize_text(glob)
+    )
+
+
+def rule_regex(rule):
+    """Регулярное выражение правила-шаблона для нормализованного текста (без проверки на безопасность)"""
+    if rule.startswith(RULE_REGEX_PREFIX):
+        return normalize_pattern(rule[len(RULE_REGEX_PREFIX):])
+    return glob_to_regex(rule[len(RULE_GLOB_PREFIX):])
+
+
+# Конструкции, которые ломают объединение шаблонов в одно выражение
+_UNSUPPORTED_SYNTAX = re.compile(r"\(\?P[<=]|\(\?[aiLmsux-]+[:)]|\\[1-9]")
+_COUNTED = re.compile(r"\{(\d*)(,?)(\d*)\}")
+
+
+def has_nested_quantifier(regex):
+    """
+    Есть ли квантификатор над группой, внутри которой уже есть повторение:
+    (a+)+, (\\w*)*, ((ab)+c){2,} — главная причина катастрофического возврата.
+    """
+    stack = [False]  # для каждой открытой группы: есть ли внутри повторение
+    closed_repeats = False  # только что закрытая группа содержала повторение
+    i = 0
+    while i < len(regex):
+        ch = regex[i]
+        quantified = False
+        if ch == "\\":
+            i += 2
+        elif ch == "[":
+            # Класс символов: квантификаторов внутри не бывает
+            i += 1
+            if i < len(regex) and regex[i] == "^":
+                i += 1
+            if i < len(regex) and regex[i] == "]":
+                i += 1
+            while i < len(regex) and regex[i] != "]":
+                i += 2 if regex[i] == "\\" else 1
+            i += 1
+        elif ch == "(":
+            stack.append(False)
+            i += 1
+        elif ch == ")":
+            inner = stack.pop() if len(stack) > 1 else False
+            stack[-1] = stack[-1] or inner
+            i += 1
+            closed_repeats = inner
+            continue
+        elif ch in "*+":
+            quantified = True
+            i += 1
+        elif ch == "{" and _COUNTED.match(regex, i):
+            counted = _COUNTED.match(regex, i)
+            i = counted.end()
+            # {n} сам возврата не добавляет, но повторяет вложенные повторения n раз: (.*a){12}
+            if closed_repeats and (counted.group(2) or int(counted.group(1) or 0) > 1):
+                return True
+            quantified = bool(counted.group(2))
+        else:
+            i += 1
+        if quantified:
+            if closed_repeats:
+                return True
+            stack[-1] = True
+        closed_repeats = False
+    return False
+
+
+def validate_rule(rule):
+    """
+    Статическая проверка правила-шаблона. Бросает RuleError с причиной.
+    Простые слова не проверяются.
+    """
+    if not is_pattern_rule(rule):
+        return
+    body = rule_regex(rule)
+    if not body:
+        raise RuleError("пустой шаблон")
+    if len(body) > MAX_PATTERN_LENGTH:
+        raise RuleError(f"шаблон длиннее {MAX_PATTERN_LENGTH} символов")
+    if _UNSUPPORTED_SYNTAX.search(body):
+        raise RuleError("именованные группы, обратные ссылки и флаги (?i) внутри шаблона не поддерживаются")
+    try:
+        compiled = re.compile(body, re.IGNORECASE)
+    except re.error as e:
+        raise RuleError(f"некорректное регулярное выражение: {e}") from None
+    if compiled.search("") is not None:
+        raise RuleError("шаблон совпадает с пустой строкой и удалял бы все сообщения")
+    if has_nested_quantifier(body):
+        raise RuleError("вложенные повторения вида (a+)+ могут зависать на длинных сообщениях")
+
+
+# Выполняется в отдельном процессе: поиск по «неудобным» строкам длиной с сообщение Telegram
+_PROBE_SCRIPT = r"""
+import re, sys
+pattern = sys.stdin.read()
+compiled = re.compile(pattern, re.IGNORECASE)
+chars = sorted(set(ch for ch in pattern if ch.isalnum() or ch in " .,-_")) or ["a"]
+probes = [ch * 4095 + "\x00" for ch in chars + ["a", " ", "1"]]
+probes.append(("".join(chars) * 4096)[:4095] + "\x00")
+for probe in probes:
+    compiled.search(probe)
+"""
+
+
+async def probe_pattern(regex, timeout=PROBE_TIMEOUT):
+    """
+    Прогоняет шаблон по длинным строкам из его же символов в отдельном процессе.
+    Возвращает False, если поиск не уложился в timeout (процесс убивается):
+    в цикле событий такой шаблон остановил бы бота.
+    """
+    process = await asyncio.create_subprocess_exec(
+        sys.executable, "-c", _PROBE_SCRIPT,
+        stdin=asyncio.subprocess.PIPE, stdout=asyncio.subprocess.DEVNULL, stderr=asyncio.subprocess.DEVNULL,
+    )
+    try:
+        await asyncio.wait_for(process.communicate(regex.encode("utf-8")), timeout=timeout)
+    except asyncio.TimeoutError:
+        process.kill()
+        await process.wait()
+        return False
+    return process.returncode == 0
+
+
+async def check_rule(rule, timeout=PROBE_TIMEOUT):
+    """Полная проверка правила перед добавлением: синтаксис, затем пробный прогон. Бросает RuleError"""
+    validate_rule(rule)
+    if is_pattern_rule(rule) and not await probe_pattern(rule_regex(rule), timeout):
+        raise RuleError(f"поиск по шаблону занимает больше {timeout:g} с на длинном сообщении")
+
+
+class RuleMatcher:
+    """
+    Все правила одного ключа (chat_id, topic_id): простые слова ищет автомат Ахо-Корасик,
+    шаблоны объединены в одно регулярное выражение с именованными группами r0, r1, ...
+    Имя сработавшей группы указывает на правило.
+    Текст сообщения нормализуется один раз (normalize_text) и проверяется обоими способами.
+    """
+
+    __slots__ = ("words", "plain", "pattern", "_pattern_rules")
+
+    def __init__(self, rules):
+        self.words = list(rules)
+        plain = []
+        parts = []
+        self._pattern_rules = []
+        for rule in self.words:
+            if is_exclusion_rule(rule):
+                continue  # действует только при наследовании, см. merge_rules
+            if not is_pattern_rule(rule):
+                plain.append(rule)
+                continue
+            try:
+                validate_rule(rule)
+            except RuleError as e:
+                # Правило могло попасть в данные в обход /add — пропускаем его, а не весь ключ
+                logging.warning(f"⚠️ Правило {rule!r} пропущено: {e}")
+                continue
+            parts.append(f"(?P<r{len(self._pattern_rules)}>{rule_regex(rule)})")
+            self._pattern_rules.append(rule)
+        self.plain = StopWordMatcher(plain, [normalize_text(word) for word in plain])
+        self.pattern = re.compile("|".join(parts), re.IGNORECASE) if parts else None
+
+    def __bool__(self):
+        return bool(self.plain) or self.pattern is not None
+
+    def _rule_for(self, match):
+        return self._pattern_rules[int(match.lastgroup[1:])]
+
+    def find(self, text):
+        """Возвращает первое сработавшее правило (простые слова проверяются первыми) или None"""
+        text = normalize_text(text)
+        word = self.plain.find(text)
+        if word is not None or self.pattern is None:
+            return word
+        match = self.pattern.search(text)
+        return self._rule_for(match) if match else None
+
+
+class MatcherCache:
+    """
+    Кэш скомпилированных правил по ключу (chat_id, topic_id).
+    Ключи можно объединять в группы (например, все темы чата), чтобы сбросить их разом.
+    """
+
+    def __init__(self):
+        self._matchers = {}
+        self._groups = {}
+
+    def get(self, key, load_words, group=None):
+        """Возвращает RuleMatcher для ключа; строит его через load_words() при первом обращении"""
+        matcher = self._matchers.get(key)
+        if matcher is None:
+            matcher = RuleMatcher(load_words())
+            self._matchers[key] = matcher
+            if group is not None:
+                self._groups.setdefault(group, set()).add(key)
+        return matcher
+
+    def invalidate(self, key):
+        """Сбрасывает скомпилированные правила ключа после их изменения"""
+        self._matchers.pop(key, None)
+
+    def invalidate_group(self, group):
+        """Сбрасывает все ключи группы"""
+        for key in self._groups.pop(group, ()):
+            self._matchers.pop(key, None)
+
+    def clear(self):
+        self._matchers.clear()
+        self._groups.clear()
@@ -0,0 +1,177 @@
+# --- КЭШ СООБЩЕНИЙ ДЛЯ /clean ---
+from collections import deque
+from datetime import datetime
+
+CACHE_CAPACITY_PER_CHAT = 1000
+
+
+class CachedMessage:
+    """
+    Запись кэша; __slots__ вместо dict экономит память на каждом сообщении.
+    timestamp — время Unix в секундах (float).
+    """
+
+    __slots__ = ("message_id", "chat_id", "topic_id", "user_id", "text", "timestamp", "alive")
+
+    def __init__(self, message_id, chat_id, topic_id, user_id, text, timestamp):
+        self.message_id = message_id
+        self.chat_id = chat_id
+        self.topic_id = topic_id
+        self.user_id = user_id
+        self.text = text
+        self.timestamp = timestamp
+        self.alive = True
+
+    @classmethod
+    def from_dict(cls, record):
+        timestamp = record["timestamp"]
+        if isinstance(timestamp, str):
+            # Старый формат журнала: ISO-строка
+            timestamp = datetime.fromisoformat(timestamp).timestamp()
+        return cls(record["message_id"], record["chat_id"], record["topic_id"],
+                   record["user_id"], record["text"], timestamp)
+
+    def to_dict(self):
+        return {
+            "message_id": self.message_id,
+            "chat_id": self.chat_id,
+            "topic_id": self.topic_id,
+            "user_id": self.user_id,
+            "text": self.text,
+            "timestamp": self.timestamp
+        }
+
+
+class MessageCache:
+    """
+    Кольцевые буферы сообщений по чатам плюс индекс (chat_id, user_id) -> сообщения.
+    Каждый чат хранит не больше capacity сообщений, поэтому шумный чат не вытесняет чужие.
+    Удалённые через /clean записи помечаются alive=False и выбрасываются из буфера чата
+    при вытеснении или при уплотнении, когда мёртвых записей становится больше capacity.
+    Общая очередь _order хранит все записи в порядке поступления (то есть по времени),
+    поэтому устаревшие записи снимаются с её головы за O(числа устаревших).
+    """
+
+    def __init__(self, capacity=CACHE_CAPACITY_PER_CHAT):
+        self.capacity = capacity
+        self._chats = {}
+        self._alive = {}
+        self._users = {}
+        self._order = deque()
+        self._size = 0
+
+    def __len__(self):
+        return self._size
+
+    def __iter__(self):
+        """Живые записи всех чатов в порядке поступления"""
+        for msg in self._order:
+            if msg.alive:
+                yield msg
+
+    def add(self, msg):
+        chat_id = msg.chat_id
+        messages = self._chats.get(chat_id)
+        if messages is None:
+            messages = self._chats[chat_id] = deque()
+            self._alive[chat_id] = 0
+        while self._alive[chat_id] >= self.capacity:
+            self._evict(messages.popleft())
+        messages.append(msg)
+        self._alive[chat_id] += 1
+        user_key = (msg.chat_id, msg.user_id)
+        user_messages = self._users.get(user_key)
+        if user_messages is None:
+            user_messages = self._users[user_key] = deque()
+        user_messages.append(msg)
+        self._order.append(msg)
+        self._size += 1
+        # Мёртвые записи (вытесненные, /clean) уходят из общей очереди при уплотнении
+        if len(self._order) > 2 * self._size + self.capacity:
+            self._order = deque(msg for msg in self._order if msg.alive)
+        return msg
+
+    def _evict(self, msg):
+        if not msg.alive:
+            return
+        # Самое старое живое сообщение чата — самое старое и у его автора
+        user_key = (msg.chat_id, msg.user_id)
+        user_messages = self._users[user_key]
+        user_messages.popleft()
+        if not user_messages:
+            del self._users[user_key]
+        msg.alive = False
+        self._alive[msg.chat_id] -= 1
+        self._size -= 1
+
+    def user_messages(self, chat_id, user_id, topic_id=None):
+        """Сообщения пользователя за O(k), где k — число его сообщений в кэше"""
+        user_messages = self._users.get((chat_id, user_id), ())
+        if topic_id is None:
+            return list(user_messages)
+        return [msg for msg in user_messages if msg.topic_id == topic_id]
+
+    def clear_user(self, chat_id, user_id, topic_id=None):
+        """Удаляет сообщения пользователя (во всём чате или только в теме)"""
+        user_key = (chat_id, user_id)
+        user_messages = self._users.get(user_key)
+        if not user_messages:
+            return
+        kept = deque()
+        for msg in user_messages:
+            if topic_id is None or msg.topic_id == topic_id:
+                msg.alive = False
+                self._alive[chat_id] -= 1
+                self._size -= 1
+            else:
+                kept.append(msg)
+        if kept:
+            self._users[user_key] = kept
+        else:
+            del self._users[user_key]
+
+        messages = self._chats[chat_id]
+        if len(messages) - self._alive[chat_id] > self.capacity:
+            self._chats[chat_id] = deque(msg for msg in messages if msg.alive)
+
+    def expire(self, cutoff, limit=None):
+        """
+        Удаляет записи с timestamp <= cutoff (не больше limit живых за вызов).
+        Самая старая живая запись чата всегда стоит в голове его буфера, поэтому
+        каждое удаление — O(1). Возвращает число удалённых живых записей.
+        """
+        order = self._order
+        removed = 0
+        while order and order[0].timestamp <= cutoff:
+            if limit is not None and removed >= limit:
+                break
+            msg = order.popleft()
+            if not msg.alive:
+                continue
+            chat_id = msg.chat_id
+            messages = self._chats[chat_id]
+            # Перед ней в буфере чата могут остаться только мёртвые записи
+            while messages[0] is not msg:
+                messages.popleft()
+            messages.popleft()
+            self._evict(msg)
+            if not messages:
+                del self._chats[chat_id]
+                del self._alive[chat_id]
+            removed += 1
+        return removed
+
+    def between(self, since, until):
+        """
+        Живые записи с since < timestamp <= until в порядке поступления. Проход идёт
+        с хвоста общей очереди до первой записи не новее since, поэтому стоит O(записей
+        новее since), а не O(размера кэша): обучение модели забирает только свежий отрезок.
+        """
+        records = []
+        for msg in reversed(self._order):
+            if msg.timestamp <= since:
+                break
+            if msg.alive and msg.timestamp <= until:
+                records.append(msg)
+        records.reverse()
+        return records
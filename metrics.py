@@ -0,0 +1,194 @@
+# --- МЕТРИКИ (текстовый формат Prometheus) ---
+# Без внешних зависимостей: счётчики, гистограммы и датчики хранятся в словарях,
+# текст для Prometheus собирается только при запросе /metrics.
+# Обновление метрики — поиск в словаре и пара сложений, доли микросекунды.
+import logging
+import time
+from bisect import bisect_left
+from aiohttp import web
+
+# Границы корзин гистограмм задержки (секунды)
+LATENCY_BUCKETS = (0.0001, 0.00025, 0.0005, 0.001, 0.0025, 0.005, 0.01, 0.025, 0.05, 0.1, 0.25, 0.5, 1, 2.5, 5, 10)
+
+CONTENT_TYPE = "text/plain; version=0.0.4; charset=utf-8"
+
+REGISTRY = []
+
+
+def _escape(value):
+    return str(value).replace("\\", "\\\\").replace("\n", "\\n").replace('"', '\\"')
+
+
+def _format_labels(names, values, extra=""):
+    parts = [f'{name}="{_escape(value)}"' for name, value in zip(names, values)]
+    if extra:
+        parts.append(extra)
+    return "{" + ",".join(parts) + "}" if parts else ""
+
+
+def _format_value(value):
+    if value == float("inf"):
+        return "+Inf"
+    return repr(float(value)) if isinstance(value, float) else str(value)
+
+
+class _Metric:
+    kind = ""
+
+    def __init__(self, name, documentation, labelnames=()):
+        self.name = name
+        self.documentation = documentation
+        self.labelnames = tuple(labelnames)
+        self._values = {}
+        REGISTRY.append(self)
+
+    def clear(self):
+        self._values.clear()
+
+    def render(self):
+        lines = [f"# HELP {self.name} {self.documentation}", f"# TYPE {self.name} {self.kind}"]
+        # list(): значения могут меняться из потока-писателя во время сборки текста
+        for labels, value in list(self._values.items()):
+            lines.extend(self._render_value(labels, value))
+        return lines
+
+    def _render_value(self, labels, value):
+        return [f"{self.name}{_format_labels(self.labelnames, labels)} {_format_value(value)}"]
+
+
+class Counter(_Metric):
+    """Монотонный счётчик; labels — кортеж значений в порядке labelnames"""
+
+    kind = "counter"
+
+    def inc(self, amount=1, labels=()):
+        self._values[labels] = self._values.get(labels, 0) + amount
+
+
+class Gauge(_Metric):
+    """Текущее значение; обычно выставляется перед отдачей /metrics"""
+
+    kind = "gauge"
+
+    def set(self, value, labels=()):
+        self._values[labels] = value
+
+
+class Histogram(_Metric):
+    """
+    Гистограмма: на каждый набор меток — счётчики по корзинам, сумма и количество.
+    Корзины хранятся без накопления, накопительные значения считаются при выводе.
+    """
+
+    kind = "histogram"
+
+    def __init__(self, name, documentation, labelnames=(), buckets=LATENCY_BUCKETS):
+        super().__init__(name, documentation, labelnames)
+        self.buckets = tuple(sorted(buckets))
+
+    def observe(self, value, labels=()):
+        state = self._values.get(labels)
+        if state is None:
+            state = self._values[labels] = [[0] * (len(self.buckets) + 1), 0.0, 0]
+        state[0][bisect_left(self.buckets, value)] += 1
+        state[1] += value
+        state[2] += 1
+
+    def _render_value(self, labels, state):
+        counts, total, count = state
+        lines = []
+        cumulative = 0
+        for bound, bucket_count in zip(self.buckets + (float("inf"),), counts):
+            cumulative += bucket_count
+            le = f'le="{_format_value(float(bound))}"'
+            lines.append(f"{self.name}_bucket{_format_labels(self.labelnames, labels, le)} {cumulative}")
+        suffix = _format_labels(self.labelnames, labels)
+        lines.append(f"{self.name}_sum{suffix} {_format_value(total)}")
+        lines.append(f"{self.name}_count{suffix} {count}")
+        return lines
+
+
+def render():
+    lines = []
+    for metric in REGISTRY:
+        lines.extend(metric.render())
+    return "\n".join(lines) + "\n"
+
+
+# --- МЕТРИКИ БОТА ---
+CHECK_SPAM_SECONDS = Histogram("antispam_check_spam_seconds", "Время обработки сообщения в check_spam")
+STORAGE_SECONDS = Histogram(
+    "antispam_storage_seconds", "Время операций хранилища (load, save, journal, compact, sqlite)", ("op",)
+)
+API_REQUEST_SECONDS = Histogram(
+    "antispam_api_request_seconds", "Время вызова Telegram API без ожидания в очереди", ("method",)
+)
+MESSAGES_TOTAL = Counter("antispam_messages_total", "Сообщения, прошедшие через check_spam")
+MATCHES_TOTAL = Counter("antispam_matches_total", "Найденные стоп-слова по чатам и темам", ("chat", "topic"))
+DELETIONS_TOTAL = Counter(
+    "antispam_deletions_total", "Итоги удаления: deleted, gone, forbidden, failed", ("result",)
+)
+DELETE_FAILURES_TOTAL = Counter(
+    "antispam_delete_failures_total", "Ошибки удаления по типу исключения", ("error",)
+)
+API_ERRORS_TOTAL = Counter("antispam_api_errors_total", "Ошибки Telegram API по методу и типу", ("method", "error"))
+CACHE_MESSAGES = Gauge("antispam_cache_messages", "Сообщений в кэше для /clean")
+RULE_WORDS = Gauge("antispam_rule_words", "Стоп-слов по чатам (все темы)", ("chat",))
+RULE_KEYS = Gauge("antispam_rule_keys", "Наборов правил (чат + тема)")
+DELETION_QUEUE_DEPTH = Gauge("antispam_deletion_queue_depth", "Глубина очереди удаления спама")
+API_QUEUE_DEPTH = Gauge("antispam_api_queue_depth", "Запросов к API в очереди планировщика")
+LOG_SUPPRESSED_TOTAL = Counter("antispam_log_suppressed_total", "События, не попавшие в лог из-за выборки", ("event",))
+CLASSIFY_BATCH_SECONDS = Histogram(
+    "antispam_classify_batch_seconds", "Время проверки пакета сообщений в пуле процессов (с ожиданием)"
+)
+CLASSIFY_FAIL_OPEN_TOTAL = Counter(
+    "antispam_classify_fail_open_total", "Сообщения, пропущенные без проверки: timeout, overload, error", ("reason",)
+)
+SCORER_BATCH_SECONDS = Histogram("antispam_scorer_batch_seconds", "Время оценки пакета сообщений моделью")
+SCORER_FLAGGED_TOTAL = Counter(
+    "antispam_scorer_flagged_total", "Сообщения выше порога модели по режиму: shadow, on", ("mode",)
+)
+RAID_MESSAGES_TOTAL = Counter("antispam_raid_messages_total", "Сообщения, удалённые как рейд (похожие от разных пользователей)")
+FLOOD_MESSAGES_TOTAL = Counter("antispam_flood_messages_total", "Сообщения, удалённые за превышение лимита флуда")
+LOG_DROPPED_TOTAL = Counter("antispam_log_dropped_total", "Записи лога, отброшенные при переполнении очереди")
+
+
+class timed:
+    """with timed(HISTOGRAM, labels): ... — записывает длительность блока"""
+
+    __slots__ = ("histogram", "labels", "started")
+
+    def __init__(self, histogram, labels=()):
+        self.histogram = histogram
+        self.labels = labels
+
+    def __enter__(self):
+        self.started = time.perf_counter()
+        return self
+
+    def __exit__(self, *exc):
+        self.histogram.observe(time.perf_counter() - self.started, self.labels)
+        return False
+
+
+async def start_metrics_server(host="127.0.0.1", port=9100, collect=None):
+    """
+    Поднимает HTTP-сервер с GET /metrics. collect — корутина, которая обновляет
+    датчики (размер кэша, число правил) перед каждой отдачей.
+    Возвращает AppRunner; остановка — await runner.cleanup().
+    """
+    async def handle(request):
+        if collect is not None:
+            try:
+                await collect()
+            except Exception as e:
+                logging.error(f"❌ Ошибка сбора метрик: {type(e).__name__}: {e}")
+        return web.Response(body=render().encode("utf-8"), headers={"Content-Type": CONTENT_TYPE})
+
+    app = web.Application()
+    app.router.add_get("/metrics", handle)
+    runner = web.AppRunner(app)
+    await runner.setup()
+    await web.TCPSite(runner, host, port).start()
+    logging.info(f"📈 Метрики: http://{host}:{port}/metrics")
+    return runner
@@ -0,0 +1,153 @@
+# --- НОРМАЛИЗАЦИЯ ТЕКСТА ПЕРЕД ПОИСКОМ СТОП-СЛОВ ---
+# Один проход по сообщению: NFKC, casefold и таблица translate, которая
+# убирает невидимые и комбинируемые символы и сводит похожие буквы
+# кириллицы, латиницы и греческого к одной (латинской) букве.
+# Стоп-слова проходят ту же нормализацию один раз при компиляции правил.
+import unicodedata
+
+# Невидимые символы: нулевой ширины, управление направлением письма, мягкий перенос,
+# селекторы вариантов, заполнители хангыля
+ZERO_WIDTH = (
+    [0x00AD, 0x034F, 0x061C, 0x115F, 0x1160, 0x17B4, 0x17B5, 0x180E, 0x3164, 0xFEFF, 0xFFA0]
+    + list(range(0x200B, 0x2010))
+    + list(range(0x202A, 0x202F))
+    + list(range(0x2060, 0x2070))
+    + list(range(0xFE00, 0xFE10))
+)
+
+# Блоки комбинируемых знаков (ударения, «залго»). Буквы с диакритикой, которые
+# NFKC собирает в один символ (й, ё, é), не разбираются и остаются буквами.
+COMBINING_BLOCKS = (
+    (0x0300, 0x0370), (0x0483, 0x048A), (0x0591, 0x05C8), (0x0610, 0x061B), (0x064B, 0x0660),
+    (0x1AB0, 0x1B00), (0x1DC0, 0x1E00), (0x20D0, 0x2100), (0x2DE0, 0x2E00), (0xFE20, 0xFE30),
+)
+
+# Похожие буквы -> каноническая латинская. Цифры не трогаются: 0 и о, 3 и з
+# слишком часто встречаются в обычных числах. Таблица применяется после casefold, поэтому
+# в ней только строчные двойники: в, к, м, н, т похожи на латиницу лишь заглавными
+# (В К М Н Т), а строчными дали бы совпадения "bet" в "привет", "kot" в "который".
+CONFUSABLES = {
+    # кириллица
+    "а": "a", "е": "e", "ё": "e", "о": "o",
+    "р": "p", "с": "c", "у": "y", "х": "x", "ѕ": "s", "і": "i", "ї": "i",
+    "ј": "j", "ԁ": "d", "ԛ": "q", "ԝ": "w", "ӏ": "l", "һ": "h", "ү": "y",
+    # греческий
+    "α": "a", "β": "b", "ε": "e", "η": "n", "ι": "i", "κ": "k", "μ": "m", "ν": "v",
+    "ο": "o", "ρ": "p", "τ": "t", "υ": "u", "χ": "x", "ς": "c", "σ": "o",
+}
+
+
+def _build_table():
+    table = {code: None for code in ZERO_WIDTH}
+    for start, end in COMBINING_BLOCKS:
+        for code in range(start, end):
+            if unicodedata.category(chr(code)) in ("Mn", "Me"):
+                table[code] = None
+    for char, canonical in CONFUSABLES.items():
+        table[ord(char)] = canonical
+        if "\u0400" <= char <= "\u052f":
+            # Заглавные кириллические — для регулярных выражений, которые не проходят casefold
+            table[ord(char.upper())] = canonical
+    return table
+
+
+TRANSLATE_TABLE = _build_table()
+
+
+def normalize_text(text):
+    """NFKC + casefold + удаление невидимых/комбинируемых знаков + замена похожих букв"""
+    if text.isascii():
+        # Чистый ASCII: NFKC ничего не меняет, заменять нечего
+        return text.lower()
+    if not unicodedata.is_normalized("NFKC", text):
+        text = unicodedata.normalize("NFKC", text)
+    return text.casefold().translate(TRANSLATE_TABLE)
+
+
+# Похожие символы, которые таблица заменяет буквой: для классов [...] в шаблонах
+_CLASS_CONFUSABLES = sorted(
+    (chr(code), canonical) for code, canonical in TRANSLATE_TABLE.items() if canonical
+)
+
+
+def _class_char(body, i):
+    """Символ класса [...] с позиции i: (символ или None для \\w, \\d и т.п., следующая позиция)"""
+    if body[i] != "\\" or i + 1 >= len(body):
+        return body[i], i + 1
+    escaped = body[i + 1]
+    size = {"x": 2, "u": 4, "U": 8}.get(escaped)
+    if size:
+        try:
+            return chr(int(body[i + 2:i + 2 + size], 16)), i + 2 + size
+        except ValueError:
+            return None, i + 2
+    if escaped.isascii() and escaped.isalnum():
+        return None, i + 2
+    return escaped, i + 2
+
+
+def _class_extras(body):
+    """Канонические буквы похожих символов, которые входят в класс (по одному или диапазоном)"""
+    extras = {}
+    i = 0
+    while i < len(body):
+        first, i = _class_char(body, i)
+        last = first
+        if i + 1 < len(body) and body[i] == "-":
+            last, i = _class_char(body, i + 1)
+            if first is None or last is None:
+                continue
+        elif first is None:
+            continue
+        for char, canonical in _CLASS_CONFUSABLES:
+            if first <= char <= last:
+                extras[canonical] = None
+    return "".join(extras)
+
+
+def _class_end(regex, start):
+    """Позиция закрывающей ] класса, который открывается в start, или -1"""
+    i = start + 1
+    if i < len(regex) and regex[i] == "^":
+        i += 1
+    if i < len(regex) and regex[i] == "]":
+        i += 1
+    while i < len(regex):
+        if regex[i] == "\\":
+            i += 2
+        elif regex[i] == "]":
+            return i
+        else:
+            i += 1
+    return -1
+
+
+def normalize_pattern(regex):
+    """
+    Нормализация регулярного выражения: только таблица translate.
+    NFKC и casefold испортили бы экранирование (\\S -> \\s), а регистр
+    учитывает флаг IGNORECASE при поиске.
+    Классы [...] не переводятся: перевод концов диапазона меняет его ([а-я] -> [a-я]).
+    Вместо этого к классу добавляются канонические буквы входящих в него похожих символов.
+    """
+    parts = []
+    i = 0
+    while i < len(regex):
+        char = regex[i]
+        if char == "\\" and i + 1 < len(regex):
+            escaped = regex[i + 1]
+            canonical = TRANSLATE_TABLE.get(ord(escaped), escaped)
+            # Экранированная похожая буква — обычная буква, а \\k или \\p были бы ошибкой
+            parts.append(canonical if canonical != escaped else "\\" + escaped)
+            i += 2
+            continue
+        if char == "[":
+            end = _class_end(regex, i)
+            if end != -1:
+                body_start = i + 2 if regex.startswith("[^", i) else i + 1
+                parts.append(regex[i:end] + _class_extras(regex[body_start:end]) + "]")
+                i = end + 1
+                continue
+        parts.append(char.translate(TRANSLATE_TABLE))
+        i += 1
+    return "".join(parts)
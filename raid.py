@@ -0,0 +1,183 @@
+# --- РЕЙДЫ: ОДНО И ТО ЖЕ СООБЩЕНИЕ ОТ МНОГИХ ПОЛЬЗОВАТЕЛЕЙ ---
+# Для каждого чата хранятся подписи MinHash последних сообщений (окно по времени
+# и не больше max_per_chat записей). Подпись разбита на полосы (LSH): сообщения
+# с совпадающей полосой попадают в одну корзину, поэтому кандидаты на сходство
+# ищутся по нескольким корзинам, а не перебором окна.
+import operator
+import re
+import time
+from collections import deque
+from normalize import normalize_text
+
+_MASK64 = (1 << 64) - 1
+_DIGITS = re.compile(r"\d+")
+_SPACES = re.compile(r"\s+")
+# Длина шингла (подстроки) в символах
+SHINGLE_SIZE = 5
+# Подпись строится по началу сообщения: копии рейда отличаются мелочами, а цена подписи
+# растёт с длиной текста
+MAX_TEXT_LENGTH = 200
+# Значение пустой ячейки подписи (в ячейку не попал ни один шингл)
+_EMPTY = 1 << 64
+# Шаг сдвига при заполнении пустых ячеек соседними (нечётная константа)
+_DENSIFY_STEP = 0x9E3779B97F4A7C15
+# Сколько кандидатов из корзин (самые новые в каждой) сравнивается с сообщением. Во время
+# рейда корзины заполнены копиями, а старые копии уже удалены — для решения хватает последних.
+MAX_CANDIDATES = 64
+
+
+class _Entry:
+    __slots__ = ("signature", "user_id", "message_id", "timestamp", "deleted")
+
+    def __init__(self, signature, user_id, message_id, timestamp):
+        self.signature = signature
+        self.user_id = user_id
+        self.message_id = message_id
+        self.timestamp = timestamp
+        self.deleted = False
+
+
+class _ChatWindow:
+    """Окно одного чата: записи по времени и корзины LSH (в каждой записи тоже по времени)"""
+
+    __slots__ = ("entries", "buckets")
+
+    def __init__(self):
+        self.entries = deque()
+        self.buckets = {}
+
+    def add(self, entry, keys):
+        self.entries.append(entry)
+        for key in keys:
+            bucket = self.buckets.get(key)
+            if bucket is None:
+                bucket = self.buckets[key] = deque()
+            bucket.append(entry)
+
+    def pop_oldest(self, band_keys):
+        # Самая старая запись окна — первая и в каждой своей корзине
+        entry = self.entries.popleft()
+        for key in band_keys(entry.signature):
+            bucket = self.buckets[key]
+            bucket.popleft()
+            if not bucket:
+                del self.buckets[key]
+
+
+class RaidDetector:
+    """
+    check() возвращает id сообщений рейда, которые нужно удалить (новое и ещё не
+    удалённые похожие), когда похожие сообщения за window секунд прислали
+    не меньше min_users разных пользователей. Иначе — None.
+    Сходство — доля совпавших ячеек подписи (оценка коэффициента Жаккара по шинглам).
+    Подпись — MinHash с одной перестановкой: хеши шинглов делятся по bands * rows ячейкам
+    по остатку, в каждой ячейке берётся минимум. Это один проход по шинглам вместо
+    прохода на каждую позицию подписи. Пустая ячейка берёт значение ближайшей непустой
+    справа со сдвигом на расстояние: иначе короткие тексты совпадали бы пустыми ячейками.
+    """
+
+    def __init__(self, min_users=5, window=300, similarity=0.8, max_per_chat=500, min_length=30,
+                 bands=12, rows=4):
+        self.min_users = min_users
+        self.window = window
+        self.similarity = similarity
+        self.max_per_chat = max_per_chat
+        # Текст короче шингла не даёт ни одного шингла, и подпись из него не построить
+        self.min_length = max(min_length, SHINGLE_SIZE)
+        self.bands = bands
+        self.rows = rows
+        self.slots = bands * rows
+        self._chats = {}
+
+    def signature(self, text):
+        """Подпись MinHash текста или None для слишком коротких (их повторы — обычное дело)"""
+        # Числа и пробелы не различаем: в рейдах меняют суммы, телефоны и отступы
+        text = _SPACES.sub(" ", _DIGITS.sub("0", normalize_text(text[:MAX_TEXT_LENGTH]))).strip()
+        if len(text) < self.min_length:
+            return None
+        slots = self.slots
+        mins = [_EMPTY] * slots
+        for h in {hash(text[i:i + SHINGLE_SIZE]) for i in range(len(text) - SHINGLE_SIZE + 1)}:
+            h &= _MASK64
+            slot = h % slots
+            if h < mins[slot]:
+                mins[slot] = h
+        if _EMPTY not in mins:
+            return tuple(mins)
+        if mins.count(_EMPTY) == slots:
+            # Не заполнено ни одной ячейки — заполнять пустые нечем
+            return None
+        signature = list(mins)
+        for i in range(slots):
+            if mins[i] == _EMPTY:
+                distance = 1
+                while mins[(i + distance) % slots] == _EMPTY:
+                    distance += 1
+                signature[i] = (mins[(i + distance) % slots] + distance * _DENSIFY_STEP) & _MASK64
+        return tuple(signature)
+
+    def _band_keys(self, signature):
+        rows = self.rows
+        return [(band, signature[band * rows:(band + 1) * rows]) for band in range(self.bands)]
+
+    def _expire_chat(self, window, cutoff):
+        entries = window.entries
+        while entries and (entries[0].timestamp <= cutoff or len(entries) > self.max_per_chat):
+            window.pop_oldest(self._band_keys)
+
+    def check(self, chat_id, user_id, message_id, text, now=None):
+        signature = self.signature(text) if text else None
+        if signature is None:
+            return None
+        now = time.monotonic() if now is None else now
+        window = self._chats.get(chat_id)
+        if window is None:
+            window = self._chats[chat_id] = _ChatWindow()
+        else:
+            self._expire_chat(window, now - self.window)
+
+        keys = self._band_keys(signature)
+        candidates = {}
+        for key in keys:
+            bucket = window.buckets.get(key)
+            if bucket is None:
+                continue
+            for i in range(len(bucket) - 1, max(-1, len(bucket) - 1 - MAX_CANDIDATES), -1):
+                candidates[id(bucket[i])] = bucket[i]
+            if len(candidates) >= MAX_CANDIDATES:
+                break
+        needed = self.similarity * len(signature)
+        similar = [
+            entry for entry in candidates.values()
+            if sum(map(operator.eq, signature, entry.signature)) >= needed
+        ]
+
+        new_entry = _Entry(signature, user_id, message_id, now)
+        window.add(new_entry, keys)
+        # Запись добавлена, окно могло вырасти сверх max_per_chat
+        self._expire_chat(window, now - self.window)
+
+        users = {entry.user_id for entry in similar}
+        users.add(user_id)
+        if len(users) < self.min_users:
+            return None
+        # Удалённые остаются в окне: следующие копии рейда совпадут с ними и удалятся сразу
+        to_delete = [message_id]
+        new_entry.deleted = True
+        for entry in similar:
+            if not entry.deleted:
+                entry.deleted = True
+                to_delete.append(entry.message_id)
+        return to_delete
+
+    def expire(self, now=None):
+        """Снимает устаревшие записи во всех чатах и забывает пустые чаты"""
+        cutoff = (time.monotonic() if now is None else now) - self.window
+        for chat_id in list(self._chats):
+            window = self._chats[chat_id]
+            self._expire_chat(window, cutoff)
+            if not window.entries:
+                del self._chats[chat_id]
+
+    def __len__(self):
+        return sum(len(window.entries) for window in self._chats.values())
@@ -0,0 +1,37 @@
+# --- ОГРАНИЧЕНИЕ ЧАСТОТЫ ЗАПРОСОВ ---
+import time
+
+
+class TokenBucket:
+    """
+    Корзина токенов: rate токенов в секунду, не больше capacity подряд.
+    Не ждёт сама: delay() говорит, сколько ждать, take() забирает токен.
+    """
+
+    def __init__(self, rate, capacity=None):
+        self.rate = rate
+        self.capacity = capacity if capacity is not None else max(1.0, rate)
+        self._tokens = self.capacity
+        self._updated = time.monotonic()
+
+    def _refill(self):
+        now = time.monotonic()
+        self._tokens = min(self.capacity, self._tokens + (now - self._updated) * self.rate)
+        self._updated = now
+
+    def delay(self):
+        """Сколько секунд ждать следующего токена (0 — токен есть прямо сейчас)"""
+        self._refill()
+        if self._tokens >= 1:
+            return 0.0
+        return (1 - self._tokens) / self.rate
+
+    @property
+    def full(self):
+        """Корзина полная — состояние не отличается от только что созданной"""
+        self._refill()
+        return self._tokens >= self.capacity
+
+    def take(self):
+        """Забирает токен без ожидания; вызывать после delay() == 0"""
+        self._tokens -= 1
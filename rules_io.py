@@ -0,0 +1,100 @@
+# --- ИМПОРТ И ЭКСПОРТ СПИСКОВ ПРАВИЛ (/import, /export) ---
+# Файл разбирается целиком, правила проверяются, а затем добавляются одним изменением
+# хранилища: одна запись на диск, одна запись отката и одна пересборка автомата.
+import asyncio
+import csv
+import io
+import json
+from matcher import RuleError, check_rule, is_pattern_rule
+
+# Файлы больше не принимаются: 1 МБ — это десятки тысяч правил
+IMPORT_MAX_BYTES = 1024 * 1024
+# Пробный прогон шаблонов идёт в отдельных процессах, не больше PROBE_CONCURRENCY одновременно
+PROBE_CONCURRENCY = 4
+EXPORT_FORMATS = ("txt", "json", "csv")
+
+
+class RulesFileError(ValueError):
+    """Файл не удалось разобрать; текст ошибки показывается админу"""
+
+
+def _rules_from_json(text):
+    try:
+        data = json.loads(text)
+    except json.JSONDecodeError as e:
+        raise RulesFileError(f"некорректный JSON: {e}") from None
+    # Список строк или объект в формате /export: {"rules": [...]}
+    if isinstance(data, dict):
+        data = data.get("rules")
+    if not isinstance(data, list) or not all(isinstance(rule, str) for rule in data):
+        raise RulesFileError("в JSON ожидается список строк или объект с полем \"rules\"")
+    return data
+
+
+def parse_rules_file(content, filename=""):
+    """
+    Правила из файла: JSON (список или формат /export), CSV (первый столбец)
+    или текст — по правилу в строке. Формат — по расширению, без него JSON узнаётся по [ или {.
+    Пробелы по краям обрезаются, пустые строки и повторы выбрасываются (порядок сохраняется).
+    """
+    if len(content) > IMPORT_MAX_BYTES:
+        raise RulesFileError(f"файл больше {IMPORT_MAX_BYTES // 1024} КБ")
+    try:
+        text = content.decode("utf-8-sig")
+    except UnicodeDecodeError:
+        raise RulesFileError("файл должен быть в кодировке UTF-8") from None
+
+    name = filename.lower()
+    if name.endswith(".json") or (not name.endswith((".txt", ".csv")) and text.lstrip().startswith(("[", "{"))):
+        rules = _rules_from_json(text)
+    elif name.endswith(".csv"):
+        rules = [row[0] for row in csv.reader(io.StringIO(text)) if row]
+    else:
+        rules = text.splitlines()
+
+    result = []
+    seen = set()
+    for rule in rules:
+        rule = rule.strip()
+        if rule and rule not in seen:
+            seen.add(rule)
+            result.append(rule)
+    return result
+
+
+async def check_rules(rules):
+    """
+    Проверяет правила-шаблоны (check_rule), простые слова принимаются как есть.
+    Возвращает (принятые правила, [(правило, причина)] для отклонённых).
+    """
+    semaphore = asyncio.Semaphore(PROBE_CONCURRENCY)
+
+    async def check(rule):
+        if not is_pattern_rule(rule):
+            return None
+        async with semaphore:
+            try:
+                await check_rule(rule)
+            except RuleError as e:
+                return str(e)
+        return None
+
+    errors = await asyncio.gather(*(check(rule) for rule in rules))
+    accepted = [rule for rule, error in zip(rules, errors) if error is None]
+    rejected = [(rule, error) for rule, error in zip(rules, errors) if error is not None]
+    return accepted, rejected
+
+
+def export_rules(rules, chat_id, topic_id, fmt="txt"):
+    """Содержимое файла экспорта (bytes); parse_rules_file читает все форматы обратно"""
+    if fmt == "json":
+        data = {"chat_id": chat_id, "topic_id": topic_id, "rules": list(rules)}
+        return json.dumps(data, ensure_ascii=False, indent=2).encode("utf-8")
+    if fmt == "csv":
+        output = io.StringIO()
+        writer = csv.writer(output)
+        for rule in rules:
+            writer.writerow([rule])
+        return output.getvalue().encode("utf-8")
+    # Правила с переводом строки текст не переживут — без потерь сохраняет json
+    return "".join(f"{rule}\n" for rule in rules).encode("utf-8")
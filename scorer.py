@@ -0,0 +1,175 @@
+# --- ОЦЕНКА СООБЩЕНИЙ МОДЕЛЬЮ (наивный Байес по n-граммам символов) ---
+# Стоп-слова ловят только то, что админ уже видел. Модель учится на сообщениях,
+# удалённых по стоп-словам (спам), и на сообщениях, которые пролежали в кэше и
+# не были удалены (не спам), и замечает новые написания тех же фраз.
+# Признаки — n-граммы символов нормализованного текста, хешированные в 2**HASH_BITS корзин.
+# Пакет сообщений оценивается одним проходом NumPy: хеши всех n-грамм пакета,
+# затем сумма весов по сообщениям через bincount.
+# NumPy — необязательная зависимость: без неё оценка моделью выключена.
+import asyncio
+import logging
+import math
+import os
+from normalize import normalize_text
+from metrics import SCORER_BATCH_SECONDS, timed
+
+try:
+    import numpy as np
+except ImportError:
+    np = None
+
+SCORER_AVAILABLE = np is not None
+
+HASH_BITS = 18
+NGRAM_SIZES = (3, 4, 5)
+# Сглаживание Лапласа для счётчиков n-грамм
+ALPHA = 0.5
+# Сообщения длиннее обрезаются: для оценки хватает начала, а хвост спама обычно повторяется
+MAX_TEXT_LENGTH = 1000
+# Режимы по чатам: off — модель не применяется, shadow — только лог, on — удаление
+SCORER_MODES = ("off", "shadow", "on")
+_PRIME = 1000003
+
+
+def _features(texts):
+    """
+    Хешированные n-граммы пакета: (корзины, номер сообщения для каждой корзины).
+    Тексты склеиваются через \\0, n-граммы через разделитель отбрасываются.
+    """
+    joined = "\0".join(normalize_text(text[:MAX_TEXT_LENGTH]) for text in texts) + "\0"
+    codes = np.frombuffer(joined.encode("utf-32-le"), dtype=np.uint32).astype(np.uint64)
+    is_sep = codes == 0
+    # Номер сообщения для каждой позиции: сколько разделителей стоит до неё
+    doc = np.cumsum(is_sep) - is_sep
+    buckets = []
+    docs = []
+    mask = np.uint64((1 << HASH_BITS) - 1)
+    for n in NGRAM_SIZES:
+        length = len(codes) - n + 1
+        if length <= 0:
+            continue
+        h = np.full(length, n, dtype=np.uint64)
+        for k in range(n):
+            h = h * np.uint64(_PRIME) + codes[k:k + length]
+        h ^= h >> np.uint64(29)
+        valid = (doc[n - 1:] == doc[:length]) & ~is_sep[n - 1:]
+        buckets.append((h & mask)[valid].astype(np.intp))
+        docs.append(doc[:length][valid])
+    if not buckets:
+        return np.zeros(0, dtype=np.intp), np.zeros(0, dtype=np.intp)
+    return np.concatenate(buckets), np.concatenate(docs)
+
+
+class SpamScorer:
+    """
+    Мультиномиальный наивный Байес: counts[0] — не спам, counts[1] — спам.
+    Веса (логарифм отношения правдоподобий) пересчитываются после обучения
+    и подменяются целиком, поэтому оценка может идти параллельно с обучением в потоке.
+    """
+
+    def __init__(self, min_samples=50):
+        self.min_samples = min_samples
+        self.counts = np.zeros((2, 1 << HASH_BITS), dtype=np.float64)
+        self.docs = [0, 0]
+        # Время Unix, до которого сообщения кэша уже учтены при обучении
+        self.trained_until = 0.0
+        self._model = None
+        self._rebuild()
+
+    @property
+    def ready(self):
+        """Обучена ли модель на достаточном числе примеров обоих классов"""
+        return min(self.docs) >= self.min_samples
+
+    def _rebuild(self):
+        totals = self.counts.sum(axis=1)
+        dim = self.counts.shape[1]
+        log_spam = np.log((self.counts[1] + ALPHA) / (totals[1] + ALPHA * dim))
+        log_ham = np.log((self.counts[0] + ALPHA) / (totals[0] + ALPHA * dim))
+        bias = math.log((self.docs[1] + 1) / (self.docs[0] + 1))
+        self._model = ((log_spam - log_ham).astype(np.float32), bias)
+
+    def learn(self, texts, label):
+        """Добавляет примеры класса label (1 — спам, 0 — не спам)"""
+        if not texts:
+            return
+        buckets, _ = _features(texts)
+        self.counts[label] += np.bincount(buckets, minlength=self.counts.shape[1])
+        self.docs[label] += len(texts)
+        self._rebuild()
+
+    def score(self, texts):
+        """Вероятности спама для пакета текстов (массив NumPy)"""
+        weights, bias = self._model
+        buckets, docs = _features(texts)
+        log_odds = np.bincount(docs, weights=weights[buckets], minlength=len(texts)) + bias
+        return 1 / (1 + np.exp(-np.clip(log_odds, -50, 50)))
+
+    def save(self, path):
+        """Атомарная запись счётчиков (для потока-писателя)"""
+        tmp_path = path + ".tmp"
+        with open(tmp_path, "wb") as f:
+            np.savez_compressed(f, counts=self.counts, docs=np.array(self.docs),
+                                trained_until=np.array(self.trained_until))
+        os.replace(tmp_path, path)
+
+    def load(self, path):
+        if not os.path.exists(path):
+            return False
+        try:
+            with np.load(path) as data:
+                if data["counts"].shape != self.counts.shape:
+                    logging.warning(f"⚠️ Модель {path} другого размера, обучение начнётся заново")
+                    return False
+                self.counts = data["counts"]
+                self.docs = [int(n) for n in data["docs"]]
+                self.trained_until = float(data["trained_until"])
+        except (OSError, ValueError, KeyError) as e:
+            logging.error(f"❌ Ошибка загрузки модели {path}: {e}")
+            return False
+        self._rebuild()
+        return True
+
+
+class ScoreBatcher:
+    """
+    Копит тексты из параллельных обработчиков до batch_size или batch_window секунд
+    и оценивает их одним вызовом SpamScorer.score в цикле событий.
+    """
+
+    def __init__(self, scorer, batch_size=64, batch_window=0.002):
+        self.scorer = scorer
+        self.batch_size = batch_size
+        self.batch_window = batch_window
+        self._texts = []
+        self._futures = []
+        self._handle = None
+
+    async def score(self, text):
+        loop = asyncio.get_running_loop()
+        future = loop.create_future()
+        self._texts.append(text)
+        self._futures.append(future)
+        if len(self._texts) >= self.batch_size:
+            self._flush()
+        elif self._handle is None:
+            self._handle = loop.call_later(self.batch_window, self._flush)
+        return await future
+
+    def _flush(self):
+        if self._handle is not None:
+            self._handle.cancel()
+            self._handle = None
+        texts, futures = self._texts, self._futures
+        self._texts, self._futures = [], []
+        if not texts:
+            return
+        try:
+            with timed(SCORER_BATCH_SECONDS):
+                scores = self.scorer.score(texts)
+        except Exception as e:
+            logging.error(f"❌ Ошибка оценки пакета: {type(e).__name__}: {e}")
+            scores = [0.0] * len(texts)
+        for future, value in zip(futures, scores):
+            if not future.done():
+                future.set_result(float(value))
@@ -0,0 +1,268 @@
+# --- НЕСКОЛЬКО ПРОЦЕССОВ: ШАРДЫ ПО ЧАТАМ ---
+# Фронт-процесс получает апдейты (getUpdates) и раздаёт их процессам-шардам по chat_id.
+# Шард — обычный бот в режиме webhook на 127.0.0.1:<SHARD_BASE_PORT + номер>:
+# свои правила, автоматы, кэш сообщений и файлы хранилища (data.shard<номер>.json ...).
+# Фронт ничего не разбирает, кроме полей для маршрутизации, и пересылает апдейт как есть.
+import asyncio
+import json
+import logging
+import os
+import signal
+import sys
+import aiohttp
+
+# Апдейты, которые обрабатывает бот
+ALLOWED_UPDATES = ["message", "callback_query"]
+# Команды админа с chat_id первым аргументом — идут в шард этого чата
+CHAT_COMMANDS = {
+    "/add", "/del", "/rules", "/clean", "/undo", "/score", "/flood", "/inherit", "/import", "/export",
+}
+# Команды, которые выполняет каждый шард (у каждого свои настройки)
+FANOUT_COMMANDS = {"/verbose"}
+# Путь после WEBHOOK_PATH, по которому шард отдаёт свой список правил: /all первого шарда
+# собирает списки всех шардов в один ответ
+RULES_LIST_SUFFIX = "/rules"
+# Разделитель номера шарда в callback_data кнопок, привязанных к шарду: "refresh@2"
+SHARD_DATA_SEPARATOR = "@"
+
+
+def shard_for_chat(chat_id, count):
+    """Номер шарда чата; для отрицательных id тоже в диапазоне 0..count-1"""
+    return chat_id % count
+
+
+def shard_data(data, index):
+    """callback_data кнопки, которую должен обработать шард index"""
+    return f"{data}{SHARD_DATA_SEPARATOR}{index}"
+
+
+def _command(text):
+    parts = text.split()
+    if not parts or not parts[0].startswith("/"):
+        return None, parts
+    return parts[0].split("@", 1)[0].lower(), parts
+
+
+def route_update(update, count):
+    """
+    Номера шардов, которым нужен апдейт (dict в формате Bot API).
+    Сообщения групп — шард чата; команды админа в ЛС — шард чата из аргумента,
+    /verbose — все шарды, остальное (в том числе сводный /all) — шард 0.
+    callback_data вида "refresh@2" уходит шарду 2, суффикс при этом срезается.
+    """
+    message = update.get("message")
+    if message is not None:
+        chat = message.get("chat", {})
+        if chat.get("type") != "private":
+            return [shard_for_chat(chat["id"], count)]
+        # /import приходит подписью к файлу
+        command, parts = _command(message.get("text") or message.get("caption") or "")
+        if command in FANOUT_COMMANDS:
+            return list(range(count))
+        if command in CHAT_COMMANDS and len(parts) > 1:
+            try:
+                return [shard_for_chat(int(parts[1]), count)]
+            except ValueError:
+                pass
+        return [0]
+
+    callback = update.get("callback_query")
+    if callback is not None:
+        data = callback.get("data") or ""
+        head, sep, tail = data.rpartition(SHARD_DATA_SEPARATOR)
+        if sep and tail.isdigit() and int(tail) < count:
+            callback["data"] = head
+            return [int(tail)]
+        # rules_<chat>_<topic>, add_<chat>_<topic>, topics_<chat>
+        parts = data.split("_")
+        if len(parts) > 1:
+            try:
+                return [shard_for_chat(int(parts[1]), count)]
+            except ValueError:
+                pass
+    return [0]
+
+
+class ShardWorker:
+    """
+    Процесс-шард и очередь апдейтов для него.
+    Апдейты пересылаются по одному и по порядку, а шард обрабатывает апдейты одного чата
+    строго друг за другом (webhook.ChatOrder), поэтому порядок сообщений чата сохраняется.
+    Упавший процесс перезапускается; пока он недоступен, апдейты ждут в очереди.
+    """
+
+    def __init__(self, index, port, script, env, path="/webhook", secret="", queue_size=10000):
+        self.index = index
+        self.url = f"http://127.0.0.1:{port}{path}"
+        self.script = script
+        self.env = env
+        self.secret = secret
+        self.queue = asyncio.Queue(maxsize=queue_size)
+        self.process = None
+        self.stopping = False
+
+    async def supervise(self):
+        delay = 1
+        while not self.stopping:
+            # Своя группа процессов: Ctrl+C получает только фронт, шарды он останавливает сам
+            self.process = await asyncio.create_subprocess_exec(
+                sys.executable, self.script, env=self.env, start_new_session=True
+            )
+            logging.info(f"🧩 Шард {self.index} запущен (pid {self.process.pid})")
+            started = asyncio.get_running_loop().time()
+            code = await self.process.wait()
+            if self.stopping:
+                break
+            # Быстрые повторные падения — ждём дольше, после долгой работы начинаем заново
+            if asyncio.get_running_loop().time() - started > 60:
+                delay = 1
+            logging.error(f"❌ Шард {self.index} завершился с кодом {code}, перезапуск через {delay} с")
+            await asyncio.sleep(delay)
+            delay = min(delay * 2, 30)
+
+    async def forward(self, session):
+        headers = {"X-Telegram-Bot-Api-Secret-Token": self.secret} if self.secret else {}
+        while True:
+            update = await self.queue.get()
+            delay = 0.5
+            while True:
+                try:
+                    async with session.post(self.url, json=update, headers=headers) as response:
+                        if response.status < 500:
+                            if response.status != 200:
+                                logging.warning(
+                                    f"⚠️ Шард {self.index} отклонил апдейт {update.get('update_id')}: HTTP {response.status}"
+                                )
+                            break
+                except (aiohttp.ClientError, asyncio.TimeoutError):
+                    pass  # шард ещё запускается или перезапускается
+                await asyncio.sleep(delay)
+                delay = min(delay * 2, 5)
+
+    async def stop(self, timeout=15):
+        """SIGTERM и ожидание: шард сам дописывает хранилище на диск"""
+        self.stopping = True
+        if self.process is None or self.process.returncode is not None:
+            return
+        self.process.terminate()
+        try:
+            await asyncio.wait_for(self.process.wait(), timeout)
+        except asyncio.TimeoutError:
+            logging.error(f"❌ Шард {self.index} не остановился за {timeout} с, завершаю принудительно")
+            self.process.kill()
+            await self.process.wait()
+
+
+async def fetch_rules_lists(indices, base_port, path="/webhook", secret="", known=None, timeout=5):
+    """
+    Списки правил шардов indices для сводного /all: {номер: ответ шарда или None, если он
+    недоступен}. known — {номер: версия}: шард с той же версией отвечает без списка.
+    """
+    headers = {"X-Telegram-Bot-Api-Secret-Token": secret} if secret else {}
+    known = known or {}
+
+    async def fetch(session, index):
+        url = f"http://127.0.0.1:{base_port + index}{path}{RULES_LIST_SUFFIX}"
+        params = {"version": known[index]} if index in known else {}
+        try:
+            async with session.get(url, params=params, headers=headers) as response:
+                if response.status == 200:
+                    return await response.json()
+                logging.warning(f"⚠️ Шард {index} не отдал список правил: HTTP {response.status}")
+        except (aiohttp.ClientError, asyncio.TimeoutError, ValueError) as e:
+            logging.warning(f"⚠️ Шард {index} не отдал список правил: {type(e).__name__}: {e}")
+        return None
+
+    async with aiohttp.ClientSession(timeout=aiohttp.ClientTimeout(total=timeout)) as session:
+        answers = await asyncio.gather(*(fetch(session, index) for index in indices))
+    return dict(zip(indices, answers))
+
+
+async def _api_call(session, token, method, **params):
+    async with session.post(f"https://api.telegram.org/bot{token}/{method}", json=params) as response:
+        payload = await response.json(content_type=None)
+    if not payload.get("ok"):
+        raise RuntimeError(f"{method}: {payload.get('description', response.status)}")
+    return payload["result"]
+
+
+async def run_front(token, script, count, base_port, path="/webhook", secret="", env=None,
+                    queue_size=10000, poll_timeout=25, metrics_port=0):
+    """
+    Запускает count процессов-шардов (script с SHARD_INDEX/SHARD_COUNT в окружении)
+    и раздаёт им апдейты из long polling до SIGINT/SIGTERM.
+    metrics_port — если задан, шард i отдаёт метрики на metrics_port + i.
+    """
+    base_env = dict(os.environ if env is None else env)
+    workers = []
+    for index in range(count):
+        worker_env = dict(base_env)
+        worker_env.update({
+            "SHARD_INDEX": str(index),
+            "SHARD_COUNT": str(count),
+            "UPDATE_MODE": "webhook",
+            "WEBHOOK_HOST": "127.0.0.1",
+            "WEBHOOK_PORT": str(base_port + index),
+            "WEBHOOK_PATH": path,
+            "WEBHOOK_URL": "",
+            "WEBHOOK_SECRET": secret,
+            "METRICS_PORT": str(metrics_port + index if metrics_port else 0),
+        })
+        workers.append(ShardWorker(index, base_port + index, script, worker_env, path, secret, queue_size))
+
+    stop = asyncio.Event()
+    loop = asyncio.get_running_loop()
+    for sig in (signal.SIGINT, signal.SIGTERM):
+        try:
+            loop.add_signal_handler(sig, stop.set)
+        except (NotImplementedError, RuntimeError):
+            pass  # Windows: остаётся KeyboardInterrupt
+
+    tasks = []
+    timeout = aiohttp.ClientTimeout(total=poll_timeout + 10)
+    async with aiohttp.ClientSession(timeout=timeout) as session:
+        for worker in workers:
+            tasks.append(asyncio.create_task(worker.supervise()))
+            tasks.append(asyncio.create_task(worker.forward(session)))
+        poller = asyncio.create_task(_poll(session, token, workers, poll_timeout))
+        try:
+            await asyncio.wait([poller, asyncio.create_task(stop.wait())], return_when=asyncio.FIRST_COMPLETED)
+        finally:
+            poller.cancel()
+            pending = sum(worker.queue.qsize() for worker in workers)
+            if pending:
+                logging.warning(f"⚠️ Остановка: не переслано апдейтов: {pending}")
+            await asyncio.gather(*(worker.stop() for worker in workers))
+            for task in tasks:
+                task.cancel()
+            await asyncio.gather(poller, *tasks, return_exceptions=True)
+    logging.info("🧩 Все шарды остановлены")
+
+
+async def _poll(session, token, workers, poll_timeout):
+    """
+    getUpdates и раскладка по очередям шардов. offset сдвигается, когда апдейт
+    поставлен в очередь: если фронт упадёт раньше пересылки, апдейт будет потерян, а не
+    обработан дважды. Полная очередь шарда задерживает чтение новых апдейтов.
+    """
+    await _api_call(session, token, "deleteWebhook")
+    me = await _api_call(session, token, "getMe")
+    logging.info(f"🤖 Бот запущен: @{me['username']}, шардов: {len(workers)}")
+    offset = None
+    delay = 1
+    while True:
+        try:
+            params = {"timeout": poll_timeout, "allowed_updates": ALLOWED_UPDATES}
+            if offset is not None:
+                params["offset"] = offset
+            updates = await _api_call(session, token, "getUpdates", **params)
+            delay = 1
+        except (aiohttp.ClientError, asyncio.TimeoutError, RuntimeError, json.JSONDecodeError) as e:
+            logging.error(f"❌ Ошибка getUpdates: {type(e).__name__}: {e}; повтор через {delay} с")
+            await asyncio.sleep(delay)
+            delay = min(delay * 2, 30)
+            continue
+        for update in updates:
+            offset = update["update_id"] + 1
+            for index in route_update(update, len(workers)):
+                await workers[index].queue.put(update)
@@ -0,0 +1,1027 @@
+import asyncio
+import json
+import logging
+import os
+import sqlite3
+import time
+from collections import deque
+from concurrent.futures import ThreadPoolExecutor
+from datetime import datetime
+from matcher import merge_rules
+from message_cache import CACHE_CAPACITY_PER_CHAT, CachedMessage, MessageCache
+from metrics import STORAGE_SECONDS, timed
+
+# --- ХРАНИЛИЩЕ ---
+# Два движка с одинаковым интерфейсом Storage:
+#   json   — data.json (правила и история) + журнал кэша cache.jsonl
+#   sqlite — один файл БД в режиме WAL с индексами по кэшу
+DATA_FILE = "data.json"
+# Кэш сообщений хранится отдельно: журнал JSON-строк, только дозапись
+CACHE_FILE = "cache.jsonl"
+SQLITE_FILE = "data.db"
+CACHE_MAX_AGE = 48 * 3600  # 48 часов (по умолчанию; задаётся cache_max_age)
+# Сколько последних изменений каждого ключа правил можно откатить
+HISTORY_DEPTH = 50
+
+def get_rules_key(chat_id, topic_id):
+    """
+    Генерирует ключ для правил.
+    topic_id может быть None (для всей группы/"веб-ветки _1") или числом (для настоящих тем).
+    """
+    # Используем "global" для None, чтобы избежать проблем с ключами
+    return f"{chat_id}_{topic_id}" if topic_id is not None else f"{chat_id}_global"
+
+def parse_rules_key(key):
+    """Обратное преобразование ключа правил в (chat_id, topic_id)"""
+    chat_id, topic = key.rsplit("_", 1)
+    return int(chat_id), (None if topic == "global" else int(topic))
+
+def effective_rules(rules, chat_id, topic_id, inherit=False):
+    """
+    Правила, действующие в теме: собственные, а если чат наследует правила (inherit) —
+    ещё и правила всей группы за вычетом исключений темы (merge_rules).
+    """
+    own = rules.get(get_rules_key(chat_id, topic_id), [])
+    if topic_id is None or not inherit:
+        return own
+    return merge_rules(rules.get(get_rules_key(chat_id, None), []), own)
+
+def empty_data():
+    """Пустая структура данных"""
+    return {"rules": {}, "history": {}, "settings": {}, "cache": []}
+
+
+def history_from_legacy(entries):
+    """
+    Переводит старую историю (общий список записей с полной копией old_words)
+    в стеки изменений по ключам: {ключ: [{"action", "word", "pos", "timestamp"}, ...]}.
+    pos — место слова в списке до изменения, по нему откат восстанавливает порядок.
+    """
+    stacks = {}
+    for h in entries:
+        old_words = h.get("old_words") or []
+        word = h["word"]
+        if h["action"] == "del" and word in old_words:
+            pos = old_words.index(word)
+        else:
+            pos = len(old_words)
+        timestamp = h.get("timestamp")
+        try:
+            timestamp = datetime.fromisoformat(timestamp).timestamp()
+        except (TypeError, ValueError):
+            timestamp = time.time()
+        stacks.setdefault(get_rules_key(h["chat_id"], h["topic_id"]), []).append(
+            {"action": h["action"], "word": word, "pos": pos, "timestamp": timestamp}
+        )
+    return stacks
+
+def load_data(path=DATA_FILE):
+    """Загружает данные из JSON файла"""
+    if os.path.exists(path):
+        try:
+            with timed(STORAGE_SECONDS, ("load",)), open(path, "r", encoding="utf-8") as f:
+                return json.load(f)
+        except Exception as e:
+            logging.error(f"Ошибка загрузки данных: {e}")
+    return empty_data()
+
+def save_data(data, path=DATA_FILE):
+    """
+    Сохраняет данные в JSON файл. Возвращает True при успехе.
+    Пишет во временный файл и атомарно подменяет им основной,
+    поэтому оборванная запись не портит data.json.
+    """
+    tmp_path = path + ".tmp"
+    try:
+        with timed(STORAGE_SECONDS, ("save",)):
+            with open(tmp_path, "w", encoding="utf-8") as f:
+                json.dump(data, f, ensure_ascii=False, indent=2)
+                f.flush()
+                os.fsync(f.fileno())
+            os.replace(tmp_path, path)
+        return True
+    except Exception as e:
+        logging.error(f"Ошибка сохранения: {e}")
+        return False
+
+
+class MessageJournal:
+    """
+    Журнал кэша сообщений: одна JSON-строка на запись, файл только дописывается.
+    Строка — либо сообщение, либо операция {"op": "clear", ...}.
+    Когда файл вырастает больше compact_bytes и вдвое больше размера после
+    прошлого сжатия, он переписывается из памяти — так большой живой кэш
+    не переписывается целиком при каждой записи.
+    """
+
+    def __init__(self, path=CACHE_FILE, compact_bytes=1_000_000):
+        self.path = path
+        self.compact_bytes = compact_bytes
+        self._pending = []
+        self._size = os.path.getsize(path) if os.path.exists(path) else 0
+        self._compacted_size = 0
+        self._compact_requested = False
+
+    @property
+    def pending(self):
+        return len(self._pending)
+
+    @property
+    def needs_compaction(self):
+        return self._compact_requested or self._size > max(self.compact_bytes, 2 * self._compacted_size)
+
+    def request_compaction(self):
+        self._compact_requested = True
+
+    def replay(self):
+        """Читает журнал при старте; битые строки (например, оборванные при падении) пропускаются"""
+        if not os.path.exists(self.path):
+            return
+        try:
+            with open(self.path, "r", encoding="utf-8") as f:
+                for line in f:
+                    try:
+                        yield json.loads(line)
+                    except ValueError:
+                        logging.warning("⚠️ Пропущена повреждённая строка журнала кэша")
+        except Exception as e:
+            logging.error(f"Ошибка чтения журнала кэша: {e}")
+
+    def append(self, entry):
+        """Ставит запись в буфер; на диск она попадёт при следующей фоновой записи"""
+        self._pending.append(json.dumps(entry, ensure_ascii=False) + "\n")
+
+    def take_pending(self):
+        """Забирает накопленный буфер одной строкой (в цикле событий)"""
+        chunk = "".join(self._pending)
+        self._pending = []
+        return chunk
+
+    def requeue(self, chunk):
+        """Возвращает неудачно записанный буфер в начало очереди"""
+        self._pending.insert(0, chunk)
+
+    def write_chunk(self, chunk):
+        """Дописывает буфер в конец файла одной операцией записи (в потоке-писателе)"""
+        try:
+            with timed(STORAGE_SECONDS, ("journal",)), open(self.path, "a", encoding="utf-8") as f:
+                f.write(chunk)
+        except Exception as e:
+            logging.error(f"Ошибка записи журнала кэша: {e}")
+            return False
+        self._size += len(chunk.encode("utf-8"))
+        return True
+
+    def begin_compaction(self):
+        """
+        Начинает сжатие: буфер больше не нужен, так как снимок кэша в памяти уже
+        содержит все его записи. Записи, пришедшие во время сжатия, снова копятся в буфере.
+        """
+        self._pending = []
+        self._compact_requested = False
+
+    def compact(self, records):
+        """Переписывает журнал снимком кэша: список CachedMessage (через временный файл и атомарную замену)"""
+        tmp_path = self.path + ".tmp"
+        try:
+            with timed(STORAGE_SECONDS, ("compact",)):
+                with open(tmp_path, "w", encoding="utf-8") as f:
+                    for record in records:
+                        f.write(json.dumps(record.to_dict(), ensure_ascii=False) + "\n")
+                os.replace(tmp_path, self.path)
+            self._size = self._compacted_size = os.path.getsize(self.path)
+        except Exception as e:
+            logging.error(f"Ошибка сжатия журнала кэша: {e}")
+            self._compact_requested = True
+
+
+def apply_cache_entry(cache, entry):
+    """Применяет строку журнала к кэшу в памяти"""
+    if entry.get("op") == "clear":
+        cache.clear_user(entry["chat_id"], entry["user_id"], entry["topic_id"])
+    else:
+        cache.add(CachedMessage.from_dict(entry))
+
+
+class Storage:
+    """
+    Интерфейс хранилища: правила, история изменений и кэш сообщений.
+    Правила и история всегда лежат в памяти, поэтому обработчики ждут только
+    изменения в памяти. Запись на диск идёт по схеме write-behind в отдельном потоке
+    (run_flusher): по таймеру или после flush_every изменений, записи одного файла
+    выполняются строго по очереди и склеиваются в одну.
+    """
+
+    def __init__(self, flush_interval=5.0, flush_every=100, cache_max_age=CACHE_MAX_AGE,
+                 history_depth=HISTORY_DEPTH, history_max_age=None):
+        self.flush_interval = flush_interval
+        self.flush_every = flush_every
+        # Сколько секунд хранить сообщения в кэше для /clean
+        self.cache_max_age = cache_max_age
+        # Откат: не больше history_depth изменений на ключ и (если задано) не старше history_max_age секунд
+        self.history_depth = history_depth
+        self.history_max_age = history_max_age
+        self._changes = 0
+        self._flush_needed = asyncio.Event()
+        # Фоновые записи идут по одной: их вызывает не только run_flusher, но и чтения кэша
+        self._flush_lock = asyncio.Lock()
+        # Один поток-писатель: все обращения к диску после старта идут через него
+        self._writer = ThreadPoolExecutor(max_workers=1, thread_name_prefix="storage-writer")
+        self.rules = {}
+        # Стеки изменений по ключам правил: самое новое изменение в конце
+        self.history = {}
+        # Разобранные ключи правил, чтобы не делать rsplit на каждый запрос
+        self._keys = {}
+        self._chat_keys = {}
+        # Версии правил: общая растёт при каждом изменении, у чата — версия его последнего
+        # изменения. По ним отрисованный список правил (/all) понимает, что устарел
+        self.rules_version = 0
+        self.chat_rules_versions = {}
+        # Настройки чатов: {chat_id: {имя: значение}}; значения — то, что переживает JSON
+        self.settings = {}
+
+    @property
+    def dirty(self):
+        return self._changes > 0
+
+    def mark_dirty(self):
+        """Отмечает изменение; после flush_every изменений будит фоновую запись"""
+        self._changes += 1
+        if self._changes >= self.flush_every:
+            self._flush_needed.set()
+
+    async def _in_writer(self, func, *args):
+        """Выполняет func в потоке-писателе, не блокируя цикл событий"""
+        return await asyncio.get_running_loop().run_in_executor(self._writer, func, *args)
+
+    # --- Правила ---
+    def _load_rules(self, rules, history):
+        """history — стеки по ключам; старый формат (общий список) переводится при загрузке"""
+        self.rules = rules
+        for key in self.rules:
+            self._index_key(key, *parse_rules_key(key))
+        if isinstance(history, list):
+            history = history_from_legacy(history)
+            self._history_migrated(history)
+        self.history = {}
+        for key, entries in history.items():
+            if entries:
+                self.history[key] = deque(entries)
+                self._trim_history(key)
+
+    def _history_migrated(self, history):
+        """Старая история переведена в новый формат: сохранить её (реализуется движком)"""
+        self.mark_dirty()
+
+    def _index_key(self, key, chat_id, topic_id):
+        self._keys[key] = (chat_id, topic_id)
+        self._chat_keys.setdefault(chat_id, set()).add(key)
+
+    def _words(self, chat_id, topic_id):
+        key = get_rules_key(chat_id, topic_id)
+        if key not in self.rules:
+            self.rules[key] = []
+            self._index_key(key, chat_id, topic_id)
+        return self.rules[key]
+
+    def _rules_changed(self, chat_id, topic_id, words):
+        """Сохраняет новый список слов ключа (реализуется движком)"""
+        self.mark_dirty()
+
+    def _rules_updated(self, chat_id, topic_id, words):
+        self.rules_version += 1
+        self.chat_rules_versions[chat_id] = self.rules_version
+        self._rules_changed(chat_id, topic_id, words)
+
+    def _history_added(self, chat_id, topic_id, entry):
+        pass
+
+    def _history_removed(self, entry):
+        pass
+
+    def _trim_history(self, key):
+        """Выбрасывает из стека ключа записи сверх history_depth и старше history_max_age"""
+        stack = self.history[key]
+        cutoff = time.time() - self.history_max_age if self.history_max_age else None
+        while stack and (len(stack) > self.history_depth or (cutoff is not None and stack[0]["timestamp"] < cutoff)):
+            self._history_removed(stack.popleft())
+        if not stack:
+            del self.history[key]
+
+    def _add_history(self, chat_id, topic_id, action, word, pos):
+        # Для отката хватает самого изменения: слово и его место в списке до изменения
+        key = get_rules_key(chat_id, topic_id)
+        entry = {"action": action, "word": word, "pos": pos, "timestamp": time.time()}
+        self.history.setdefault(key, deque()).append(entry)
+        self._history_added(chat_id, topic_id, entry)
+        self._trim_history(key)
+
+    def get_rules(self, chat_id, topic_id=None):
+        return self.rules.get(get_rules_key(chat_id, topic_id), [])
+
+    def get_effective_rules(self, chat_id, topic_id=None):
+        """Правила, которые проверяются в теме, с учётом наследования (настройка чата inherit_rules)"""
+        return effective_rules(self.rules, chat_id, topic_id, self.get_setting(chat_id, "inherit_rules", False))
+
+    def inheriting_chats(self):
+        """Чаты, в темах которых действуют правила всей группы"""
+        return {chat_id for chat_id, chat_settings in self.settings.items() if chat_settings.get("inherit_rules")}
+
+    def add_rule(self, chat_id, topic_id, word):
+        words = self._words(chat_id, topic_id)
+        if word in words:
+            return False
+        self._add_history(chat_id, topic_id, "add", word, len(words))
+        words.append(word)
+        self._rules_updated(chat_id, topic_id, words)
+        return True
+
+    def import_rules(self, chat_id, topic_id, new_words):
+        """
+        Добавляет в конец списка слова, которых в нём ещё нет, одним изменением:
+        одна запись отката ("import", список слов) и одно сохранение.
+        Возвращает список добавленных.
+        """
+        words = self._words(chat_id, topic_id)
+        existing = set(words)
+        added = []
+        for word in new_words:
+            if word not in existing:
+                existing.add(word)
+                added.append(word)
+        if not added:
+            return added
+        self._add_history(chat_id, topic_id, "import", list(added), len(words))
+        words.extend(added)
+        self._rules_updated(chat_id, topic_id, words)
+        return added
+
+    def del_rule(self, chat_id, topic_id, word):
+        words = self.get_rules(chat_id, topic_id)
+        if word not in words:
+            return False
+        pos = words.index(word)
+        self._add_history(chat_id, topic_id, "del", word, pos)
+        del words[pos]
+        self._rules_updated(chat_id, topic_id, words)
+        return True
+
+    def undo_last_change(self, chat_id, topic_id, steps=1):
+        """
+        Откатывает до steps последних изменений ключа, каждое за O(1) (плюс вставка в список слов).
+        Возвращает число откаченных изменений.
+        """
+        key = get_rules_key(chat_id, topic_id)
+        if key not in self.history:
+            return 0
+        self._trim_history(key)
+        stack = self.history.get(key)
+        words = self._words(chat_id, topic_id)
+        undone = 0
+        while stack and undone < steps:
+            h = stack.pop()
+            if h["action"] == "import":
+                added = h["word"]
+                if isinstance(added, str):
+                    # Старый формат записи: слова через перевод строки
+                    added = added.split("\n")
+                end = h["pos"] + len(added)
+                if words[h["pos"]:end] == added:
+                    del words[h["pos"]:end]
+                else:
+                    # После импорта список менялся — удаляем импортированные слова, где бы они ни стояли
+                    imported = set(added)
+                    words[:] = [word for word in words if word not in imported]
+            elif h["action"] == "add":
+                if h["pos"] < len(words) and words[h["pos"]] == h["word"]:
+                    del words[h["pos"]]
+                elif h["word"] in words:
+                    words.remove(h["word"])
+            elif h["word"] not in words:
+                words.insert(min(h["pos"], len(words)), h["word"])
+            self._history_removed(h)
+            undone += 1
+        if stack is not None and not stack:
+            del self.history[key]
+        if undone:
+            self._rules_updated(chat_id, topic_id, words)
+        return undone
+
+    def undo_depth(self, chat_id, topic_id):
+        """Сколько изменений ключа сейчас можно откатить"""
+        key = get_rules_key(chat_id, topic_id)
+        if key not in self.history:
+            return 0
+        self._trim_history(key)
+        return len(self.history.get(key, ()))
+
+    def rules_chats(self):
+        """id чатов, для которых есть правила, по возрастанию"""
+        return sorted(self._chat_keys)
+
+    def chat_rules_summary(self, chat_id):
+        """Список (topic_id, words) чата: вся группа первой, затем темы по номеру"""
+        result = [(self._keys[key][1], self.rules[key]) for key in self._chat_keys.get(chat_id, ())]
+        return sorted(result, key=lambda x: (x[0] is not None, x[0] or 0))
+
+    def topics_for_chat(self, chat_id):
+        """Список (topic_id, words) настоящих тем чата, по возрастанию topic_id"""
+        result = []
+        for key in self._chat_keys.get(chat_id, ()):
+            topic_id = self._keys[key][1]
+            if topic_id is not None:
+                result.append((topic_id, self.rules[key]))
+        return sorted(result, key=lambda x: x[0])
+
+    # --- Настройки чатов ---
+    def get_setting(self, chat_id, name, default=None):
+        return self.settings.get(chat_id, {}).get(name, default)
+
+    def set_setting(self, chat_id, name, value):
+        """value=None удаляет настройку (вернётся значение по умолчанию)"""
+        chat_settings = self.settings.setdefault(chat_id, {})
+        if value is None:
+            chat_settings.pop(name, None)
+            if not chat_settings:
+                del self.settings[chat_id]
+        else:
+            chat_settings[name] = value
+        self._setting_changed(chat_id, name, value)
+
+    def _setting_changed(self, chat_id, name, value):
+        """Сохраняет настройку (реализуется движком)"""
+        self.mark_dirty()
+
+    # --- Кэш сообщений ---
+    def cache_message(self, message_id, chat_id, topic_id, user_id, text):
+        raise NotImplementedError
+
+    async def get_user_messages(self, chat_id, user_id, topic_id=None, since=None):
+        """id сообщений пользователя из кэша; since — только не старше этого времени Unix"""
+        raise NotImplementedError
+
+    def clear_user_cache(self, chat_id, user_id, topic_id=None):
+        raise NotImplementedError
+
+    def clear_old_cache(self, max_age=None, limit=None):
+        """
+        Удаляет из кэша сообщения старше max_age секунд (по умолчанию cache_max_age),
+        не больше limit за вызов, если движок это поддерживает.
+        Возвращает число удалённых или None, если оно неизвестно сразу.
+        """
+        raise NotImplementedError
+
+    async def cached_count(self):
+        """Сколько сообщений сейчас в кэше (для метрик)"""
+        raise NotImplementedError
+
+    async def cached_between(self, since, until):
+        """Записи кэша (CachedMessage) с since < timestamp <= until в порядке поступления"""
+        raise NotImplementedError
+
+    # --- Запись на диск ---
+    def flush(self):
+        """Синхронно записывает всё несохранённое (используется при остановке)"""
+        raise NotImplementedError
+
+    async def flush_in_background(self):
+        """Записывает несохранённое в потоке-писателе"""
+        raise NotImplementedError
+
+    async def run_flusher(self):
+        """Фоновая запись: по таймеру или по сигналу от mark_dirty"""
+        while True:
+            try:
+                await asyncio.wait_for(self._flush_needed.wait(), timeout=self.flush_interval)
+            except asyncio.TimeoutError:
+                pass
+            self._flush_needed.clear()
+            try:
+                await self.flush_in_background()
+            except Exception as e:
+                logging.error(f"Ошибка фоновой записи: {e}")
+
+    def close(self):
+        # Дожидаемся записи, которая могла уже выполняться в потоке
+        self._writer.shutdown(wait=True)
+        self.flush()
+
+
+class JsonStorage(Storage):
+    """
+    Состояние в памяти: data.json читается один раз при старте и переписывается в фоне.
+    Кэш сообщений хранится в журнале cache.jsonl (только дозапись).
+    """
+
+    def __init__(self, path=DATA_FILE, cache_path=CACHE_FILE, cache_capacity=CACHE_CAPACITY_PER_CHAT,
+                 compact_bytes=1_000_000, **kwargs):
+        super().__init__(**kwargs)
+        self.path = path
+        self.cache_capacity = cache_capacity
+        data = load_data(path)
+        self._load_rules(data.get("rules", {}), data.get("history", {}))
+        # Ключи JSON-объекта — строки, в памяти chat_id хранится числом
+        self.settings = {int(chat_id): values for chat_id, values in data.get("settings", {}).items()}
+
+        # Кэш сообщений живёт только в памяти и в журнале, в data.json его нет
+        self.cache = MessageCache(cache_capacity)
+        self.journal = MessageJournal(cache_path, compact_bytes)
+        legacy_cache = data.get("cache")
+        if legacy_cache and not os.path.exists(cache_path):
+            # Одноразовый перенос кэша из старого формата data.json
+            for record in legacy_cache:
+                self.cache.add(CachedMessage.from_dict(record))
+            self.journal.request_compaction()
+            self._changes += 1
+        else:
+            for entry in self.journal.replay():
+                apply_cache_entry(self.cache, entry)
+        # Устаревшее за время простоя выбрасываем сразу; журнал перепишется при сжатии
+        self.cache.expire(time.time() - self.cache_max_age)
+
+    def _snapshot(self):
+        """Копия правил и истории для записи в другом потоке (списки копируются, записи истории неизменяемы)"""
+        return {
+            "rules": {key: list(words) for key, words in self.rules.items()},
+            "history": {key: list(stack) for key, stack in self.history.items()},
+            "settings": {str(chat_id): dict(values) for chat_id, values in self.settings.items()}
+        }
+
+    def cache_message(self, message_id, chat_id, topic_id, user_id, text):
+        """Добавляет сообщение в кэш: O(1) в памяти плюс строка в буфере журнала"""
+        msg = self.cache.add(CachedMessage(message_id, chat_id, topic_id, user_id, text, time.time()))
+        self.journal.append(msg.to_dict())
+        if self.journal.pending >= self.flush_every:
+            self._flush_needed.set()
+
+    async def get_user_messages(self, chat_id, user_id, topic_id=None, since=None):
+        return [
+            msg.message_id for msg in self.cache.user_messages(chat_id, user_id, topic_id)
+            if since is None or msg.timestamp >= since
+        ]
+
+    def clear_user_cache(self, chat_id, user_id, topic_id=None):
+        """Удаляет из кэша сообщения пользователя и записывает операцию в журнал"""
+        entry = {"op": "clear", "chat_id": chat_id, "user_id": user_id, "topic_id": topic_id}
+        apply_cache_entry(self.cache, entry)
+        self.journal.append(entry)
+
+    async def cached_count(self):
+        return len(self.cache)
+
+    def _cached_records(self):
+        return list(self.cache)
+
+    async def cached_between(self, since, until):
+        return self.cache.between(since, until)
+
+    def _import_cache(self, records):
+        """Массовое добавление записей кэша (перенос между хранилищами); журнал переписывается целиком"""
+        for msg in records:
+            self.cache.add(CachedMessage(msg.message_id, msg.chat_id, msg.topic_id, msg.user_id,
+                                         msg.text, msg.timestamp))
+        self.journal.request_compaction()
+
+    def clear_old_cache(self, max_age=None, limit=None):
+        """
+        Снимает устаревшие сообщения с головы кэша за O(числа удалённых).
+        В журнал ничего не пишется: при загрузке записи старше cache_max_age
+        отбрасываются по времени, а из файла они уходят при очередном сжатии.
+        """
+        cutoff = time.time() - (self.cache_max_age if max_age is None else max_age)
+        return self.cache.expire(cutoff, limit)
+
+    def flush(self):
+        if self.journal.needs_compaction:
+            self.journal.begin_compaction()
+            self.journal.compact(list(self.cache))
+        else:
+            chunk = self.journal.take_pending()
+            if chunk and not self.journal.write_chunk(chunk):
+                self.journal.requeue(chunk)
+        if self._changes:
+            changes = self._changes
+            if save_data(self._snapshot(), self.path):
+                self._changes -= changes
+
+    async def flush_in_background(self):
+        async with self._flush_lock:
+            await self._flush_in_writer()
+
+    async def _flush_in_writer(self):
+        # Снимки делаются в цикле событий, а сериализация и запись — в потоке-писателе
+        if self.journal.needs_compaction:
+            snapshot = list(self.cache)
+            self.journal.begin_compaction()
+            await self._in_writer(self.journal.compact, snapshot)
+        chunk = self.journal.take_pending()
+        if chunk and not await self._in_writer(self.journal.write_chunk, chunk):
+            self.journal.requeue(chunk)
+        if self._changes:
+            changes = self._changes
+            if await self._in_writer(save_data, self._snapshot(), self.path):
+                # Изменения, сделанные во время записи, остаются "грязными"
+                self._changes -= changes
+
+
+SQLITE_SCHEMA = """
+CREATE TABLE IF NOT EXISTS rules (
+    chat_id INTEGER NOT NULL,
+    topic_id INTEGER,
+    pos INTEGER NOT NULL,
+    word TEXT NOT NULL
+);
+CREATE INDEX IF NOT EXISTS rules_key ON rules (chat_id, topic_id, pos);
+
+CREATE TABLE IF NOT EXISTS undo_log (
+    id INTEGER PRIMARY KEY,
+    chat_id INTEGER NOT NULL,
+    topic_id INTEGER,
+    action TEXT NOT NULL,
+    word TEXT NOT NULL,
+    pos INTEGER NOT NULL,
+    timestamp REAL NOT NULL
+);
+CREATE INDEX IF NOT EXISTS undo_log_key ON undo_log (chat_id, topic_id, id);
+
+CREATE TABLE IF NOT EXISTS cache (
+    message_id INTEGER NOT NULL,
+    chat_id INTEGER NOT NULL,
+    topic_id INTEGER,
+    user_id INTEGER NOT NULL,
+    text TEXT NOT NULL,
+    timestamp REAL NOT NULL
+);
+CREATE INDEX IF NOT EXISTS cache_user ON cache (chat_id, user_id, topic_id);
+CREATE INDEX IF NOT EXISTS cache_chat ON cache (chat_id);
+CREATE INDEX IF NOT EXISTS cache_time ON cache (timestamp);
+
+CREATE TABLE IF NOT EXISTS chat_settings (
+    chat_id INTEGER NOT NULL,
+    name TEXT NOT NULL,
+    value TEXT NOT NULL,
+    PRIMARY KEY (chat_id, name)
+);
+
+CREATE TABLE IF NOT EXISTS meta (
+    key TEXT PRIMARY KEY,
+    value TEXT NOT NULL
+);
+"""
+
+
+def _dump_history_word(word):
+    # Запись импорта хранит список слов: в столбце word он лежит как JSON
+    return json.dumps(word, ensure_ascii=False) if isinstance(word, list) else word
+
+
+def _load_history_word(action, word):
+    if action != "import":
+        return word
+    try:
+        words = json.loads(word)
+    except ValueError:
+        return word  # старый формат: слова через перевод строки
+    return words if isinstance(words, list) else word
+
+
+class SqliteStorage(Storage):
+    """
+    SQLite в режиме WAL. Кэш проиндексирован по (chat_id, user_id, topic_id) и по времени,
+    поэтому /clean и очистка старых сообщений не сканируют всю таблицу.
+    Правила и история загружаются в память при старте; изменения копятся очередью
+    SQL-операций и применяются одной транзакцией в потоке-писателе.
+    """
+
+    def __init__(self, path=SQLITE_FILE, cache_capacity=CACHE_CAPACITY_PER_CHAT, **kwargs):
+        super().__init__(**kwargs)
+        self.path = path
+        self.cache_capacity = cache_capacity
+        # Соединение создаётся здесь, но после старта используется только потоком-писателем
+        self.db = sqlite3.connect(path, check_same_thread=False)
+        self.db.execute("PRAGMA journal_mode=WAL")
+        self.db.execute("PRAGMA synchronous=NORMAL")
+        self.db.executescript(SQLITE_SCHEMA)
+        self.db.commit()
+        self._ops = []
+        # Чаты, получившие сообщения после последней записи: их кэш обрезается при flush
+        self._touched_chats = set()
+
+        rules = {}
+        for chat_id, topic_id, word in self.db.execute(
+            "SELECT chat_id, topic_id, word FROM rules ORDER BY chat_id, topic_id, pos"
+        ):
+            rules.setdefault(get_rules_key(chat_id, topic_id), []).append(word)
+        history = {}
+        for row in self.db.execute(
+            "SELECT id, chat_id, topic_id, action, word, pos, timestamp FROM undo_log ORDER BY id"
+        ):
+            history.setdefault(get_rules_key(row[1], row[2]), []).append(
+                {"id": row[0], "action": row[3], "word": _load_history_word(row[3], row[4]),
+                 "pos": row[5], "timestamp": row[6]}
+            )
+        self._next_history_id = 1 + (self.db.execute("SELECT MAX(id) FROM undo_log").fetchone()[0] or 0)
+        if self.db.execute("SELECT 1 FROM sqlite_master WHERE type = 'table' AND name = 'history'").fetchone():
+            # Старая таблица history с полными копиями списков слов
+            history = [
+                {"chat_id": row[0], "topic_id": row[1], "action": row[2], "word": row[3],
+                 "old_words": json.loads(row[4]), "timestamp": row[5]}
+                for row in self.db.execute(
+                    "SELECT chat_id, topic_id, action, word, old_words, timestamp FROM history ORDER BY id"
+                )
+            ]
+        self._load_rules(rules, history)
+        for chat_id, name, value in self.db.execute("SELECT chat_id, name, value FROM chat_settings"):
+            self.settings.setdefault(chat_id, {})[name] = json.loads(value)
+
+    def _queue(self, sql, params=(), many=False):
+        self._ops.append((sql, params, many))
+        self.mark_dirty()
+
+    def get_meta(self, key):
+        row = self.db.execute("SELECT value FROM meta WHERE key = ?", (key,)).fetchone()
+        return row[0] if row else None
+
+    def set_meta(self, key, value):
+        self._queue("INSERT OR REPLACE INTO meta (key, value) VALUES (?, ?)", (key, value))
+
+    def _rules_changed(self, chat_id, topic_id, words):
+        self._queue("DELETE FROM rules WHERE chat_id = ? AND topic_id IS ?", (chat_id, topic_id))
+        self._queue(
+            "INSERT INTO rules (chat_id, topic_id, pos, word) VALUES (?, ?, ?, ?)",
+            [(chat_id, topic_id, pos, word) for pos, word in enumerate(words)],
+            many=True
+        )
+
+    def _history_migrated(self, history):
+        self._queue("DROP TABLE history")
+        for key, entries in history.items():
+            chat_id, topic_id = parse_rules_key(key)
+            for entry in entries:
+                self._history_added(chat_id, topic_id, entry)
+        self.flush()
+        logging.info("📦 История правил переведена в формат стеков изменений")
+
+    def _setting_changed(self, chat_id, name, value):
+        if value is None:
+            self._queue("DELETE FROM chat_settings WHERE chat_id = ? AND name = ?", (chat_id, name))
+        else:
+            self._queue(
+                "INSERT OR REPLACE INTO chat_settings (chat_id, name, value) VALUES (?, ?, ?)",
+                (chat_id, name, json.dumps(value, ensure_ascii=False))
+            )
+
+    def _history_added(self, chat_id, topic_id, entry):
+        entry["id"] = self._next_history_id
+        self._next_history_id += 1
+        self._queue(
+            "INSERT INTO undo_log (id, chat_id, topic_id, action, word, pos, timestamp) "
+            "VALUES (?, ?, ?, ?, ?, ?, ?)",
+            (entry["id"], chat_id, topic_id, entry["action"], _dump_history_word(entry["word"]),
+             entry["pos"], entry["timestamp"])
+        )
+
+    def _history_removed(self, entry):
+        self._queue("DELETE FROM undo_log WHERE id = ?", (entry["id"],))
+
+    def cache_message(self, message_id, chat_id, topic_id, user_id, text):
+        self._queue(
+            "INSERT INTO cache (message_id, chat_id, topic_id, user_id, text, timestamp) "
+            "VALUES (?, ?, ?, ?, ?, ?)",
+            (message_id, chat_id, topic_id, user_id, text, time.time())
+        )
+        self._touched_chats.add(chat_id)
+
+    def _select_user_messages(self, chat_id, user_id, topic_id, since):
+        query = "SELECT message_id FROM cache WHERE chat_id = ? AND user_id = ?"
+        params = [chat_id, user_id]
+        if topic_id is not None:
+            query += " AND topic_id = ?"
+            params.append(topic_id)
+        if since is not None:
+            query += " AND timestamp >= ?"
+            params.append(since)
+        return [row[0] for row in self.db.execute(query + " ORDER BY rowid", params)]
+
+    async def get_user_messages(self, chat_id, user_id, topic_id=None, since=None):
+        # Сначала применяем накопленные вставки, затем читаем в том же потоке-писателе
+        await self.flush_in_background()
+        return await self._in_writer(self._select_user_messages, chat_id, user_id, topic_id, since)
+
+    def clear_user_cache(self, chat_id, user_id, topic_id=None):
+        if topic_id is None:
+            self._queue("DELETE FROM cache WHERE chat_id = ? AND user_id = ?", (chat_id, user_id))
+        else:
+            self._queue(
+                "DELETE FROM cache WHERE chat_id = ? AND user_id = ? AND topic_id = ?",
+                (chat_id, user_id, topic_id)
+            )
+
+    async def cached_count(self):
+        # Без flush: несохранённые вставки ещё не видны, для метрики это допустимо
+        return await self._in_writer(lambda: self.db.execute("SELECT COUNT(*) FROM cache").fetchone()[0])
+
+    def _cached_records(self):
+        return [
+            CachedMessage(*row) for row in self.db.execute(
+                "SELECT message_id, chat_id, topic_id, user_id, text, timestamp FROM cache ORDER BY rowid"
+            )
+        ]
+
+    def _select_cached_between(self, since, until):
+        return [
+            CachedMessage(*row) for row in self.db.execute(
+                "SELECT message_id, chat_id, topic_id, user_id, text, timestamp FROM cache "
+                "WHERE timestamp > ? AND timestamp <= ? ORDER BY rowid",
+                (since, until)
+            )
+        ]
+
+    async def cached_between(self, since, until):
+        await self.flush_in_background()
+        return await self._in_writer(self._select_cached_between, since, until)
+
+    def _import_cache(self, records):
+        self._queue(
+            "INSERT INTO cache (message_id, chat_id, topic_id, user_id, text, timestamp) "
+            "VALUES (?, ?, ?, ?, ?, ?)",
+            [(msg.message_id, msg.chat_id, msg.topic_id, msg.user_id, msg.text, msg.timestamp)
+             for msg in records],
+            many=True
+        )
+
+    def clear_old_cache(self, max_age=None, limit=None):
+        # По индексу cache_time удаление стоит O(числа удалённых) и идёт в потоке-писателе,
+        # поэтому limit не нужен
+        cutoff = time.time() - (self.cache_max_age if max_age is None else max_age)
+        self._queue("DELETE FROM cache WHERE timestamp <= ?", (cutoff,))
+        return None
+
+    def _apply(self, ops, touched_chats):
+        """Применяет очередь операций одной транзакцией (выполняется в потоке-писателе)"""
+        try:
+            with timed(STORAGE_SECONDS, ("sqlite",)), self.db:
+                for sql, params, many in ops:
+                    if many:
+                        self.db.executemany(sql, params)
+                    else:
+                        self.db.execute(sql, params)
+                # Храним только последние cache_capacity сообщений каждого чата
+                for chat_id in touched_chats:
+                    self.db.execute(
+                        "DELETE FROM cache WHERE chat_id = ? AND rowid <= ("
+                        "SELECT rowid FROM cache WHERE chat_id = ? ORDER BY rowid DESC LIMIT 1 OFFSET ?)",
+                        (chat_id, chat_id, self.cache_capacity)
+                    )
+            return True
+        except sqlite3.Error as e:
+            logging.error(f"Ошибка сохранения: {e}")
+            return False
+
+    def _take_ops(self):
+        # Счётчик изменений обнуляется вместе с очередью: изменения во время записи считаются заново
+        ops, self._ops = self._ops, []
+        touched, self._touched_chats = self._touched_chats, set()
+        changes, self._changes = self._changes, 0
+        return ops, touched, changes
+
+    def _restore_ops(self, ops, touched, changes):
+        # Транзакция откатилась целиком — возвращаем операции в начало очереди
+        self._ops[:0] = ops
+        self._touched_chats |= touched
+        self._changes += changes
+
+    def flush(self):
+        if not self._ops:
+            return
+        ops, touched, changes = self._take_ops()
+        if not self._apply(ops, touched):
+            self._restore_ops(ops, touched, changes)
+
+    async def flush_in_background(self):
+        async with self._flush_lock:
+            if not self._ops:
+                return
+            ops, touched, changes = self._take_ops()
+            if not await self._in_writer(self._apply, ops, touched):
+                self._restore_ops(ops, touched, changes)
+
+    def close(self):
+        super().close()
+        self.db.close()
+
+
+def shard_path(path, index):
+    """Путь файла шарда: data.json -> data.shard2.json"""
+    root, ext = os.path.splitext(path)
+    return f"{root}.shard{index}{ext}"
+
+
+def copy_storage(source, target, keep_chat=None):
+    """
+    Копирует правила, историю, настройки чатов и кэш сообщений из source в target (движки могут различаться).
+    keep_chat(chat_id) отбирает чаты — так шард забирает из общего хранилища только свои.
+    """
+    for key, words in source.rules.items():
+        chat_id, topic_id = parse_rules_key(key)
+        if keep_chat is not None and not keep_chat(chat_id):
+            continue
+        words_copy = target._words(chat_id, topic_id)
+        words_copy[:] = words
+        target._rules_changed(chat_id, topic_id, words_copy)
+    for key, stack in source.history.items():
+        chat_id, topic_id = parse_rules_key(key)
+        if keep_chat is not None and not keep_chat(chat_id):
+            continue
+        entries = [dict(h) for h in stack]
+        target.history[key] = deque(entries)
+        for entry in entries:
+            target._history_added(chat_id, topic_id, entry)
+        target._trim_history(key)
+    for chat_id, values in source.settings.items():
+        if keep_chat is not None and not keep_chat(chat_id):
+            continue
+        for name, value in values.items():
+            target.set_setting(chat_id, name, value)
+    target._import_cache([
+        msg for msg in source._cached_records()
+        if keep_chat is None or keep_chat(msg.chat_id)
+    ])
+
+
+def _open_readonly_json(storage, data_path, cache_path):
+    """JsonStorage только для чтения: поток-писатель сразу останавливается, close() не вызывается"""
+    source = JsonStorage(data_path, cache_path=cache_path, cache_capacity=storage.cache_capacity,
+                         cache_max_age=storage.cache_max_age)
+    source._writer.shutdown()
+    return source
+
+
+def migrate_json_to_sqlite(storage, data_path=DATA_FILE, cache_path=CACHE_FILE):
+    """
+    Одноразовый перенос правил, истории и кэша из JSON-хранилища в SQLite.
+    Повторно не выполняется: факт переноса отмечается в таблице meta.
+    """
+    if storage.get_meta("migrated_from_json") or not os.path.exists(data_path):
+        return False
+    copy_storage(_open_readonly_json(storage, data_path, cache_path), storage)
+    storage.set_meta("migrated_from_json", datetime.now().isoformat())
+    storage.flush()
+    logging.info(f"📦 Данные перенесены из {data_path} в {storage.path}")
+    return True
+
+
+def seed_shard(storage, backend, index, count, data_path=DATA_FILE, cache_path=CACHE_FILE,
+               sqlite_path=SQLITE_FILE):
+    """
+    Первый запуск шарда: забирает из общего (нешардированного) хранилища чаты,
+    для которых chat_id % count == index. Общее хранилище не изменяется.
+    Источник — data.db для sqlite, если он есть, иначе data.json.
+    """
+    if backend == "sqlite" and os.path.exists(sqlite_path):
+        source = SqliteStorage(sqlite_path, cache_capacity=storage.cache_capacity,
+                               cache_max_age=storage.cache_max_age)
+        source._writer.shutdown()
+    elif os.path.exists(data_path):
+        source = _open_readonly_json(storage, data_path, cache_path)
+    else:
+        return False
+    copy_storage(source, storage, keep_chat=lambda chat_id: chat_id % count == index)
+    if isinstance(source, SqliteStorage):
+        source.db.close()
+    # Файл шарда записывается даже без правил: по нему следующий запуск видит, что перенос был
+    storage.mark_dirty()
+    storage.flush()
+    logging.info(f"📦 Шард {index}: чаты перенесены из общего хранилища в {storage.path}")
+    return True
+
+
+def open_storage(backend="json", data_path=DATA_FILE, cache_path=CACHE_FILE,
+                 sqlite_path=SQLITE_FILE, compact_bytes=1_000_000, shard=None, **kwargs):
+    """
+    Создаёт хранилище выбранного движка ("json" или "sqlite").
+    shard=(index, count) — хранилище процесса-шарда: у файлов суффикс .shard<index>,
+    при первом запуске в него копируются чаты шарда из общего хранилища.
+    """
+    if backend not in ("json", "sqlite"):
+        raise ValueError(f"Неизвестный движок хранилища: {backend}")
+    if shard is not None:
+        index, count = shard
+        paths = (shard_path(data_path, index), shard_path(cache_path, index), shard_path(sqlite_path, index))
+        storage = open_storage(backend, *paths, compact_bytes=compact_bytes, **kwargs)
+        # Признак первого запуска: у json — ещё нет файла шарда, у sqlite — нет отметки в meta
+        if backend == "json":
+            fresh = not os.path.exists(paths[0])
+        else:
+            fresh = not storage.get_meta("seeded_shard")
+        if fresh:
+            seed_shard(storage, backend, index, count, data_path, cache_path, sqlite_path)
+            if backend == "sqlite":
+                storage.set_meta("seeded_shard", f"{index}/{count}")
+                storage.flush()
+        return storage
+    if backend == "json":
+        return JsonStorage(data_path, cache_path=cache_path, compact_bytes=compact_bytes, **kwargs)
+    storage = SqliteStorage(sqlite_path, **kwargs)
+    migrate_json_to_sqlite(storage, data_path, cache_path)
+    return storage
@@ -0,0 +1,44 @@
+from flood import FLOOD_CONTINUES, FLOOD_STARTED, FloodLimiter
+
+
+def test_limit_boundary():
+    flood = FloodLimiter()
+    # 3 сообщения за 10 секунд: шаг 10 / 3
+    assert [flood.check(-1, 1, 3, 10, now=0.0) for _ in range(3)] == [None, None, None]
+    assert flood.check(-1, 1, 3, 10, now=0.0) == FLOOD_STARTED
+    assert flood.check(-1, 1, 3, 10, now=1.0) == FLOOD_CONTINUES
+    # Другой пользователь и другой чат считаются отдельно
+    assert flood.check(-1, 2, 3, 10, now=1.0) is None
+    assert flood.check(-2, 1, 3, 10, now=1.0) is None
+
+
+def test_capacity_returns_after_one_interval():
+    flood = FloodLimiter()
+    for _ in range(3):
+        assert flood.check(-1, 1, 3, 9, now=0.0) is None
+    # TAT = 9: до 3 секунд лимит исчерпан, ровно через шаг есть место для одного сообщения
+    assert flood.check(-1, 1, 3, 9, now=2.999) == FLOOD_STARTED
+    assert flood.check(-1, 1, 3, 9, now=3.0) is None
+    assert flood.check(-1, 1, 3, 9, now=3.0) == FLOOD_STARTED
+
+
+def test_rejected_messages_do_not_consume_capacity():
+    flood = FloodLimiter()
+    for _ in range(3):
+        flood.check(-1, 1, 3, 9, now=0.0)
+    for _ in range(100):
+        assert flood.check(-1, 1, 3, 9, now=1.0) is not None
+    assert flood.check(-1, 1, 3, 9, now=3.0) is None
+
+
+def test_expire_forgets_recovered_users():
+    flood = FloodLimiter()
+    flood.check(-1, 1, 3, 9, now=0.0)
+    flood.check(-1, 2, 3, 9, now=5.0)
+    assert len(flood) == 2
+    # TAT первого — 3, второго — 8
+    assert flood.expire(now=3.0) == 1
+    assert len(flood) == 1
+    assert flood.expire(now=7.9) == 0
+    assert flood.expire(now=8.0) == 1
+    assert len(flood) == 0
@@ -0,0 +1,33 @@
+import re
+from matcher import RuleMatcher, rule_regex
+
+
+def test_cyrillic_range_does_not_match_latin_words():
+    matcher = RuleMatcher(["re:^[а-я]+$"])
+    assert matcher.find("привет") == "re:^[а-я]+$"
+    assert matcher.find("hello") is None
+    assert matcher.find("quiz") is None
+
+
+def test_cyrillic_range_keeps_inner_letters():
+    matcher = RuleMatcher(["re:^[к-м]$"])
+    assert matcher.find("л") == "re:^[к-м]$"
+    assert matcher.find("к") == "re:^[к-м]$"
+    assert matcher.find("н") is None
+
+
+def test_range_with_confusable_endpoints_compiles():
+    re.compile(rule_regex("re:[у-х]"))
+    matcher = RuleMatcher(["re:^[у-х]$"])
+    assert matcher.find("ф") == "re:^[у-х]$"
+    assert matcher.find("х") == "re:^[у-х]$"
+    assert matcher.find("ц") is None
+
+
+def test_lowercase_cyrillic_without_latin_twin_is_not_folded():
+    # в, н, т, м, к похожи на латиницу только заглавными
+    assert RuleMatcher(["bet"]).find("привет всем") is None
+    assert RuleMatcher(["bet"]).find("ответ") is None
+    assert RuleMatcher(["hot"]).find("блокнот") is None
+    assert RuleMatcher(["kot"]).find("который Котик") is None
+    assert RuleMatcher(["casino"]).find("саsinо") == "casino"
@@ -0,0 +1,21 @@
+from raid import SHINGLE_SIZE, RaidDetector
+
+AD = "Заработок от {} рублей в день, пиши в личку, обучение бесплатно"
+
+
+def test_raid_detected_from_min_users():
+    detector = RaidDetector(min_users=3)
+    results = [detector.check(-1, user, user, AD.format(1000 + user), now=float(user)) for user in range(4)]
+    assert results[:2] == [None, None]
+    assert sorted(results[2]) == [0, 1, 2]
+    assert results[3] == [3]
+
+
+def test_short_text_without_shingles():
+    # Раньше заполнение пустых ячеек подписи зацикливалось
+    detector = RaidDetector(min_length=1)
+    assert detector.min_length == SHINGLE_SIZE
+    assert detector.signature("abc") is None
+    assert detector.check(-1, 1, 1, "abc") is None
+    detector.min_length = 0
+    assert detector.signature("abc") is None
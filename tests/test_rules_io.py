@@ -0,0 +1,43 @@
+import json
+
+import pytest
+from rules_io import IMPORT_MAX_BYTES, RulesFileError, export_rules, parse_rules_file
+
+RULES = ["казино", "re:\\d{5,}", "glob:крипт*", "a, b"]
+
+
+def test_text_file_strips_and_dedupes():
+    content = "﻿ казино \n\nставки\r\nказино\n  \nre:\\d+\n".encode("utf-8")
+    assert parse_rules_file(content, "rules.txt") == ["казино", "ставки", "re:\\d+"]
+
+
+def test_csv_takes_first_column():
+    content = 'казино,комментарий\n"a, b"\n\nставки\n'.encode("utf-8")
+    assert parse_rules_file(content, "RULES.CSV") == ["казино", "a, b", "ставки"]
+
+
+def test_json_list_and_export_object():
+    assert parse_rules_file(json.dumps(["x", " y ", "x"]).encode(), "r.json") == ["x", "y"]
+    exported = json.dumps({"chat_id": -1, "topic_id": None, "rules": ["x"]}).encode()
+    assert parse_rules_file(exported, "r.json") == ["x"]
+    # Без расширения JSON узнаётся по первому символу
+    assert parse_rules_file(b'  ["x"]', "") == ["x"]
+    # У .txt скобка — обычное правило
+    assert parse_rules_file(b"[x]", "r.txt") == ["[x]"]
+
+
+@pytest.mark.parametrize("fmt", ["txt", "json", "csv"])
+def test_export_round_trip(fmt):
+    assert parse_rules_file(export_rules(RULES, -1, None, fmt), f"rules.{fmt}") == RULES
+
+
+@pytest.mark.parametrize("content, filename", [
+    (b"x" * (IMPORT_MAX_BYTES + 1), "rules.txt"),
+    ("казино".encode("cp1251"), "rules.txt"),
+    (b"[\"x\",", "rules.json"),
+    (b"{\"words\": [\"x\"]}", "rules.json"),
+    (b"[1, 2]", "rules.json"),
+])
+def test_bad_files_raise(content, filename):
+    with pytest.raises(RulesFileError):
+        parse_rules_file(content, filename)
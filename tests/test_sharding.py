@@ -0,0 +1,59 @@
+from sharding import route_update, shard_data, shard_for_chat
+
+CHAT = -1001234567890
+
+
+def private(text):
+    return {"message": {"chat": {"id": 42, "type": "private"}, "text": text}}
+
+
+def callback(data):
+    return {"callback_query": {"data": data}}
+
+
+def test_shard_for_negative_chat_is_in_range():
+    for count in (1, 2, 3, 7):
+        assert 0 <= shard_for_chat(CHAT, count) < count
+    assert shard_for_chat(-1, 3) == 2
+
+
+def test_group_message_goes_to_chat_shard():
+    update = {"message": {"chat": {"id": CHAT, "type": "supergroup"}, "text": "/add казино"}}
+    assert route_update(update, 4) == [shard_for_chat(CHAT, 4)]
+
+
+def test_chat_commands_route_by_argument():
+    shard = shard_for_chat(CHAT, 4)
+    assert route_update(private(f"/add {CHAT} 0 казино"), 4) == [shard]
+    assert route_update(private(f"/ADD@spam_bot {CHAT} казино"), 4) == [shard]
+    # /import приходит подписью к файлу
+    update = {"message": {"chat": {"id": 42, "type": "private"}, "caption": f"/import {CHAT}"}}
+    assert route_update(update, 4) == [shard]
+    assert route_update(private("/add казино"), 4) == [0]
+    assert route_update(private("/add"), 4) == [0]
+
+
+def test_fanout_and_default_commands():
+    assert route_update(private("/verbose quiet"), 3) == [0, 1, 2]
+    assert route_update(private("/verbose@spam_bot"), 3) == [0, 1, 2]
+    assert route_update(private(f"/all {CHAT}"), 3) == [0]
+    assert route_update(private("привет"), 3) == [0]
+
+
+def test_callback_shard_suffix_is_stripped():
+    update = callback(shard_data("refresh", 2))
+    assert route_update(update, 3) == [2]
+    assert update["callback_query"]["data"] == "refresh"
+    update = callback(shard_data(f"rules_{CHAT}_0", 1))
+    assert route_update(update, 3) == [1]
+    assert update["callback_query"]["data"] == f"rules_{CHAT}_0"
+
+
+def test_callback_out_of_range_suffix_falls_back():
+    # Суффикс от запуска с большим числом шардов: маршрут по chat_id из данных
+    update = callback(f"rules_{CHAT}_0@5")
+    assert route_update(update, 3) == [shard_for_chat(CHAT, 3)]
+    assert update["callback_query"]["data"] == f"rules_{CHAT}_0@5"
+    assert route_update(callback(f"topics_{CHAT}"), 3) == [shard_for_chat(CHAT, 3)]
+    assert route_update(callback("refresh@5"), 3) == [0]
+    assert route_update(callback("refresh"), 3) == [0]
@@ -0,0 +1,156 @@
+import json
+import sqlite3
+
+import pytest
+from storage import JsonStorage, SqliteStorage, copy_storage, get_rules_key, open_storage
+
+CHAT = -1001234567890
+
+
+def open_backend(backend, tmp_path):
+    return open_storage(
+        backend,
+        data_path=str(tmp_path / "data.json"),
+        cache_path=str(tmp_path / "cache.jsonl"),
+        sqlite_path=str(tmp_path / "data.db"),
+    )
+
+
+def reopen(storage, backend, tmp_path):
+    storage.close()
+    return open_backend(backend, tmp_path)
+
+
+@pytest.mark.parametrize("backend", ["json", "sqlite"])
+def test_undo_add_del_import_round_trip(backend, tmp_path):
+    storage = open_backend(backend, tmp_path)
+    storage.add_rule(CHAT, None, "казино")
+    storage.add_rule(CHAT, None, "ставки")
+    storage.del_rule(CHAT, None, "казино")
+    assert storage.import_rules(CHAT, None, ["ставки", "крипта", "re:\\d{5,}"]) == ["крипта", "re:\\d{5,}"]
+    assert storage.get_rules(CHAT, None) == ["ставки", "крипта", "re:\\d{5,}"]
+
+    # Стек отката переживает перезапуск, запись импорта остаётся списком
+    storage = reopen(storage, backend, tmp_path)
+    assert storage.undo_depth(CHAT, None) == 4
+    assert storage.undo_last_change(CHAT, None) == 1
+    assert storage.get_rules(CHAT, None) == ["ставки"]
+    assert storage.undo_last_change(CHAT, None) == 1
+    # Удалённое слово возвращается на прежнее место
+    assert storage.get_rules(CHAT, None) == ["казино", "ставки"]
+
+    storage = reopen(storage, backend, tmp_path)
+    assert storage.undo_last_change(CHAT, None, steps=5) == 2
+    assert storage.get_rules(CHAT, None) == []
+    assert storage.undo_last_change(CHAT, None) == 0
+
+    storage = reopen(storage, backend, tmp_path)
+    assert storage.get_rules(CHAT, None) == []
+    assert storage.undo_depth(CHAT, None) == 0
+    storage.close()
+
+
+@pytest.mark.parametrize("backend", ["json", "sqlite"])
+def test_undo_import_after_list_changed(backend, tmp_path):
+    storage = open_backend(backend, tmp_path)
+    storage.add_rule(CHAT, 7, "а")
+    storage.import_rules(CHAT, 7, ["б", "в"])
+    storage.del_rule(CHAT, 7, "а")
+    storage.add_rule(CHAT, 7, "г")
+    storage = reopen(storage, backend, tmp_path)
+    # Два шага отката: "г" убирается, "а" возвращается в начало
+    assert storage.undo_last_change(CHAT, 7, steps=2) == 2
+    assert storage.get_rules(CHAT, 7) == ["а", "б", "в"]
+    assert storage.undo_last_change(CHAT, 7) == 1
+    assert storage.get_rules(CHAT, 7) == ["а"]
+    storage.close()
+
+
+def legacy_history():
+    return [
+        {"chat_id": CHAT, "topic_id": None, "action": "add", "word": "казино",
+         "old_words": [], "timestamp": "2024-01-01T00:00:00"},
+        {"chat_id": CHAT, "topic_id": None, "action": "add", "word": "ставки",
+         "old_words": ["казино"], "timestamp": "2024-01-01T00:01:00"},
+        {"chat_id": CHAT, "topic_id": None, "action": "del", "word": "казино",
+         "old_words": ["казино", "ставки"], "timestamp": "2024-01-01T00:02:00"},
+    ]
+
+
+def test_json_legacy_history_becomes_undo_stack(tmp_path):
+    data = {"rules": {get_rules_key(CHAT, None): ["ставки"]}, "history": legacy_history(), "cache": []}
+    (tmp_path / "data.json").write_text(json.dumps(data, ensure_ascii=False), encoding="utf-8")
+
+    storage = open_backend("json", tmp_path)
+    assert storage.undo_depth(CHAT, None) == 3
+    storage = reopen(storage, "json", tmp_path)
+    saved = json.loads((tmp_path / "data.json").read_text(encoding="utf-8"))
+    assert isinstance(saved["history"], dict)
+    assert storage.undo_last_change(CHAT, None) == 1
+    assert storage.get_rules(CHAT, None) == ["казино", "ставки"]
+    storage.close()
+
+
+def test_sqlite_legacy_history_table_is_migrated(tmp_path):
+    path = str(tmp_path / "data.db")
+    SqliteStorage(path).close()
+    db = sqlite3.connect(path)
+    db.execute(
+        "CREATE TABLE history (id INTEGER PRIMARY KEY, chat_id INTEGER, topic_id INTEGER, "
+        "action TEXT, word TEXT, old_words TEXT, timestamp TEXT)"
+    )
+    db.executemany(
+        "INSERT INTO history (chat_id, topic_id, action, word, old_words, timestamp) VALUES (?, ?, ?, ?, ?, ?)",
+        [(h["chat_id"], h["topic_id"], h["action"], h["word"], json.dumps(h["old_words"]), h["timestamp"])
+         for h in legacy_history()]
+    )
+    db.execute("INSERT INTO rules (chat_id, topic_id, pos, word) VALUES (?, NULL, 0, 'ставки')", (CHAT,))
+    db.commit()
+    db.close()
+
+    SqliteStorage(path).close()
+    storage = SqliteStorage(path)
+    assert storage.db.execute("SELECT 1 FROM sqlite_master WHERE name = 'history'").fetchone() is None
+    assert storage.undo_depth(CHAT, None) == 3
+    assert storage.undo_last_change(CHAT, None, steps=2) == 2
+    assert storage.get_rules(CHAT, None) == ["казино"]
+    storage.close()
+
+
+def test_json_to_sqlite_migration_survives_reopen(tmp_path):
+    source = open_backend("json", tmp_path)
+    source.add_rule(CHAT, None, "казино")
+    source.import_rules(CHAT, 5, ["ставки", "крипта"])
+    source.set_setting(CHAT, "inherit_rules", True)
+    source.close()
+
+    storage = open_backend("sqlite", tmp_path)
+    storage = reopen(storage, "sqlite", tmp_path)
+    assert storage.get_meta("migrated_from_json")
+    assert storage.get_rules(CHAT, 5) == ["ставки", "крипта"]
+    assert storage.get_setting(CHAT, "inherit_rules") is True
+    # Перенос не повторяется: изменения в SQLite не затираются данными из data.json
+    storage.del_rule(CHAT, None, "казино")
+    storage = reopen(storage, "sqlite", tmp_path)
+    assert storage.get_rules(CHAT, None) == []
+    assert storage.undo_last_change(CHAT, None) == 1
+    assert storage.undo_last_change(CHAT, 5) == 1
+    assert storage.get_rules(CHAT, None) == ["казино"]
+    assert storage.get_rules(CHAT, 5) == []
+    storage.close()
+
+
+def test_copy_storage_keeps_undo_stacks(tmp_path):
+    source = JsonStorage(str(tmp_path / "data.json"), cache_path=str(tmp_path / "cache.jsonl"))
+    source.add_rule(CHAT, None, "казино")
+    source.add_rule(-1002, None, "ставки")
+    target = SqliteStorage(str(tmp_path / "copy.db"))
+    copy_storage(source, target, keep_chat=lambda chat_id: chat_id == CHAT)
+    target.close()
+    source.close()
+
+    target = SqliteStorage(str(tmp_path / "copy.db"))
+    assert target.rules_chats() == [CHAT]
+    assert target.undo_last_change(CHAT, None) == 1
+    assert target.get_rules(CHAT, None) == []
+    target.close()
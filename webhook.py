@@ -0,0 +1,121 @@
+# --- РЕЖИМ WEBHOOK (вместо long polling) ---
+import asyncio
+import logging
+import signal
+from aiohttp import web
+from aiogram import BaseMiddleware
+from aiogram.webhook.aiohttp_server import SimpleRequestHandler, setup_application
+
+
+class ChatOrder(BaseMiddleware):
+    """
+    Внешний middleware апдейтов: апдейты одного чата обрабатываются по одному и в порядке
+    поступления. SimpleRequestHandler запускает каждый апдейт отдельной задачей, и без этого
+    обработчики сообщений одного чата шли бы параллельно. Блокировка (очередь FIFO) берётся
+    до ConcurrencyLimit, поэтому ждущий своей очереди апдейт не занимает место в лимите.
+    """
+
+    def __init__(self):
+        # {chat_id: [блокировка, число апдейтов чата в работе и в очереди]}
+        self._chats = {}
+
+    async def __call__(self, handler, event, data):
+        chat = data.get("event_chat")
+        if chat is None:
+            return await handler(event, data)
+        entry = self._chats.get(chat.id)
+        if entry is None:
+            entry = self._chats[chat.id] = [asyncio.Lock(), 0]
+        entry[1] += 1
+        try:
+            async with entry[0]:
+                return await handler(event, data)
+        finally:
+            entry[1] -= 1
+            if not entry[1]:
+                del self._chats[chat.id]
+
+
+def json_route(answer, secret_token=None):
+    """
+    GET-обработчик aiohttp: JSON с ответом answer(query). С secret_token запрос
+    принимается только с тем же заголовком X-Telegram-Bot-Api-Secret-Token, что и апдейты.
+    """
+
+    async def handle(request):
+        if secret_token and request.headers.get("X-Telegram-Bot-Api-Secret-Token") != secret_token:
+            return web.Response(status=401)
+        return web.json_response(answer(request.query))
+
+    return handle
+
+
+class ConcurrencyLimit(BaseMiddleware):
+    """Внешний middleware апдейтов: не больше limit обработчиков одновременно"""
+
+    def __init__(self, limit):
+        self._semaphore = asyncio.Semaphore(limit)
+
+    async def __call__(self, handler, event, data):
+        async with self._semaphore:
+            return await handler(event, data)
+
+
+def create_app(dp, bot, path="/webhook", secret_token=None, max_concurrency=100, ordered=False, routes=None):
+    """
+    aiohttp-приложение, которое принимает апдейты POST-запросами на path
+    и передаёт их в те же хендлеры dp. Заголовок X-Telegram-Bot-Api-Secret-Token
+    сверяется с secret_token (если он задан).
+    ordered — апдейты одного чата по порядку (ChatOrder); routes — {путь: answer} для json_route.
+    """
+    if ordered:
+        dp.update.outer_middleware(ChatOrder())
+    dp.update.outer_middleware(ConcurrencyLimit(max_concurrency))
+    app = web.Application()
+    SimpleRequestHandler(dispatcher=dp, bot=bot, secret_token=secret_token or None).register(app, path=path)
+    for route_path, answer in (routes or {}).items():
+        app.router.add_get(route_path, json_route(answer, secret_token))
+    setup_application(app, dp, bot=bot)
+    return app
+
+
+async def run_webhook(dp, bot, host="0.0.0.0", port=8080, path="/webhook", secret_token=None,
+                      public_url=None, max_concurrency=100, ordered=False, routes=None):
+    """
+    Поднимает HTTP-сервер и работает до SIGINT/SIGTERM.
+    Если public_url не задан, setWebhook не вызывается — так сервер можно проверить
+    локально без Telegram, отправляя ему сохранённые апдейты:
+        curl -X POST localhost:8080/webhook -H "Content-Type: application/json" \\
+             -H "X-Telegram-Bot-Api-Secret-Token: <секрет>" -d @update.json
+    """
+    app = create_app(dp, bot, path, secret_token, max_concurrency, ordered, routes)
+    # Строка access-лога на каждый апдейт не нужна: события сообщений пишет EventLog
+    runner = web.AppRunner(app, access_log=None)
+    await runner.setup()
+    site = web.TCPSite(runner, host, port)
+    await site.start()
+    logging.info(f"🌐 Webhook-сервер слушает http://{host}:{port}{path}")
+
+    if public_url:
+        await bot.set_webhook(
+            public_url.rstrip("/") + path,
+            secret_token=secret_token or None,
+            allowed_updates=dp.resolve_used_update_types(),
+            max_connections=min(max_concurrency, 100),
+        )
+        me = await bot.get_me()
+        logging.info(f"🤖 Бот запущен (webhook): @{me.username}")
+    else:
+        logging.info("ℹ️ WEBHOOK_URL не задан: setWebhook пропущен, сервер работает локально")
+
+    stop = asyncio.Event()
+    loop = asyncio.get_running_loop()
+    for sig in (signal.SIGINT, signal.SIGTERM):
+        try:
+            loop.add_signal_handler(sig, stop.set)
+        except (NotImplementedError, RuntimeError):
+            pass  # Windows: остаётся KeyboardInterrupt
+    try:
+        await stop.wait()
+    finally:
+        await runner.cleanup()